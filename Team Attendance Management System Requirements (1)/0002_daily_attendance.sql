@@ -0,0 +1,14 @@
+-- Migration number: 0002 	 2026-10-18
+-- Per-user, per-day rollup of completed sessions, maintained on check-out
+CREATE TABLE IF NOT EXISTS daily_attendance (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER NOT NULL,
+  day DATE NOT NULL,
+  sessions INTEGER NOT NULL DEFAULT 0,
+  total_hours REAL NOT NULL DEFAULT 0,
+  first_check_in DATETIME,
+  last_check_out DATETIME,
+  FOREIGN KEY (user_id) REFERENCES users(id),
+  UNIQUE (user_id, day)
+);
+CREATE INDEX IF NOT EXISTS idx_daily_attendance_day ON daily_attendance(day);
@@ -0,0 +1,19 @@
+-- Migration number: 0003 	 2026-10-18
+-- Store check-in coordinates as typed columns with a grid cell index.
+-- location_data is kept (and still written) for older clients.
+ALTER TABLE attendance ADD COLUMN latitude REAL;
+ALTER TABLE attendance ADD COLUMN longitude REAL;
+ALTER TABLE attendance ADD COLUMN grid_cell INTEGER;
+
+-- Backfill from the JSON blob
+UPDATE attendance SET
+  latitude = CAST(json_extract(location_data, '$.latitude') AS REAL),
+  longitude = CAST(json_extract(location_data, '$.longitude') AS REAL)
+WHERE json_valid(location_data);
+
+-- Grid cells are 0.01 degrees, numbered row * 36000 + column (see models.grid_cell)
+UPDATE attendance SET
+  grid_cell = CAST((latitude + 90) / 0.01 AS INTEGER) * 36000 + CAST((longitude + 180) / 0.01 AS INTEGER)
+WHERE latitude IS NOT NULL AND longitude IS NOT NULL;
+
+CREATE INDEX idx_attendance_grid_cell ON attendance(grid_cell);
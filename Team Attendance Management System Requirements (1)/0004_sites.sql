@@ -0,0 +1,14 @@
+-- Migration number: 0004 	 2026-10-18
+-- Work sites and the site each check-in was matched to
+CREATE TABLE IF NOT EXISTS sites (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name TEXT UNIQUE NOT NULL,
+  latitude REAL,
+  longitude REAL,
+  radius_m REAL,
+  polygon TEXT, -- JSON list of [lat, long] vertices
+  created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE attendance ADD COLUMN site_id INTEGER REFERENCES sites(id);
+ALTER TABLE attendance ADD COLUMN off_site BOOLEAN;
@@ -0,0 +1,5 @@
+-- Migration number: 0005 	 2026-10-18
+-- At most one open session per user. The partial index also serves the
+-- "current open session" lookup without scanning the user's history.
+-- Close any duplicate open sessions before applying this.
+CREATE UNIQUE INDEX uq_attendance_open_session ON attendance(user_id) WHERE check_out_time IS NULL;
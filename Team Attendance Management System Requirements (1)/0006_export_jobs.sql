@@ -0,0 +1,15 @@
+-- Migration number: 0006 	 2026-10-18
+-- Background CSV/PDF exports; id is a hash of the report parameters
+CREATE TABLE IF NOT EXISTS export_jobs (
+  id TEXT PRIMARY KEY,
+  kind TEXT NOT NULL,
+  params TEXT NOT NULL, -- JSON string with the report parameters
+  status TEXT NOT NULL DEFAULT 'pending',
+  path TEXT,
+  size INTEGER,
+  error TEXT,
+  created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  started_at DATETIME,
+  finished_at DATETIME,
+  last_accessed DATETIME
+);
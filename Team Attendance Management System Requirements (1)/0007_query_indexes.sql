@@ -0,0 +1,12 @@
+-- Migration number: 0007 	 2026-10-18
+-- Indexes matching the hot attendance queries. SQLite appends the rowid
+-- (id) to every index, so these also serve the (check_in_time, id) keyset
+-- order used for pagination.
+
+-- A user's history, newest first, and per-user report ranges. Supersedes
+-- the single-column user_id index, which is a prefix of it.
+CREATE INDEX IF NOT EXISTS idx_attendance_user_check_in ON attendance(user_id, check_in_time);
+DROP INDEX IF EXISTS idx_attendance_user_id;
+
+-- Export cache eviction walks finished jobs by last access
+CREATE INDEX IF NOT EXISTS idx_export_jobs_status_accessed ON export_jobs(status, last_accessed);
@@ -0,0 +1,5 @@
+-- Migration number: 0008 	 2026-10-18
+-- Per-user version of the attendance data, bumped on every change to it.
+-- The Flask app derives ETag/Last-Modified headers from these.
+ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN data_modified_at DATETIME;
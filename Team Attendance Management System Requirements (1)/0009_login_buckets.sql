@@ -0,0 +1,8 @@
+-- Migration number: 0009 	 2026-10-18
+-- Login attempt token buckets, keyed by username or client address,
+-- used when the Flask app runs with LOGIN_THROTTLE_STORE = 'database'
+CREATE TABLE IF NOT EXISTS login_buckets (
+  key TEXT PRIMARY KEY,
+  tokens REAL NOT NULL,
+  updated_at REAL NOT NULL -- Unix time of the last refill
+);
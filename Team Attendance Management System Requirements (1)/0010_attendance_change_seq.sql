@@ -0,0 +1,6 @@
+-- Migration number: 0010 	 2026-10-18
+-- Change sequence for delta sync: each attendance row carries its user's
+-- data_version as of the row's last insert or update. Existing rows keep
+-- 0 and are picked up by a client's first, full sync.
+ALTER TABLE attendance ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS idx_attendance_user_change ON attendance(user_id, change_seq);
@@ -0,0 +1,14 @@
+-- Migration number: 0011 	 2026-10-18
+-- Responses of check-in/check-out requests sent with an Idempotency-Key,
+-- replayed when a client retries; the Flask app expires them after
+-- IDEMPOTENCY_KEY_TTL seconds
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  user_id INTEGER NOT NULL REFERENCES users(id),
+  key TEXT NOT NULL,
+  fingerprint TEXT NOT NULL, -- sha256 of method, path and body
+  status INTEGER NOT NULL,
+  body TEXT NOT NULL,
+  created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (user_id, key)
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at);
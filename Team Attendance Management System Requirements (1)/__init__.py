@@ -1,15 +1,28 @@
+import os
 from flask import Flask
 from flask_login import LoginManager
-from app.models.models import db, User
+from app.models.models import db
+from app.utils.user_cache import load_cached_user
+from app.utils.metrics import init_metrics
+from app.utils.database import DEFAULT_DATABASE_URI, engine_options, configure_engine
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'your-secret-key'  # Change this in production
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///attendance.db'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', DEFAULT_DATABASE_URI)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['EVENT_BROKER'] = os.environ.get('EVENT_BROKER', 'local')
+    app.config['EVENT_RELAY_AUTHKEY'] = os.environ.get('EVENT_RELAY_AUTHKEY')
     
-    # Initialize extensions
+    # Overrides, e.g. a separate database for tests and benchmarks
+    if config:
+        app.config.update(config)
+    
+    # Initialize extensions; pool and pragma settings follow the database type
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
     db.init_app(app)
+    with app.app_context():
+        configure_engine(app, db.engine)
     
     # Setup login manager
     login_manager = LoginManager()
@@ -18,11 +31,10 @@ def create_app():
     
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return load_cached_user(int(user_id))
     
-    # Create database tables
-    with app.app_context():
-        db.create_all()
+    # Request latency, SQL use and /metrics
+    init_metrics(app)
     
     # Register blueprints
     from app.controllers.auth import auth as auth_blueprint
@@ -40,4 +52,23 @@ def create_app():
     from app.controllers.reports import reports as reports_blueprint
     app.register_blueprint(reports_blueprint)
     
+    # CLI commands; the schema is managed by `flask migrate`, not on boot
+    from app.utils.schema import migrate_command
+    app.cli.add_command(migrate_command)
+    
+    from app.utils.rollups import rebuild_rollups_command
+    app.cli.add_command(rebuild_rollups_command)
+    
+    from app.utils.archive import archive_attendance_command
+    app.cli.add_command(archive_attendance_command)
+    
+    from app.utils.geofence import evaluate_geofences_command
+    app.cli.add_command(evaluate_geofences_command)
+    
+    from app.utils.provisioning import import_users_command
+    app.cli.add_command(import_users_command)
+    
+    from app.utils.status_events import event_relay_command
+    app.cli.add_command(event_relay_command)
+    
     return app
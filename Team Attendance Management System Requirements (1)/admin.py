@@ -1,6 +1,11 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, send_file
+from flask import Blueprint, render_template, redirect, url_for, request, flash, send_file, current_app
 from flask_login import login_required, current_user
 from app.models.models import User, Attendance, db
+from app.utils.queries import attendance_with_users, iter_keyset, report_date_range
+from app.utils.exports import iter_csv, stream_download
+from app.utils.rollups import summarize
+from app.utils.archive import with_archived
+from app.utils.user_cache import invalidate_user
 from datetime import datetime, timedelta
 import csv
 import os
@@ -22,7 +27,7 @@ def index():
     users = User.query.all()
     
     # Get recent attendance records
-    recent_records = Attendance.query.order_by(Attendance.check_in_time.desc()).limit(10).all()
+    recent_records = attendance_with_users().limit(10).all()
     
     return render_template('admin/index.html', users=users, recent_records=recent_records)
 
@@ -58,6 +63,7 @@ def toggle_admin(user_id):
     # Toggle admin status
     user.is_admin = not user.is_admin
     db.session.commit()
+    invalidate_user(user.id)
     
     flash(f'Admin status for {user.username} has been {"granted" if user.is_admin else "revoked"}.')
     return redirect(url_for('admin.users'))
@@ -73,49 +79,35 @@ def reports():
     # Get all users for filter dropdown
     users = User.query.all()
     
-    # Get date range from query parameters
-    start_date_str = request.args.get('start_date')
-    end_date_str = request.args.get('end_date')
+    # Get date range from query parameters, defaulting to the last 7 days
+    start_date, end_date = report_date_range(request.args, 7)
     user_id = request.args.get('user_id')
     
-    # Default to last 7 days if no dates provided
-    today = datetime.utcnow().date()
-    if not start_date_str:
-        start_date = today - timedelta(days=7)
-    else:
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-    
-    if not end_date_str:
-        end_date = today
-    else:
-        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
-    
     # Convert dates to datetime for query
     start_datetime = datetime.combine(start_date, datetime.min.time())
     end_datetime = datetime.combine(end_date, datetime.max.time())
     
-    # Build query
-    query = Attendance.query.filter(
-        Attendance.check_in_time >= start_datetime,
-        Attendance.check_in_time <= end_datetime
-    )
-    
-    # Filter by user if specified
-    if user_id and user_id != 'all':
-        query = query.filter(Attendance.user_id == int(user_id))
+    # Get records together with their users, including archived months
+    records = list(with_archived(
+        attendance_with_users(start_datetime, end_datetime, user_id).all(),
+        start_datetime, end_datetime, user_id
+    ))
     
-    # Get records
-    records = query.order_by(Attendance.check_in_time.desc()).all()
+    # Totals come from the daily rollups rather than the raw records
+    summary = summarize(start_date, end_date, user_id)
     
     return render_template(
         'admin/reports.html', 
         records=records, 
+        summary=summary,
         users=users,
         start_date=start_date.strftime('%Y-%m-%d'),
         end_date=end_date.strftime('%Y-%m-%d'),
         selected_user_id=user_id
     )
 
+# Streamed CSV download, kept for the report page's export button and
+# existing links; /admin/exports renders the same file in the background
 @admin.route('/admin/export-csv')
 @login_required
 def export_csv():
@@ -124,74 +116,21 @@ def export_csv():
         flash('Access denied. Admin privileges required.')
         return redirect(url_for('attendance.index'))
     
-    # Get date range from query parameters
-    start_date_str = request.args.get('start_date')
-    end_date_str = request.args.get('end_date')
+    # Get date range from query parameters, defaulting to the last 30 days
+    start_date, end_date = report_date_range(request.args, 30)
     user_id = request.args.get('user_id')
     
-    # Default to last 30 days if no dates provided
-    today = datetime.utcnow().date()
-    if not start_date_str:
-        start_date = today - timedelta(days=30)
-    else:
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-    
-    if not end_date_str:
-        end_date = today
-    else:
-        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
-    
     # Convert dates to datetime for query
     start_datetime = datetime.combine(start_date, datetime.min.time())
     end_datetime = datetime.combine(end_date, datetime.max.time())
     
-    # Build query
-    query = Attendance.query.filter(
-        Attendance.check_in_time >= start_datetime,
-        Attendance.check_in_time <= end_datetime
+    # Stream the records page by page instead of loading the whole range
+    query = attendance_with_users(start_datetime, end_datetime, user_id)
+    records = with_archived(
+        iter_keyset(query, current_app.config.get('EXPORT_PAGE_SIZE', 1000)),
+        start_datetime, end_datetime, user_id
     )
     
-    # Filter by user if specified
-    if user_id and user_id != 'all':
-        query = query.filter(Attendance.user_id == int(user_id))
-    
-    # Get records
-    records = query.order_by(Attendance.check_in_time.desc()).all()
-    
-    # Create CSV in memory
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # Write header
-    writer.writerow([
-        'ID', 'Username', 'Check-in Time', 'Check-out Time', 'Duration (hours)',
-        'Location (Lat, Long)', 'Address', 'Notes'
-    ])
-    
-    # Write data
-    for record in records:
-        user = User.query.get(record.user_id)
-        location = record.get_location()
-        location_str = f"{location['latitude']}, {location['longitude']}" if location else "N/A"
-        
-        writer.writerow([
-            record.id,
-            user.username,
-            record.check_in_time.strftime('%Y-%m-%d %H:%M:%S'),
-            record.check_out_time.strftime('%Y-%m-%d %H:%M:%S') if record.check_out_time else 'N/A',
-            record.duration() if record.duration() else 'N/A',
-            location_str,
-            record.location_address or 'N/A',
-            record.notes or ''
-        ])
-    
-    # Prepare response
-    output.seek(0)
     filename = f"attendance_report_{start_date.strftime('%Y%m%d')}_to_{end_date.strftime('%Y%m%d')}.csv"
     
-    return send_file(
-        io.BytesIO(output.getvalue().encode('utf-8')),
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name=filename
-    )
+    return stream_download(iter_csv(records), 'text/csv', filename, 'csv')
@@ -0,0 +1,195 @@
+import calendar
+import numpy as np
+from sqlalchemy import Integer, cast, extract, func, literal_column, select
+from app.models.models import Attendance, db
+from app.utils.archive import archived_intervals
+
+SECONDS_PER_DAY = 86400
+
+
+def _runs(keys):
+    """Group index of each element of a sorted array, and each group's first position"""
+    starts = np.empty(len(keys), dtype=bool)
+    starts[:1] = True
+    np.not_equal(keys[1:], keys[:-1], out=starts[1:])
+    return np.cumsum(starts) - 1, np.flatnonzero(starts)
+
+
+def _epoch_seconds(column, dialect):
+    """Seconds since the epoch, computed by the database where it can"""
+    if dialect == 'sqlite':
+        return cast(func.strftime('%s', column), Integer)
+    if dialect == 'postgresql':
+        return cast(extract('epoch', column), Integer)
+    if dialect == 'mysql':
+        # MySQL has no epoch unit, and UNIX_TIMESTAMP() would apply the session time zone
+        return func.timestampdiff(literal_column('SECOND'), '1970-01-01 00:00:00', column)
+    return column
+
+
+class Intervals:
+    """Closed attendance sessions as parallel NumPy arrays.
+
+    Sessions are sorted by user, then check-in. Times are integer
+    seconds since the epoch in local time, shifted by `utc_offset`
+    seconds so that day and hour boundaries fall where people expect.
+    """
+
+    def __init__(self, user_ids, starts, ends, utc_offset=0):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if len(starts):
+            # One argsort over a combined key is several times faster than lexsort
+            first_start = starts.min()
+            key = (user_ids - user_ids.min()) * (starts.max() - first_start + 1) + (starts - first_start)
+            if np.any(key[1:] < key[:-1]):
+                order = np.argsort(key)
+                user_ids, starts, ends = user_ids[order], starts[order], ends[order]
+        self.user_ids = user_ids
+        self.starts = starts + utc_offset
+        self.ends = ends + utc_offset
+        # Sorted input lets groups be found in one pass instead of np.unique's sort
+        self.user_index, first = _runs(self.user_ids)
+        self.users = self.user_ids[first]
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def load(cls, start_datetime, end_datetime, user_id=None, utc_offset=0):
+        """Fetch closed sessions that started in a range, three columns only"""
+        dialect = db.engine.dialect.name
+        query = select(
+            Attendance.user_id,
+            _epoch_seconds(Attendance.check_in_time, dialect),
+            _epoch_seconds(Attendance.check_out_time, dialect)
+        ).where(
+            Attendance.check_in_time >= start_datetime,
+            Attendance.check_in_time <= end_datetime,
+            Attendance.check_out_time.isnot(None)
+        )
+        if user_id and user_id != 'all':
+            query = query.where(Attendance.user_id == int(user_id))
+        # Served in index order, so the arrays need no sorting
+        query = query.order_by(Attendance.user_id, Attendance.check_in_time)
+
+        rows = db.session.execute(query).all()
+        if rows and not isinstance(rows[0][1], int):
+            # Databases without an epoch function hand back naive UTC datetimes;
+            # datetime.timestamp() would read them as server local time
+            rows = [
+                (user, calendar.timegm(start.utctimetuple()), calendar.timegm(end.utctimetuple()))
+                for user, start, end in rows
+            ]
+        columns = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        user_ids, starts, ends = columns[:, 0], columns[:, 1], columns[:, 2]
+
+        archived = archived_intervals(start_datetime, end_datetime, user_id)
+        if archived is not None:
+            user_ids, starts, ends = (np.concatenate(pair) for pair in zip((user_ids, starts, ends), archived))
+        return cls(user_ids, starts, ends, utc_offset)
+
+    def durations(self):
+        """Session lengths in hours"""
+        return (self.ends - self.starts) / 3600.0
+
+    def _user_days(self):
+        """Index of each session's (user, day) group, and each group's user index and day"""
+        days = self.starts // SECONDS_PER_DAY
+        # Check-ins are sorted within each user, so (user, day) keys are sorted too
+        group, first = _runs(self.user_index * (days.max() + 1) + days)
+        return group, self.user_index[first], days[first], first
+
+    def summary(self, workday_start_hour=9.0, workday_hours=8.0):
+        """Per-user statistics, keyed by user id.
+
+        A day counts as late when its first check-in comes after
+        `workday_start_hour`; overtime is the time worked beyond
+        `workday_hours` on each day. The trend is the least-squares
+        slope of daily hours, in hours per week.
+        """
+        if not len(self):
+            return {}
+
+        user_count = len(self.users)
+        hours = self.durations()
+        sessions = np.bincount(self.user_index, minlength=user_count)
+        total_hours = np.bincount(self.user_index, weights=hours, minlength=user_count)
+
+        group, group_user, group_day, first = self._user_days()
+        daily_hours = np.bincount(group, weights=hours)
+        days_worked = np.bincount(group_user, minlength=user_count)
+
+        # Sessions are sorted by check-in, so a group's first row is the day's first check-in
+        lateness = (self.starts[first] % SECONDS_PER_DAY) / 60.0 - workday_start_hour * 60
+        late = lateness > 0
+        late_days = np.bincount(group_user, weights=late, minlength=user_count)
+        late_minutes = np.bincount(group_user, weights=np.where(late, lateness, 0), minlength=user_count)
+
+        overtime = np.bincount(group_user, weights=np.maximum(daily_hours - workday_hours, 0), minlength=user_count)
+
+        # Per-user least squares of daily hours against the day number
+        x = (group_day - group_day.min()).astype(np.float64)
+        sum_x = np.bincount(group_user, weights=x, minlength=user_count)
+        sum_y = np.bincount(group_user, weights=daily_hours, minlength=user_count)
+        sum_xy = np.bincount(group_user, weights=x * daily_hours, minlength=user_count)
+        sum_xx = np.bincount(group_user, weights=x * x, minlength=user_count)
+        denominator = days_worked * sum_xx - sum_x ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.where(denominator > 0, (days_worked * sum_xy - sum_x * sum_y) / denominator, 0.0)
+            avg_late = np.where(late_days > 0, late_minutes / late_days, 0.0)
+
+        return {
+            int(user): {
+                'sessions': int(sessions[i]),
+                'days_worked': int(days_worked[i]),
+                'total_hours': round(float(total_hours[i]), 2),
+                'avg_session_hours': round(float(total_hours[i] / sessions[i]), 2),
+                'late_days': int(late_days[i]),
+                'avg_late_minutes': round(float(avg_late[i]), 1),
+                'overtime_hours': round(float(overtime[i]), 2),
+                'trend_hours_per_week': round(float(slope[i] * 7), 3),
+            }
+            for i, user in enumerate(self.users)
+        }
+
+    def occupancy(self):
+        """Average headcount for each weekday (Monday first) and hour, as a 7x24 array"""
+        # Zero-length sessions add nothing and would end before their first hour
+        present = self.ends > self.starts
+        starts, ends = self.starts[present], self.ends[present]
+        heatmap = np.zeros(7 * 24)
+        if not len(starts):
+            return heatmap.reshape(7, 24)
+
+        first_hour = starts // 3600
+        last_hour = (ends - 1) // 3600
+        base = first_hour.min()
+        span = last_hour.max() - base + 1
+
+        # Person-seconds per absolute hour: partial first and last hours are
+        # added directly, whole hours in between through a difference array
+        single = first_hour == last_hour
+        multi = ~single
+        seconds = (
+            np.bincount(first_hour[single] - base, weights=(ends - starts)[single], minlength=span)
+            + np.bincount(first_hour[multi] - base,
+                          weights=(first_hour[multi] + 1) * 3600 - starts[multi], minlength=span)
+            + np.bincount(last_hour[multi] - base,
+                          weights=ends[multi] - last_hour[multi] * 3600, minlength=span)
+        )
+        whole = (
+            np.bincount(first_hour[multi] + 1 - base, minlength=span + 1)
+            - np.bincount(last_hour[multi] - base, minlength=span + 1)
+        )
+        seconds += np.cumsum(whole)[:span] * 3600
+
+        # The epoch fell on a Thursday
+        hours = base + np.arange(span)
+        slot = ((hours // 24 + 3) % 7) * 24 + hours % 24
+        heatmap = np.bincount(slot, weights=seconds, minlength=7 * 24) / 3600.0
+        occurrences = np.bincount(slot, minlength=7 * 24)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            heatmap = np.where(occurrences > 0, heatmap / occurrences, 0.0)
+        return heatmap.reshape(7, 24)
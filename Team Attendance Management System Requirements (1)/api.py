@@ -1,12 +1,92 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify
+from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify, current_app
 from flask_login import login_required, current_user
-from app.models.models import User, Attendance, db
+from app.models.models import User, Attendance, Site, db
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
 import json
 from werkzeug.security import generate_password_hash
+from app.utils.geocoding import get_geocoder
+from app.utils.rollups import record_session
+from app.utils.data_versions import bump_data_version, conditional_on_user_data
+from app.utils.status_events import status_changed
+from app.utils.geofence import GeofenceIndex, changed_tags, tag_site, invalidate_geofence_index
+from app.utils.queries import attendance_with_users, attendance_near, changes_since, keyset_page, report_date_range
+from app.utils.ingest import ingest_events, BatchConflict
+from app.utils.provisioning import import_users, read_users_csv, ImportConflict
+from app.utils.user_cache import invalidate_user
+from app.utils.idempotency import idempotent, remember_response
 
 api = Blueprint('api', __name__)
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+MAX_BATCH_EVENTS = 5000
+MAX_IMPORT_USERS = 5000
+
+# Fields available on attendance records, computed only when requested
+ATTENDANCE_FIELDS = {
+    'id': lambda record: record.id,
+    'check_in_time': lambda record: record.check_in_time.isoformat(),
+    'check_out_time': lambda record: record.check_out_time.isoformat() if record.check_out_time else None,
+    'duration': lambda record: record.duration(),
+    'location': lambda record: record.get_location(),
+    'location_address': lambda record: record.location_address,
+    'site_id': lambda record: record.site_id,
+    'off_site': lambda record: record.off_site,
+    'notes': lambda record: record.notes
+}
+
+ADMIN_ATTENDANCE_FIELDS = dict(
+    ATTENDANCE_FIELDS,
+    user_id=lambda record: record.user_id,
+    username=lambda record: record.user.username
+)
+
+def page_args(available_fields):
+    """Read cursor, limit and fields query parameters.
+
+    Raises ValueError with a client-facing message on bad input.
+    """
+    cursor = request.args.get('cursor')
+    
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('Invalid limit')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError(f'Limit must be between 1 and {MAX_PAGE_SIZE}')
+    
+    fields = list(available_fields)
+    if request.args.get('fields'):
+        fields = request.args.get('fields').split(',')
+        unknown = [field for field in fields if field not in available_fields]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    
+    return cursor, limit, fields
+
+def admin_datetime_range(start_date, end_date):
+    """Parse optional YYYY-MM-DD bounds into an inclusive datetime range.
+
+    Raises ValueError with a client-facing message on bad input.
+    """
+    try:
+        start_datetime = None
+        if start_date:
+            start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
+        
+        end_datetime = None
+        if end_date:
+            end_datetime = datetime.strptime(end_date, '%Y-%m-%d')
+            end_datetime = datetime.combine(end_datetime.date(), datetime.max.time())
+    except ValueError:
+        raise ValueError('Dates must be YYYY-MM-DD')
+    
+    return start_datetime, end_datetime
+
+def serialize(record, fields, available_fields):
+    return {field: available_fields[field](record) for field in fields}
+
 # API endpoint for user authentication
 @api.route('/api/login', methods=['POST'])
 def login():
@@ -34,6 +114,7 @@ def user_status():
 # API endpoint to record attendance check-in
 @api.route('/api/attendance/check-in', methods=['POST'])
 @login_required
+@idempotent
 def check_in():
     data = request.get_json()
     
@@ -49,27 +130,51 @@ def check_in():
     if open_attendance:
         return jsonify({'success': False, 'message': 'Already checked in'}), 400
     
+    geocoder = get_geocoder()
+    
     # Create new attendance record
     new_attendance = Attendance(
         user_id=current_user.id,
         check_in_time=datetime.utcnow(),
-        notes=data.get('notes', '')
+        notes=data.get('notes', ''),
+        location_address=geocoder.cached(data.get('latitude'), data.get('longitude'))
     )
-    new_attendance.set_location(data.get('latitude'), data.get('longitude'))
+    try:
+        new_attendance.set_location(data.get('latitude'), data.get('longitude'))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid location data'}), 400
+    tag_site(new_attendance)
     
     db.session.add(new_attendance)
-    db.session.commit()
+    try:
+        db.session.flush()
+        bump_data_version([current_user.id], [new_attendance.id])
+        response = jsonify({
+            'success': True, 
+            'message': 'Check-in successful',
+            'attendance_id': new_attendance.id,
+            'check_in_time': new_attendance.check_in_time.isoformat(),
+            'site_id': new_attendance.site_id,
+            'off_site': new_attendance.off_site
+        })
+        remember_response(response)
+        db.session.commit()
+    except IntegrityError:
+        # Another device checked in first, or a retry of this request did;
+        # at most one session can be open and each key is stored once
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Already checked in'}), 400
+    status_changed(current_user.id)
     
-    return jsonify({
-        'success': True, 
-        'message': 'Check-in successful',
-        'attendance_id': new_attendance.id,
-        'check_in_time': new_attendance.check_in_time.isoformat()
-    })
+    if not new_attendance.location_address:
+        geocoder.enqueue(new_attendance.id, data.get('latitude'), data.get('longitude'))
+    
+    return response
 
 # API endpoint to record attendance check-out
 @api.route('/api/attendance/check-out', methods=['POST'])
 @login_required
+@idempotent
 def check_out():
     # Find the user's open attendance record
     open_attendance = Attendance.query.filter_by(
@@ -80,11 +185,19 @@ def check_out():
     if not open_attendance:
         return jsonify({'success': False, 'message': 'No active check-in found'}), 400
     
-    # Update the check-out time
-    open_attendance.check_out_time = datetime.utcnow()
-    db.session.commit()
+    # Close the session only if no other request closed it in the meantime
+    closed = Attendance.query.filter_by(
+        id=open_attendance.id,
+        check_out_time=None
+    ).update({'check_out_time': datetime.utcnow()})
     
-    return jsonify({
+    if not closed:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'No active check-in found'}), 400
+    
+    record_session(open_attendance)
+    bump_data_version([current_user.id], [open_attendance.id])
+    response = jsonify({
         'success': True, 
         'message': 'Check-out successful',
         'attendance_id': open_attendance.id,
@@ -92,28 +205,101 @@ def check_out():
         'check_out_time': open_attendance.check_out_time.isoformat(),
         'duration': open_attendance.duration()
     })
+    remember_response(response)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A retry of this request stored its response first
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'No active check-in found'}), 400
+    status_changed(current_user.id)
+    
+    return response
+
+# API endpoint for kiosks and badge readers to upload buffered events in bulk
+@api.route('/api/attendance/batch', methods=['POST'])
+@login_required
+def attendance_batch():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Admin privileges required'}), 403
+    
+    data = request.get_json()
+    
+    if not data or not isinstance(data.get('events'), list):
+        return jsonify({'success': False, 'message': 'Missing events'}), 400
+    
+    if len(data.get('events')) > MAX_BATCH_EVENTS:
+        return jsonify({'success': False, 'message': f'At most {MAX_BATCH_EVENTS} events per batch'}), 400
+    
+    try:
+        results = ingest_events(data.get('events'))
+    except BatchConflict as e:
+        return jsonify({'success': False, 'message': str(e)}), 409
+    
+    accepted = sum(1 for result in results if result['success'])
+    return jsonify({
+        'success': True,
+        'accepted': accepted,
+        'rejected': len(results) - accepted,
+        'results': results
+    })
 
 # API endpoint to get attendance history
 @api.route('/api/attendance/history', methods=['GET'])
 @login_required
+@conditional_on_user_data
 def attendance_history():
-    # Get user's attendance records
-    records = Attendance.query.filter_by(user_id=current_user.id).order_by(Attendance.check_in_time.desc()).all()
-    
-    history = []
-    for record in records:
-        location = record.get_location()
-        history.append({
-            'id': record.id,
-            'check_in_time': record.check_in_time.isoformat(),
-            'check_out_time': record.check_out_time.isoformat() if record.check_out_time else None,
-            'duration': record.duration(),
-            'location': location,
-            'location_address': record.location_address,
-            'notes': record.notes
-        })
+    try:
+        cursor, limit, fields = page_args(ATTENDANCE_FIELDS)
+        records, next_cursor = keyset_page(
+            Attendance.query.filter_by(user_id=current_user.id),
+            cursor,
+            limit
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    history = [serialize(record, fields, ATTENDANCE_FIELDS) for record in records]
+    
+    return jsonify({'success': True, 'history': history, 'next_cursor': next_cursor})
+
+# API endpoint for offline-capable clients to fetch only what changed since their last sync
+@api.route('/api/attendance/sync', methods=['GET'])
+@login_required
+@conditional_on_user_data
+def attendance_sync():
+    try:
+        cursor, limit, fields = page_args(ATTENDANCE_FIELDS)
+        # Without since the client has nothing yet and gets every record
+        since = request.args.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                raise ValueError('Invalid since')
+            if since < 0:
+                raise ValueError('Invalid since')
+        # Read before the records: every change up to this version is committed
+        version = db.session.query(User.data_version).filter_by(id=current_user.id).scalar()
+        records, next_cursor, watermark = changes_since(
+            Attendance.query.filter_by(user_id=current_user.id),
+            since,
+            cursor,
+            limit
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    if next_cursor is None:
+        watermark = max(watermark, version)
+    changes = [serialize(record, fields, ATTENDANCE_FIELDS) for record in records]
     
-    return jsonify({'success': True, 'history': history})
+    return jsonify({
+        'success': True,
+        'changes': changes,
+        'watermark': watermark,
+        'next_cursor': next_cursor
+    })
 
 # API endpoint for admin to get all attendance records
 @api.route('/api/admin/attendance', methods=['GET'])
@@ -127,43 +313,117 @@ def admin_attendance():
     end_date = request.args.get('end_date')
     user_id = request.args.get('user_id')
     
-    # Build query
-    query = Attendance.query
+    # Get one page of records together with their users
+    try:
+        start_datetime, end_datetime = admin_datetime_range(start_date, end_date)
+        cursor, limit, fields = page_args(ADMIN_ATTENDANCE_FIELDS)
+        records, next_cursor = keyset_page(
+            attendance_with_users(start_datetime, end_datetime, user_id),
+            cursor,
+            limit
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    attendance_data = [serialize(record, fields, ADMIN_ATTENDANCE_FIELDS) for record in records]
+    
+    return jsonify({'success': True, 'attendance': attendance_data, 'next_cursor': next_cursor})
+
+# API endpoint for admin to find check-ins near a location
+@api.route('/api/admin/attendance/nearby', methods=['GET'])
+@login_required
+def admin_attendance_nearby():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Admin privileges required'}), 403
     
-    if start_date:
-        start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
-        query = query.filter(Attendance.check_in_time >= start_datetime)
+    try:
+        latitude = float(request.args['latitude'])
+        longitude = float(request.args['longitude'])
+        radius = float(request.args.get('radius', 100))
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'message': 'latitude, longitude and radius must be numbers'}), 400
+    
+    try:
+        start_datetime, end_datetime = admin_datetime_range(
+            request.args.get('start_date'),
+            request.args.get('end_date')
+        )
+        cursor, limit, fields = page_args(ADMIN_ATTENDANCE_FIELDS)
+        matches, next_cursor = attendance_near(
+            attendance_with_users(start_datetime, end_datetime, request.args.get('user_id')),
+            latitude,
+            longitude,
+            radius,
+            cursor,
+            limit
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     
-    if end_date:
-        end_datetime = datetime.strptime(end_date, '%Y-%m-%d')
-        end_datetime = datetime.combine(end_datetime.date(), datetime.max.time())
-        query = query.filter(Attendance.check_in_time <= end_datetime)
+    attendance_data = []
+    for record, distance in matches:
+        row = serialize(record, fields, ADMIN_ATTENDANCE_FIELDS)
+        row['distance_m'] = round(distance, 1)
+        attendance_data.append(row)
     
-    if user_id and user_id != 'all':
-        query = query.filter(Attendance.user_id == int(user_id))
+    return jsonify({'success': True, 'attendance': attendance_data, 'next_cursor': next_cursor})
+
+def load_intervals():
+    """Closed sessions for the requested range and user, as NumPy arrays"""
+    # NumPy is only imported by workers that serve analytics
+    from app.utils.analytics import Intervals
+    
+    start_date, end_date = report_date_range(request.args, 30)
+    return Intervals.load(
+        datetime.combine(start_date, datetime.min.time()),
+        datetime.combine(end_date, datetime.max.time()),
+        request.args.get('user_id'),
+        utc_offset=current_app.config.get('ANALYTICS_UTC_OFFSET_MINUTES', 0) * 60
+    )
+
+# API endpoint for admin to get per-user lateness, overtime and trends
+@api.route('/api/admin/analytics/summary', methods=['GET'])
+@login_required
+def admin_analytics_summary():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Admin privileges required'}), 403
     
-    # Get records
-    records = query.order_by(Attendance.check_in_time.desc()).all()
+    try:
+        intervals = load_intervals()
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must be YYYY-MM-DD'}), 400
     
-    # Format response
-    attendance_data = []
-    for record in records:
-        user = User.query.get(record.user_id)
-        location = record.get_location()
-        
-        attendance_data.append({
-            'id': record.id,
-            'user_id': record.user_id,
-            'username': user.username,
-            'check_in_time': record.check_in_time.isoformat(),
-            'check_out_time': record.check_out_time.isoformat() if record.check_out_time else None,
-            'duration': record.duration(),
-            'location': location,
-            'location_address': record.location_address,
-            'notes': record.notes
-        })
+    summary = intervals.summary(
+        workday_start_hour=current_app.config.get('WORKDAY_START_HOUR', 9),
+        workday_hours=current_app.config.get('WORKDAY_HOURS', 8)
+    )
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(summary)))
+    
+    users = []
+    for user_id, stats in summary.items():
+        users.append(dict(stats, user_id=user_id, username=usernames.get(user_id)))
     
-    return jsonify({'success': True, 'attendance': attendance_data})
+    return jsonify({'success': True, 'users': users})
+
+# API endpoint for admin to get average headcount by weekday and hour
+@api.route('/api/admin/analytics/occupancy', methods=['GET'])
+@login_required
+def admin_analytics_occupancy():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Admin privileges required'}), 403
+    
+    try:
+        intervals = load_intervals()
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must be YYYY-MM-DD'}), 400
+    
+    heatmap = intervals.occupancy().round(2).tolist()
+    
+    return jsonify({
+        'success': True,
+        'weekdays': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+        'occupancy': heatmap
+    })
 
 # API endpoint for admin to get all users
 @api.route('/api/admin/users', methods=['GET'])
@@ -218,6 +478,7 @@ def admin_create_user():
     
     db.session.add(new_user)
     db.session.commit()
+    invalidate_user(new_user.id)
     
     return jsonify({
         'success': True, 
@@ -229,3 +490,114 @@ def admin_create_user():
             'is_admin': new_user.is_admin
         }
     })
+
+# API endpoint for admin to create many users from JSON or CSV
+@api.route('/api/admin/users/import', methods=['POST'])
+@login_required
+def admin_import_users():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Admin privileges required'}), 403
+    
+    if request.mimetype == 'text/csv':
+        rows = read_users_csv(request.get_data(as_text=True))
+    else:
+        data = request.get_json(silent=True)
+        rows = data.get('users') if isinstance(data, dict) else None
+    
+    if not isinstance(rows, list):
+        return jsonify({'success': False, 'message': 'Missing users'}), 400
+    
+    if len(rows) > MAX_IMPORT_USERS:
+        return jsonify({'success': False, 'message': f'At most {MAX_IMPORT_USERS} users per import'}), 400
+    
+    try:
+        results = import_users(rows)
+    except ImportConflict as e:
+        return jsonify({'success': False, 'message': str(e)}), 409
+    
+    created = sum(1 for result in results if result['success'])
+    return jsonify({
+        'success': True,
+        'created': created,
+        'rejected': len(results) - created,
+        'results': results
+    })
+
+
+def serialize_site(site):
+    return {
+        'id': site.id,
+        'name': site.name,
+        'latitude': site.latitude,
+        'longitude': site.longitude,
+        'radius_m': site.radius_m,
+        'polygon': site.get_polygon()
+    }
+
+# API endpoint for admin to list sites
+@api.route('/api/admin/sites', methods=['GET'])
+@login_required
+def admin_sites():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Admin privileges required'}), 403
+    
+    sites = Site.query.order_by(Site.name).all()
+    return jsonify({'success': True, 'sites': [serialize_site(site) for site in sites]})
+
+# API endpoint for admin to create a site from a polygon or a centre and radius
+@api.route('/api/admin/sites/create', methods=['POST'])
+@login_required
+def admin_create_site():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Admin privileges required'}), 403
+    
+    data = request.get_json()
+    
+    if not data or not data.get('name'):
+        return jsonify({'success': False, 'message': 'Missing site name'}), 400
+    
+    if Site.query.filter_by(name=data.get('name')).first():
+        return jsonify({'success': False, 'message': 'Site already exists'}), 400
+    
+    site = Site(name=data.get('name'))
+    try:
+        if data.get('polygon'):
+            if len(data.get('polygon')) < 3:
+                raise ValueError
+            site.set_polygon(data.get('polygon'))
+        else:
+            site.latitude = float(data['latitude'])
+            site.longitude = float(data['longitude'])
+            site.radius_m = float(data['radius_m'])
+            if site.radius_m <= 0:
+                raise ValueError
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'A site needs a polygon of at least 3 points or a latitude, longitude and positive radius_m'}), 400
+    
+    db.session.add(site)
+    db.session.commit()
+    invalidate_geofence_index()
+    
+    return jsonify({'success': True, 'message': 'Site created successfully', 'site': serialize_site(site)})
+
+# API endpoint for admin to delete a site
+@api.route('/api/admin/sites/<int:site_id>/delete', methods=['POST'])
+@login_required
+def admin_delete_site(site_id):
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Admin privileges required'}), 403
+    
+    site = Site.query.get_or_404(site_id)
+    # Check-ins in the site are re-tagged against the sites that remain
+    index = GeofenceIndex(Site.query.filter(Site.id != site.id).all())
+    changes, user_ids = changed_tags(Attendance.query.filter_by(site_id=site.id), index)
+    if changes:
+        db.session.bulk_update_mappings(Attendance, changes)
+        bump_data_version(user_ids, [mapping['id'] for mapping in changes])
+    db.session.delete(site)
+    db.session.commit()
+    invalidate_geofence_index()
+    for user_id in user_ids:
+        invalidate_user(user_id)
+    
+    return jsonify({'success': True, 'message': 'Site deleted successfully'})
@@ -0,0 +1,329 @@
+import heapq
+import itertools
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.attributes import set_committed_value
+from app.models.models import Attendance, User, db, grid_cell
+from app.utils.data_versions import bump_data_version
+
+PARTITION_FILE = re.compile(r'^attendance-(\d{4})-(\d{2})\.npz$')
+COLUMNS = (
+    'id', 'user_id', 'check_in_time', 'check_out_time', 'latitude', 'longitude',
+    'site_id', 'off_site', 'location_address', 'notes'
+)
+# Stored as byte offsets plus one UTF-8 buffer each
+TEXT_COLUMNS = ('location_address', 'notes')
+DELETE_CHUNK = 1000
+
+
+def archive_dir(app=None):
+    app = app or current_app._get_current_object()
+    return app.config.get('ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+
+
+def _month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def _next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partitions(start_datetime=None, end_datetime=None):
+    """(month, path) of archived months overlapping a range, newest first.
+
+    Partitions are pruned by file name alone, so a range that does not
+    reach back into the archive opens no files.
+    """
+    directory = archive_dir()
+    if not os.path.isdir(directory):
+        return []
+
+    found = []
+    for name in os.listdir(directory):
+        match = PARTITION_FILE.match(name)
+        if not match:
+            continue
+        month = datetime(int(match.group(1)), int(match.group(2)), 1)
+        if start_datetime and _next_month(month) <= start_datetime:
+            continue
+        if end_datetime and month > end_datetime:
+            continue
+        found.append((month, os.path.join(directory, name)))
+    return sorted(found, reverse=True)
+
+
+def _to_columns(records):
+    import numpy as np
+
+    locations = [record.get_location() for record in records]
+    return {
+        'id': np.array([record.id for record in records], dtype=np.int64),
+        'user_id': np.array([record.user_id for record in records], dtype=np.int64),
+        'check_in_time': np.array([record.check_in_time for record in records], dtype='datetime64[us]'),
+        'check_out_time': np.array([record.check_out_time for record in records], dtype='datetime64[us]'),
+        'latitude': np.array([location['latitude'] if location else np.nan for location in locations], dtype=np.float64),
+        'longitude': np.array([location['longitude'] if location else np.nan for location in locations], dtype=np.float64),
+        # -1 stands for NULL in the integer columns
+        'site_id': np.array([-1 if record.site_id is None else record.site_id for record in records], dtype=np.int64),
+        'off_site': np.array([-1 if record.off_site is None else int(record.off_site) for record in records], dtype=np.int8),
+        'location_address': np.array([record.location_address or '' for record in records], dtype=object),
+        'notes': np.array([record.notes or '' for record in records], dtype=object),
+    }
+
+
+def _encode_text(column):
+    """Byte offsets and UTF-8 buffer of a text column.
+
+    A fixed-width unicode array would pad every row to the longest
+    value, and object arrays can only be saved pickled.
+    """
+    import numpy as np
+
+    encoded = [value.encode('utf-8') for value in column]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded], dtype=np.int64)
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def _decode_text(offsets, buffer, rows):
+    import numpy as np
+
+    buffer = buffer.tobytes()
+    return np.array([buffer[offsets[i]:offsets[i + 1]].decode('utf-8') for i in rows.tolist()], dtype=object)
+
+
+def _read_partition(path, keep=None, names=COLUMNS):
+    """Columns of a partition file, restricted to the rows `keep(data)` selects.
+
+    Members of the file are read one at a time, and text is decoded for
+    the selected rows only.
+    """
+    import numpy as np
+
+    with np.load(path) as data:
+        count = len(data['id'])
+        rows = np.arange(count) if keep is None else np.flatnonzero(keep(data))
+        columns = {}
+        for name in names:
+            if name in TEXT_COLUMNS:
+                columns[name] = _decode_text(data[f'{name}_offsets'], data[f'{name}_bytes'], rows)
+            else:
+                columns[name] = data[name][rows]
+        return columns
+
+
+def _write_partition(path, *parts):
+    """Write the concatenated column sets sorted by check-in, replacing `path` atomically"""
+    import numpy as np
+
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+    # Re-archiving a month after an interrupted run must not duplicate rows
+    _, unique = np.unique(columns['id'][::-1], return_index=True)
+    keep = len(columns['id']) - 1 - unique
+    order = keep[np.lexsort((columns['id'][keep], columns['check_in_time'][keep]))]
+
+    arrays = {}
+    for name, column in columns.items():
+        if name in TEXT_COLUMNS:
+            arrays[f'{name}_offsets'], arrays[f'{name}_bytes'] = _encode_text(column[order])
+        else:
+            arrays[name] = column[order]
+
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            np.savez_compressed(output, **arrays)
+        os.replace(partial, path)
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+
+def archive_sessions(before=None):
+    """Move closed sessions into compressed monthly partition files.
+
+    Sessions checked in before the start of the month containing
+    `before` (default: ARCHIVE_AFTER_DAYS, 365, days ago) are archived,
+    so partitions always hold whole months; open sessions stay in the
+    table. Each month is written to its file, merged with any earlier
+    partition for it, before its rows are deleted, so a run that dies
+    in between leaves rows in both places until the next run merges
+    them again. Daily rollups are kept. Returns the number of sessions
+    archived.
+    """
+    if before is None:
+        before = datetime.utcnow() - timedelta(days=current_app.config.get('ARCHIVE_AFTER_DAYS', 365))
+    cutoff = _month_start(before)
+    directory = archive_dir()
+    os.makedirs(directory, exist_ok=True)
+
+    closed = Attendance.query.filter(
+        Attendance.check_out_time.isnot(None),
+        Attendance.check_in_time < cutoff
+    )
+    oldest = closed.order_by(Attendance.check_in_time).first()
+
+    count = 0
+    month = _month_start(oldest.check_in_time) if oldest else cutoff
+    while month < cutoff:
+        next_month = _next_month(month)
+        # Legacy rows only have their location in location_data
+        records = closed.filter(
+            Attendance.check_in_time >= month,
+            Attendance.check_in_time < next_month
+        ).options(undefer(Attendance.location_data)).all()
+
+        if records:
+            path = os.path.join(directory, f'attendance-{month.year:04d}-{month.month:02d}.npz')
+            parts = [_read_partition(path)] if os.path.exists(path) else []
+            _write_partition(path, *parts, _to_columns(records))
+
+            ids = [record.id for record in records]
+            for offset in range(0, len(ids), DELETE_CHUNK):
+                Attendance.query.filter(
+                    Attendance.id.in_(ids[offset:offset + DELETE_CHUNK])
+                ).delete(synchronize_session=False)
+            # The live-only listings change, so cached copies must not be reused
+            bump_data_version({record.user_id for record in records})
+            db.session.commit()
+            count += len(records)
+        month = next_month
+
+    return count
+
+
+def _range_filter(start_datetime, end_datetime, user_id):
+    """Row filter for _read_partition matching a range and an optional user"""
+    import numpy as np
+
+    def keep(data):
+        check_ins = data['check_in_time']
+        mask = np.ones(len(check_ins), dtype=bool)
+        if start_datetime:
+            mask &= check_ins >= np.datetime64(start_datetime, 'us')
+        if end_datetime:
+            mask &= check_ins <= np.datetime64(end_datetime, 'us')
+        if user_id and user_id != 'all':
+            mask &= data['user_id'] == int(user_id)
+        return mask
+    return keep
+
+
+def _partition_records(path, start_datetime, end_datetime, user_id, by_user, users):
+    """Archived sessions of one partition in a range, as transient Attendance records.
+
+    Only this partition's matching rows are held. `users` caches the
+    users loaded so far, shared across partitions.
+    """
+    import numpy as np
+
+    columns = _read_partition(path, _range_filter(start_datetime, end_datetime, user_id))
+    if not len(columns['id']):
+        return
+
+    user_ids = np.unique(columns['user_id'])
+    missing = [user_id for user_id in user_ids.tolist() if user_id not in users]
+    if missing:
+        users.update((user.id, user) for user in User.query.filter(User.id.in_(missing)))
+
+    ids = columns['id']
+    check_ins = columns['check_in_time'].astype(np.int64)
+    if by_user:
+        # Rank users by name, then sort by rank, newest first within each
+        names = [users[user_id].username if user_id in users else '' for user_id in user_ids.tolist()]
+        rank = np.argsort(np.argsort(names, kind='stable'))
+        order = np.lexsort((-ids, -check_ins, rank[np.searchsorted(user_ids, columns['user_id'])]))
+    else:
+        order = np.lexsort((ids, check_ins))[::-1]
+
+    for i in order.tolist():
+        user = users.get(int(columns['user_id'][i]))
+        if user is None:
+            continue
+        latitude = float(columns['latitude'][i])
+        has_location = not np.isnan(latitude)
+        record = Attendance(
+            id=int(ids[i]),
+            user_id=user.id,
+            check_in_time=columns['check_in_time'][i].item(),
+            check_out_time=columns['check_out_time'][i].item(),
+            latitude=latitude if has_location else None,
+            longitude=float(columns['longitude'][i]) if has_location else None,
+            grid_cell=grid_cell(latitude, float(columns['longitude'][i])) if has_location else None,
+            site_id=int(columns['site_id'][i]) if columns['site_id'][i] >= 0 else None,
+            off_site=bool(columns['off_site'][i]) if columns['off_site'][i] >= 0 else None,
+            location_address=columns['location_address'][i] or None,
+            notes=columns['notes'][i] or None
+        )
+        # Attach the user without touching user.attendance_records or the session
+        set_committed_value(record, 'user', user)
+        yield record
+
+
+def _newest_first_key(record):
+    return record.check_in_time, record.id
+
+
+def _by_user_key(record):
+    return record.user.username, datetime.max - record.check_in_time, -record.id
+
+
+def with_archived(records, start_datetime=None, end_datetime=None, user_id=None, by_user=False):
+    """Merge archived sessions in a range into live records.
+
+    `records` must be newest first, or by username and then newest first
+    with `by_user`, each with its user loaded; archived sessions come
+    back as transient Attendance records in the same order. Partitions
+    are read lazily: newest first, one month in memory at a time, or,
+    with `by_user`, the matching rows of each month merged together.
+    Returns `records` untouched when no partition overlaps the range.
+    """
+    found = partitions(start_datetime, end_datetime)
+    if not found:
+        return records
+
+    users = {}
+    archived = [
+        _partition_records(path, start_datetime, end_datetime, user_id, by_user, users)
+        for _, path in found
+    ]
+    if by_user:
+        return heapq.merge(records, *archived, key=_by_user_key)
+    # Partitions hold disjoint months, newest first, so they simply follow each other
+    return heapq.merge(records, itertools.chain(*archived), key=_newest_first_key, reverse=True)
+
+
+def archived_intervals(start_datetime, end_datetime, user_id=None):
+    """User ids, check-ins and check-outs (epoch seconds) of archived sessions in a range, or None"""
+    found = partitions(start_datetime, end_datetime)
+    if not found:
+        return None
+
+    import numpy as np
+    keep = _range_filter(start_datetime, end_datetime, user_id)
+    slices = [
+        _read_partition(path, keep, ('user_id', 'check_in_time', 'check_out_time'))
+        for _, path in found
+    ]
+    return (
+        np.concatenate([columns['user_id'] for columns in slices]),
+        np.concatenate([columns['check_in_time'] for columns in slices]).astype('datetime64[s]').astype(np.int64),
+        np.concatenate([columns['check_out_time'] for columns in slices]).astype('datetime64[s]').astype(np.int64)
+    )
+
+
+@click.command('archive-attendance')
+@click.option('--before', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Archive sessions before the start of this month (default: ARCHIVE_AFTER_DAYS ago)')
+@with_appcontext
+def archive_attendance_command(before):
+    """Move old closed sessions into monthly archive files."""
+    count = archive_sessions(before)
+    click.echo(f'Archived {count} sessions into {archive_dir()}')
@@ -1,9 +1,16 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify
+from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
 from app.models.models import Attendance, db
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 import json
-from geopy.geocoders import Nominatim
+from app.utils.geocoding import get_geocoder
+from app.utils.rollups import record_session
+from app.utils.open_sessions import open_session_status
+from app.utils.data_versions import bump_data_version, conditional_on_user_data
+from app.utils.status_events import status_changed, status_stream
+from app.utils.geofence import tag_site
+from app.utils.archive import with_archived
 
 attendance = Blueprint('attendance', __name__)
 
@@ -33,28 +40,37 @@ def check_in():
         flash('You already have an active check-in')
         return redirect(url_for('attendance.index'))
     
-    # Try to get address from coordinates
-    address = None
-    try:
-        geolocator = Nominatim(user_agent="attendance_system")
-        location = geolocator.reverse(f"{latitude}, {longitude}")
-        if location:
-            address = location.address
-    except Exception as e:
-        # Just log the error, but continue with check-in
-        print(f"Error getting address: {e}")
+    # Use a cached address if we have one, otherwise resolve it in the background
+    geocoder = get_geocoder()
     
     # Create new attendance record
     new_attendance = Attendance(
         user_id=current_user.id,
         check_in_time=datetime.utcnow(),
         notes=notes,
-        location_address=address
+        location_address=geocoder.cached(latitude, longitude)
     )
-    new_attendance.set_location(latitude, longitude)
+    try:
+        new_attendance.set_location(latitude, longitude)
+    except ValueError:
+        flash('Invalid location data')
+        return redirect(url_for('attendance.index'))
+    tag_site(new_attendance)
     
     db.session.add(new_attendance)
-    db.session.commit()
+    try:
+        db.session.flush()
+        bump_data_version([current_user.id], [new_attendance.id])
+        db.session.commit()
+    except IntegrityError:
+        # Another device checked in first; at most one session can be open
+        db.session.rollback()
+        flash('You already have an active check-in')
+        return redirect(url_for('attendance.index'))
+    status_changed(current_user.id)
+    
+    if not new_attendance.location_address:
+        geocoder.enqueue(new_attendance.id, latitude, longitude)
     
     flash('Check-in successful')
     return redirect(url_for('attendance.index'))
@@ -72,35 +88,50 @@ def check_out():
         flash('No active check-in found')
         return redirect(url_for('attendance.index'))
     
-    # Update the check-out time
-    open_attendance.check_out_time = datetime.utcnow()
+    # Close the session only if no other request closed it in the meantime
+    closed = Attendance.query.filter_by(
+        id=open_attendance.id,
+        check_out_time=None
+    ).update({'check_out_time': datetime.utcnow()})
+    
+    if not closed:
+        db.session.rollback()
+        flash('No active check-in found')
+        return redirect(url_for('attendance.index'))
+    
+    record_session(open_attendance)
+    bump_data_version([current_user.id], [open_attendance.id])
     db.session.commit()
+    status_changed(current_user.id)
     
     flash('Check-out successful')
     return redirect(url_for('attendance.index'))
 
 @attendance.route('/history')
 @login_required
+@conditional_on_user_data
 def history():
-    # Get user's attendance records
-    records = Attendance.query.filter_by(user_id=current_user.id).order_by(Attendance.check_in_time.desc()).all()
+    # Get user's attendance records, archived months included
+    records = Attendance.query.filter_by(user_id=current_user.id).order_by(
+        Attendance.check_in_time.desc(),
+        Attendance.id.desc()
+    )
+    records = list(with_archived(records, user_id=current_user.id))
     return render_template('history.html', records=records)
 
 @attendance.route('/api/attendance/status')
 @login_required
+@conditional_on_user_data
 def status():
-    # Check if user has an open attendance record
-    open_attendance = Attendance.query.filter_by(
-        user_id=current_user.id, 
-        check_out_time=None
-    ).first()
-    
-    if open_attendance:
-        return jsonify({
-            'status': 'checked_in',
-            'check_in_time': open_attendance.check_in_time.isoformat(),
-            'location': open_attendance.get_location(),
-            'location_address': open_attendance.location_address
-        })
-    
-    return jsonify({'status': 'checked_out'})
+    # Served from the open-session cache when the status has not changed
+    return jsonify(open_session_status(current_user.id))
+
+@attendance.route('/api/attendance/status/stream')
+@login_required
+def status_events():
+    # Pushes the status whenever a check-in/out or address lookup changes it
+    return Response(
+        stream_with_context(status_stream(current_user.id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
@@ -2,9 +2,26 @@ from flask import Blueprint, render_template, redirect, url_for, request, flash
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from app.models.models import User, db
+from app.utils.login_protection import get_login_limiter, verify_password, HashingBusy
 
 auth = Blueprint('auth', __name__)
 
+# Prefixes of bcrypt hashes, which only the D1 frontend writes and verifies
+D1_HASH_PREFIXES = ('$2a$', '$2b$', '$2y$')
+
+def password_matches(password_hash, password):
+    try:
+        return check_password_hash(password_hash, password)
+    except ValueError:
+        # Hashes written by the D1 frontend (bcrypt, e.g. the seeded admin)
+        # are not verifiable here
+        return False
+
+def has_local_users():
+    """Whether any user can log in here; D1-only accounts, like the admin seeded by 0001, cannot"""
+    d1_only = db.or_(*[User.password.startswith(prefix, autoescape=True) for prefix in D1_HASH_PREFIXES])
+    return db.session.query(User.query.filter(db.not_(d1_only)).exists()).scalar()
+
 @auth.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -12,12 +29,26 @@ def login():
         password = request.form.get('password')
         remember = True if request.form.get('remember') else False
         
+        # Throttle before hashing anything, so a flood of attempts stays cheap
+        limiter = get_login_limiter()
+        if limiter and not limiter.allow(username, request.remote_addr):
+            flash('Too many login attempts. Please try again later.')
+            return render_template('login.html'), 429, {'Retry-After': str(limiter.retry_after())}
+        
         user = User.query.filter_by(username=username).first()
         
-        if not user or not check_password_hash(user.password, password):
+        try:
+            matches = user is not None and verify_password(password_matches, user.password, password)
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.')
+            return render_template('login.html'), 503, {'Retry-After': '1'}
+        
+        if not matches:
             flash('Please check your login details and try again.')
             return redirect(url_for('auth.login'))
         
+        if limiter:
+            limiter.succeeded(username, request.remote_addr)
         login_user(user, remember=remember)
         return redirect(url_for('attendance.index'))
     
@@ -50,7 +81,7 @@ def register():
         )
         
         # Add first user as admin
-        if User.query.count() == 0:
+        if not has_local_users():
             new_user.is_admin = True
         
         db.session.add(new_user)
@@ -0,0 +1,623 @@
+"""Performance benchmarks.
+
+Run one with `python benchmarks.py <name> [options]`, e.g.
+`python benchmarks.py geofence --sites 5000`.
+
+Each benchmark reports named results. `--save-baseline FILE` records
+them and `--baseline FILE` fails the run when a result is more than
+`--tolerance` worse than the recorded one. Results ending in `_per_s`
+are better when higher, all others when lower.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from werkzeug.security import generate_password_hash
+from app import create_app
+from app.models.models import db, User, Attendance, grid_cell
+from app.utils.rollups import rebuild_rollups
+from app.utils.geofence import GeofenceIndex
+from app.utils.ingest import ingest_events
+from app.utils.pdf_reports import write_pdf
+from app.utils.provisioning import import_users
+
+
+def bench_app(directory, **config):
+    """App backed by a scratch SQLite database in `directory`"""
+    app = create_app(dict({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'bench.db'),
+        'GEOCODER_BACKEND': 'stub',
+    }, **config))
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def seed_users(count, password='x'):
+    users = [
+        User(username=f'bench{i}', email=f'bench{i}@example.com', password=password)
+        for i in range(count)
+    ]
+    db.session.add_all(users)
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def bench_geofence(args):
+    """Time geofence lookups against thousands of sites"""
+    rng = random.Random(args.seed)
+
+    # Sites scattered over a metropolitan area, a mix of circles and squares
+    sites = []
+    for site_id in range(args.sites):
+        latitude = 37.0 + rng.random()
+        longitude = -122.5 + rng.random()
+        if site_id % 2:
+            size = rng.uniform(0.0005, 0.002)
+            polygon = [
+                [latitude, longitude],
+                [latitude + size, longitude],
+                [latitude + size, longitude + size],
+                [latitude, longitude + size]
+            ]
+            sites.append(SimpleNamespace(
+                id=site_id, name=f'site{site_id}', latitude=None, longitude=None,
+                radius_m=None, get_polygon=lambda polygon=polygon: polygon
+            ))
+        else:
+            sites.append(SimpleNamespace(
+                id=site_id, name=f'site{site_id}', latitude=latitude, longitude=longitude,
+                radius_m=rng.uniform(50, 300), get_polygon=lambda: None
+            ))
+
+    started = time.perf_counter()
+    index = GeofenceIndex(sites)
+    build_time = time.perf_counter() - started
+
+    points = [(37.0 + rng.random(), -122.5 + rng.random()) for _ in range(args.lookups)]
+    started = time.perf_counter()
+    matched = sum(1 for latitude, longitude in points if index.locate(latitude, longitude))
+    lookup_time = time.perf_counter() - started
+
+    per_lookup_us = lookup_time / args.lookups * 1e6
+    print(f'sites: {args.sites}  index build: {build_time * 1000:.1f} ms')
+    print(f'lookups: {args.lookups}  matched: {matched}  per lookup: {per_lookup_us:.1f} us')
+    return per_lookup_us < 1000, {'build_ms': build_time * 1000, 'lookup_us': per_lookup_us}
+
+
+def bench_ingest(args):
+    """Throughput of the bulk check-in/out ingestion path"""
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = bench_app(directory)
+        with app.app_context():
+            user_ids = seed_users(args.users)
+
+            # One check-in and one check-out per user per day
+            events = []
+            day = datetime(2026, 1, 5, 8, 0)
+            while len(events) < args.events:
+                for user_id in user_ids:
+                    check_in = day + timedelta(minutes=rng.randint(0, 90))
+                    events.append({
+                        'type': 'check_in', 'user_id': user_id,
+                        'timestamp': check_in.isoformat(),
+                        'latitude': 37.7 + rng.random() / 10,
+                        'longitude': -122.5 + rng.random() / 10
+                    })
+                    events.append({
+                        'type': 'check_out', 'user_id': user_id,
+                        'timestamp': (check_in + timedelta(hours=8)).isoformat()
+                    })
+                day += timedelta(days=1)
+            events = events[:args.events]
+
+            started = time.perf_counter()
+            accepted = 0
+            for offset in range(0, len(events), args.batch):
+                results = ingest_events(events[offset:offset + args.batch])
+                accepted += sum(1 for result in results if result['success'])
+            elapsed = time.perf_counter() - started
+
+    print(f'events: {len(events)}  accepted: {accepted}  batch size: {args.batch}')
+    print(f'elapsed: {elapsed:.2f} s  throughput: {len(events) / elapsed:.0f} events/s')
+    return accepted == len(events), {'events_per_s': len(events) / elapsed}
+
+
+def bench_pdf(args):
+    """Sectioned PDF rendering, in-process versus a process pool"""
+    rng = random.Random(args.seed)
+    end = datetime(2026, 3, 29, 23, 0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = bench_app(directory)
+        with app.app_context():
+            user_ids = seed_users(args.users)
+            records = []
+            for i in range(args.events):
+                check_in = end - timedelta(days=rng.randint(0, 83), hours=rng.randint(0, 12))
+                record = Attendance(
+                    user_id=rng.choice(user_ids), check_in_time=check_in,
+                    check_out_time=check_in + timedelta(hours=8), notes=f'row {i}'
+                )
+                record.set_location(37.7 + rng.random() / 10, -122.5 + rng.random() / 10)
+                records.append(record)
+            db.session.add_all(records)
+            db.session.commit()
+
+            timings = {}
+            for workers in (0, args.workers):
+                app.config['PDF_WORKERS'] = workers
+                started = time.perf_counter()
+                write_pdf(os.path.join(directory, f'report{workers}.pdf'),
+                          (end - timedelta(days=83)).date(), end.date(), section='week')
+                timings[workers] = time.perf_counter() - started
+                print(f'workers: {workers}  rows: {args.events}  elapsed: {timings[workers]:.2f} s')
+
+            pool = app.extensions.pop('pdf_pool', None)
+            if pool is not None:
+                pool.shutdown()
+    return True, {f'workers_{workers}_s': elapsed for workers, elapsed in timings.items()}
+
+
+def seed_history(user_ids, years, rng, batch_size=10000):
+    """Insert `years` of closed weekday sessions per user, ending yesterday"""
+    today = datetime.utcnow().date()
+    first_day = today - timedelta(days=int(365 * years))
+    table = Attendance.__table__
+    rows = []
+    count = 0
+
+    day = first_day
+    while day < today:
+        if day.weekday() < 5:
+            for user_id in user_ids:
+                check_in = datetime.combine(day, datetime.min.time()) + timedelta(
+                    hours=7, minutes=rng.randint(0, 120)
+                )
+                latitude = 37.7 + rng.random() / 10
+                longitude = -122.5 + rng.random() / 10
+                rows.append({
+                    'user_id': user_id,
+                    'check_in_time': check_in,
+                    'check_out_time': check_in + timedelta(hours=8, minutes=rng.randint(0, 60)),
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'grid_cell': grid_cell(latitude, longitude),
+                    'location_data': json.dumps({'latitude': latitude, 'longitude': longitude}),
+                    'location_address': f'{rng.randint(1, 999)} Market St',
+                    'notes': ''
+                })
+                if len(rows) >= batch_size:
+                    db.session.execute(table.insert(), rows)
+                    count += len(rows)
+                    rows = []
+        day += timedelta(days=1)
+
+    if rows:
+        db.session.execute(table.insert(), rows)
+        count += len(rows)
+    db.session.commit()
+    rebuild_rollups(first_day, today)
+    return count
+
+
+def seeded_app(directory, args):
+    """Bench app with users (password 'password') and their history"""
+    app = bench_app(directory)
+    with app.app_context():
+        # Cheap hashes keep logins from dominating the timings
+        password = generate_password_hash('password', method='pbkdf2:sha256:1000')
+        started = time.perf_counter()
+        user_ids = seed_users(args.users, password)
+        rows = seed_history(user_ids, args.years, random.Random(args.seed))
+        print(f'seeded {len(user_ids)} users, {rows} sessions in {time.perf_counter() - started:.1f} s')
+    return app
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(0, int(round(fraction * len(ordered))) - 1)]
+
+
+def latency_summary(name, latencies):
+    p50, p95, p99 = (percentile(latencies, fraction) * 1000 for fraction in (0.5, 0.95, 0.99))
+    print(f'{name:<12} n={len(latencies):<6} p50 {p50:7.1f} ms  p95 {p95:7.1f} ms  p99 {p99:7.1f} ms')
+    return {f'{name}_p50_ms': p50, f'{name}_p95_ms': p95, f'{name}_p99_ms': p99}
+
+
+def bench_rush(args):
+    """Concurrent morning rush: login, check in, poll status, history, check out"""
+    latencies = {}
+    errors = []
+    lock = threading.Lock()
+
+    def timed(name, call, expected):
+        started = time.perf_counter()
+        response = call()
+        elapsed = time.perf_counter() - started
+        status = response.status_code
+        response.close()
+        with lock:
+            latencies.setdefault(name, []).append(elapsed)
+            if status not in expected:
+                errors.append((name, status))
+
+    def employee(index):
+        rng = random.Random(args.seed + index)
+        client = app.test_client()
+        timed('login', lambda: client.post('/login', data={
+            'username': f'bench{index}', 'password': 'password'
+        }), (302,))
+        timed('check_in', lambda: client.post('/api/attendance/check-in', json={
+            'latitude': 37.7 + rng.random() / 10, 'longitude': -122.5 + rng.random() / 10
+        }), (200,))
+        for _ in range(args.polls):
+            timed('status', lambda: client.get('/api/attendance/status'), (200,))
+        timed('history', lambda: client.get('/api/attendance/history'), (200,))
+        timed('check_out', lambda: client.post('/api/attendance/check-out'), (200,))
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = seeded_app(directory, args)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(employee, range(args.users)))
+        elapsed = time.perf_counter() - started
+
+    total = sum(len(values) for values in latencies.values())
+    results = {'requests_per_s': total / elapsed}
+    print(f'users: {args.users}  concurrency: {args.concurrency}  requests: {total}  errors: {len(errors)}')
+    for name in ('login', 'check_in', 'status', 'history', 'check_out'):
+        results.update(latency_summary(name, latencies[name]))
+    print(f'elapsed: {elapsed:.2f} s  throughput: {results["requests_per_s"]:.0f} requests/s')
+    return not errors, results
+
+
+def bench_exports(args):
+    """Time full-history CSV and 90-day PDF exports over seeded data"""
+    with tempfile.TemporaryDirectory() as directory:
+        app = seeded_app(directory, args)
+        app.config['PDF_WORKERS'] = args.workers
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench0', 'password': 'password'})
+        with app.app_context():
+            User.query.filter_by(username='bench0').update({'is_admin': True})
+            db.session.commit()
+
+        today = datetime.utcnow().date()
+        ranges = {
+            'csv': ('/admin/export-csv', today - timedelta(days=int(365 * args.years))),
+            'pdf': ('/admin/export-pdf', today - timedelta(days=90)),
+        }
+        latencies = {}
+        sizes = {}
+        for kind, (path, start_date) in ranges.items():
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                response = client.get(path, query_string={
+                    'start_date': start_date.isoformat(), 'end_date': today.isoformat()
+                })
+                # Drain streamed bodies so the whole export is timed
+                sizes[kind] = len(response.get_data())
+                latencies.setdefault(kind, []).append(time.perf_counter() - started)
+                response.close()
+
+        pool = app.extensions.pop('pdf_pool', None)
+        if pool is not None:
+            pool.shutdown()
+
+    results = {}
+    for kind, values in latencies.items():
+        print(f'{kind}: {sizes[kind] / 1024:.0f} KiB')
+        results.update(latency_summary(kind, values))
+    return all(sizes.values()), results
+
+
+def contention_worker(uri, journal_mode, usernames, rounds, barrier, results):
+    """One worker process: check its users in and out `rounds` times"""
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': uri,
+        'SQLITE_JOURNAL_MODE': journal_mode,
+        'GEOCODER_BACKEND': 'stub',
+    })
+    clients = []
+    for username in usernames:
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': 'password'})
+        clients.append(client)
+
+    barrier.wait()
+    started = time.time()
+    check_ins = errors = 0
+    for _ in range(rounds):
+        for client in clients:
+            response = client.post('/api/attendance/check-in', json={'latitude': 37.77, 'longitude': -122.42})
+            if response.status_code == 200:
+                check_ins += 1
+            else:
+                errors += 1
+            if client.post('/api/attendance/check-out').status_code != 200:
+                errors += 1
+    results.put((check_ins, errors, started, time.time()))
+
+
+def bench_contention(args):
+    """Check-in throughput with 1..N worker processes sharing one SQLite file"""
+    context = multiprocessing.get_context('spawn')
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = bench_app(directory, SQLITE_JOURNAL_MODE=args.journal_mode)
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        with app.app_context():
+            seed_users(args.processes * args.users, generate_password_hash('password', method='pbkdf2:sha256:1000'))
+            db.engine.dispose()
+
+        ok = True
+        processes = 1
+        while processes <= args.processes:
+            barrier = context.Barrier(processes)
+            queue = context.Queue()
+            workers = [
+                context.Process(target=contention_worker, args=(
+                    uri, args.journal_mode,
+                    [f'bench{worker * args.users + i}' for i in range(args.users)],
+                    args.rounds, barrier, queue
+                ))
+                for worker in range(processes)
+            ]
+            for worker in workers:
+                worker.start()
+            reports = [queue.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+
+            check_ins = sum(report[0] for report in reports)
+            errors = sum(report[1] for report in reports)
+            elapsed = max(report[3] for report in reports) - min(report[2] for report in reports)
+            results[f'processes_{processes}_check_ins_per_s'] = check_ins / elapsed
+            print(f'processes: {processes}  journal: {args.journal_mode}  check-ins: {check_ins}  '
+                  f'errors: {errors}  throughput: {check_ins / elapsed:.0f} check-ins/s')
+            ok = ok and not errors
+            processes *= 2
+    return ok, results
+
+
+def summarize_rows(rows, workday_start_hour=9, workday_hours=8):
+    """Per-row reference for Intervals.summary(): sessions, hours, lateness, overtime"""
+    stats = {}
+    daily = {}
+    for user_id, check_in, check_out in rows:
+        hours = (check_out - check_in).total_seconds() / 3600
+        user = stats.setdefault(user_id, {'sessions': 0, 'total_hours': 0.0, 'late_days': 0, 'overtime_hours': 0.0})
+        user['sessions'] += 1
+        user['total_hours'] += hours
+        day = daily.setdefault((user_id, check_in.date()), [check_in, 0.0])
+        day[0] = min(day[0], check_in)
+        day[1] += hours
+    for (user_id, _), (first_check_in, hours) in daily.items():
+        start_hour = first_check_in.hour + first_check_in.minute / 60 + first_check_in.second / 3600
+        if start_hour > workday_start_hour:
+            stats[user_id]['late_days'] += 1
+        stats[user_id]['overtime_hours'] += max(hours - workday_hours, 0)
+    return stats
+
+
+def bench_analytics(args):
+    """Vectorized analytics against a per-row Python loop"""
+    import numpy as np
+    from app.utils.analytics import Intervals
+
+    rng = np.random.default_rng(args.seed)
+    epoch_day = (datetime(2020, 1, 1) - datetime(1970, 1, 1)).days
+    user_ids = rng.integers(0, args.users, args.sessions)
+    days = epoch_day + rng.integers(0, 5 * 365, args.sessions)
+    starts = days * 86400 + rng.integers(7 * 3600, 11 * 3600, args.sessions)
+    ends = starts + rng.integers(2 * 3600, 10 * 3600, args.sessions)
+
+    rows = [
+        (int(user_id), datetime.utcfromtimestamp(int(start)), datetime.utcfromtimestamp(int(end)))
+        for user_id, start, end in zip(user_ids, starts, ends)
+    ]
+    started = time.perf_counter()
+    expected = summarize_rows(rows)
+    loop_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    intervals = Intervals(user_ids, starts, ends)
+    summary = intervals.summary()
+    intervals.occupancy()
+    vector_time = time.perf_counter() - started
+
+    matches = all(
+        summary[user_id]['sessions'] == stats['sessions']
+        and summary[user_id]['late_days'] == stats['late_days']
+        and abs(summary[user_id]['total_hours'] - stats['total_hours']) < 0.01
+        and abs(summary[user_id]['overtime_hours'] - stats['overtime_hours']) < 0.01
+        for user_id, stats in expected.items()
+    )
+    speedup = loop_time / vector_time
+    print(f'sessions: {args.sessions}  users: {args.users}  results match: {matches}')
+    print(f'python loop: {loop_time:.2f} s  vectorized (summary + occupancy): {vector_time:.3f} s  '
+          f'speedup: {speedup:.0f}x')
+    return matches and speedup >= 10, {'loop_s': loop_time, 'vectorized_s': vector_time}
+
+
+def bench_provision(args):
+    """Bulk user import, hashing in-process versus a process pool"""
+    rows = [
+        {'username': f'new{i}', 'email': f'new{i}@example.com', 'password': f'password-{i}'}
+        for i in range(args.imports)
+    ]
+
+    timings = {}
+    ok = True
+    for workers in (1, args.workers):
+        with tempfile.TemporaryDirectory() as directory:
+            app = bench_app(directory, HASH_WORKERS=workers, PASSWORD_HASH_METHOD=args.hash_method)
+            with app.app_context():
+                started = time.perf_counter()
+                results = import_users(rows)
+                timings[workers] = time.perf_counter() - started
+                ok = ok and all(result['success'] for result in results)
+            pool = app.extensions.pop('hash_pool', None)
+            if pool is not None:
+                pool.shutdown()
+        print(f'workers: {workers}  users: {args.imports}  hash: {args.hash_method}  '
+              f'elapsed: {timings[workers]:.2f} s  ({args.imports / timings[workers]:.0f} users/s)')
+    return ok, {f'workers_{workers}_users_per_s': args.imports / elapsed for workers, elapsed in timings.items()}
+
+
+def bench_login_flood(args):
+    """Check-in latency while a paced flood of bad logins runs, with and without protection"""
+    modes = {
+        'unprotected': {'LOGIN_THROTTLE_STORE': None, 'LOGIN_HASH_WORKERS': 0},
+        'protected': {'LOGIN_THROTTLE_STORE': 'memory', 'LOGIN_HASH_WORKERS': 1},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = seeded_app(directory, args)
+        with app.app_context():
+            # Flood targets keep production-cost hashes
+            User.query.filter(User.username != 'bench0').update({
+                'password': generate_password_hash('password', method=args.hash_method)
+            })
+            db.session.commit()
+
+        def flood(index, stop):
+            rng = random.Random(args.seed + index)
+            client = app.test_client()
+            interval = args.concurrency / args.flood_rate
+            next_attempt = time.perf_counter()
+            while not stop.is_set():
+                client.post('/login', data={
+                    'username': f'bench{rng.randint(1, args.users - 1)}', 'password': 'wrong'
+                }, environ_base={'REMOTE_ADDR': f'10.0.0.{rng.randint(1, args.addresses)}'}).close()
+                next_attempt += interval
+                time.sleep(max(0, next_attempt - time.perf_counter()))
+
+        def check_ins():
+            client = app.test_client()
+            client.post('/login', data={'username': 'bench0', 'password': 'password'},
+                        environ_base={'REMOTE_ADDR': '192.168.0.1'})
+            latencies = []
+            for _ in range(args.rounds):
+                for path in ('/api/attendance/check-in', '/api/attendance/check-out'):
+                    started = time.perf_counter()
+                    client.post(path, json={'latitude': 37.7749, 'longitude': -122.4194}).close()
+                    latencies.append(time.perf_counter() - started)
+            return latencies
+
+        results = {}
+        results.update(latency_summary('idle', check_ins()))
+        for mode, config in modes.items():
+            app.config.update(config)
+            app.extensions.pop('login_limiter', None)
+            stop = threading.Event()
+            flooders = [threading.Thread(target=flood, args=(i, stop)) for i in range(args.concurrency)]
+            for thread in flooders:
+                thread.start()
+            try:
+                results.update(latency_summary(mode, check_ins()))
+            finally:
+                stop.set()
+                for thread in flooders:
+                    thread.join()
+            executor = app.extensions.pop('hash_executor', None)
+            if executor is not None:
+                executor.shutdown()
+
+    print(f'flood: {args.flood_rate} bad logins/s from {args.addresses} addresses, hash: {args.hash_method}')
+    # Holding steady: protected p95 within twice the idle p95
+    return results['protected_p95_ms'] <= 2 * max(results['idle_p95_ms'], 5), results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return the names of results that regressed past the tolerance"""
+    regressions = []
+    for name, value in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if name.endswith('_per_s'):
+            regressed = value < expected * (1 - tolerance)
+        else:
+            regressed = value > expected * (1 + tolerance)
+        if regressed:
+            print(f'REGRESSION {name}: {value:.2f} vs baseline {expected:.2f}')
+            regressions.append(name)
+    return regressions
+
+
+BENCHMARKS = {
+    'geofence': bench_geofence,
+    'ingest': bench_ingest,
+    'pdf': bench_pdf,
+    'rush': bench_rush,
+    'exports': bench_exports,
+    'contention': bench_contention,
+    'analytics': bench_analytics,
+    'provision': bench_provision,
+    'login-flood': bench_login_flood,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--sites', type=int, default=5000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--polls', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--journal-mode', default='WAL')
+    parser.add_argument('--sessions', type=int, default=1000000)
+    parser.add_argument('--imports', type=int, default=2000)
+    # Cost scales linearly with iterations; pass 'pbkdf2:sha256' for the production default
+    parser.add_argument('--hash-method', default='pbkdf2:sha256:20000')
+    parser.add_argument('--flood-rate', type=float, default=200)
+    parser.add_argument('--addresses', type=int, default=4)
+    parser.add_argument('--baseline', help='fail if results regress past this baseline file')
+    parser.add_argument('--save-baseline', help='write the results to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    ok, results = BENCHMARKS[args.benchmark](args)
+
+    if args.save_baseline:
+        stored = {}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline) as f:
+                stored = json.load(f)
+        stored[args.benchmark] = results
+        with open(args.save_baseline, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get(args.benchmark, {})
+        if compare_to_baseline(results, baseline, args.tolerance):
+            ok = False
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,88 @@
+import hashlib
+from datetime import datetime
+from functools import wraps
+from flask import has_app_context, make_response, request, session
+from flask_login import current_user
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from app.models.models import Attendance, User, db
+from app.utils.user_cache import invalidate_user
+
+STAMP_CHUNK = 1000
+
+
+def bump_data_version(user_ids, attendance_ids=None):
+    """Mark users' attendance data as changed.
+
+    Call inside the transaction that changes the data, so the new
+    version becomes visible together with it. The changed
+    `attendance_ids` get their user's new version as change_seq for
+    delta sync. The bumped user rows stay locked until commit, so a
+    user's versions are committed in order, and their cached copies
+    are dropped once the commit succeeds.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    users = User.__table__
+    db.session.execute(
+        users.update().where(users.c.id.in_(user_ids)).values(
+            data_version=users.c.data_version + 1,
+            data_modified_at=datetime.utcnow()
+        )
+    )
+    db.session.info.setdefault('bumped_user_ids', set()).update(user_ids)
+    if attendance_ids is None:
+        return
+
+    attendance = Attendance.__table__
+    stamp = attendance.update().values(
+        change_seq=select(users.c.data_version).where(users.c.id == attendance.c.user_id).scalar_subquery()
+    )
+    attendance_ids = list(attendance_ids)
+    for offset in range(0, len(attendance_ids), STAMP_CHUNK):
+        db.session.execute(stamp.where(attendance.c.id.in_(attendance_ids[offset:offset + STAMP_CHUNK])))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_bumped_users(session):
+    # After the commit, so a load racing it cannot cache the old version
+    user_ids = session.info.pop('bumped_user_ids', None)
+    if user_ids and has_app_context():
+        for user_id in user_ids:
+            invalidate_user(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_bumped_users(session):
+    session.info.pop('bumped_user_ids', None)
+
+
+def conditional_on_user_data(view):
+    """Answer repeat GETs of a user's own data with 304 Not Modified.
+
+    The strong ETag combines the user's data version with the request
+    path and query string, so an unchanged resource costs no query and
+    no serialisation when the user comes from the cache. Last-Modified
+    is not sent: with one-second resolution it cannot tell apart two
+    writes in the same second.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version = current_user.data_version
+        digest = hashlib.sha256(request.full_path.encode('utf-8')).hexdigest()[:16]
+        etag = f'{current_user.id}-{version or 0}-{digest}'
+
+        # Pending flash messages are rendered into pages, so serve those fresh
+        if request.if_none_match.contains(etag) and not session.get('_flashes'):
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
@@ -0,0 +1,58 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+DEFAULT_DATABASE_URI = 'sqlite:///attendance.db'
+
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def engine_options(config):
+    """SQLAlchemy engine options for the configured database.
+
+    Server databases get a tuned connection pool. SQLite uses the pool
+    Flask-SQLAlchemy picks for it, and is tuned with pragmas on connect
+    instead (see configure_engine). Explicit SQLALCHEMY_ENGINE_OPTIONS
+    take precedence.
+    """
+    options = {}
+    if not is_sqlite(config['SQLALCHEMY_DATABASE_URI']):
+        options.update(
+            pool_size=config.get('DB_POOL_SIZE', 10),
+            max_overflow=config.get('DB_MAX_OVERFLOW', 20),
+            # Recycle before server-side idle timeouts close connections
+            pool_recycle=config.get('DB_POOL_RECYCLE', 1800),
+            pool_timeout=config.get('DB_POOL_TIMEOUT', 30),
+            pool_pre_ping=config.get('DB_POOL_PRE_PING', True),
+        )
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    return options
+
+
+def configure_engine(app, engine):
+    """Apply SQLite pragmas to every new connection.
+
+    WAL lets readers run alongside the single writer, busy_timeout makes
+    writers wait for the lock instead of failing with "database is
+    locked", and synchronous=NORMAL is durable enough under WAL while
+    avoiding an fsync per commit.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    pragmas = [
+        ('busy_timeout', int(app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))),
+        ('journal_mode', app.config.get('SQLITE_JOURNAL_MODE', 'WAL')),
+        ('synchronous', app.config.get('SQLITE_SYNCHRONOUS', 'NORMAL')),
+    ]
+    if engine.url.database in (None, '', ':memory:'):
+        # In-memory databases have no journal to configure
+        pragmas = pragmas[:1]
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
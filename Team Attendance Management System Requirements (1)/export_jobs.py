@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app.models.models import ExportJob, db
+from app.utils.exports import iter_csv
+from app.utils.metrics import get_metrics
+from app.utils.queries import attendance_with_users, iter_keyset
+from app.utils.archive import with_archived
+
+EXPORT_KINDS = {
+    'csv': 'text/csv',
+    'pdf': 'application/pdf',
+}
+
+
+def job_key(kind, start_date, end_date, user_id):
+    """Identical parameter sets map to the same job id"""
+    params = {
+        'kind': kind,
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'user_id': str(user_id) if user_id and user_id != 'all' else 'all'
+    }
+    payload = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest(), payload
+
+
+def render_export(kind, path, start_date, end_date, user_id):
+    """Write a CSV or PDF export for a date range to `path`"""
+    if kind == 'csv':
+        start_datetime = datetime.combine(start_date, datetime.min.time())
+        end_datetime = datetime.combine(end_date, datetime.max.time())
+        query = attendance_with_users(start_datetime, end_datetime, user_id)
+        with open(path, 'wb') as output:
+            records = with_archived(iter_keyset(query), start_datetime, end_datetime, user_id)
+            for chunk in iter_csv(records):
+                output.write(chunk)
+    else:
+        from app.utils.pdf_reports import write_pdf
+        write_pdf(path, start_date, end_date, user_id)
+
+
+class ExportQueue:
+    """Renders exports on a local thread pool into EXPORT_DIR.
+
+    Job state lives in the export_jobs table so any worker sharing the
+    database and export directory can report status and serve files.
+    Finished artifacts are evicted least recently used first once their
+    total size passes EXPORT_CACHE_BYTES.
+    """
+
+    def __init__(self, app, directory, workers=2, cache_bytes=500 * 1024 * 1024, job_timeout=3600):
+        self.app = app
+        self.directory = directory
+        self.cache_bytes = cache_bytes
+        self.job_timeout = job_timeout
+        os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='export')
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def submit(self, kind, start_date, end_date, user_id=None):
+        """Return the job for these parameters, queueing it if needed"""
+        key, params = job_key(kind, start_date, end_date, user_id)
+        job = ExportJob.query.get(key)
+
+        if job is not None and self._reusable(job, end_date):
+            return job
+
+        if job is None:
+            job = ExportJob(id=key, kind=kind, params=params)
+            db.session.add(job)
+        job.status = 'pending'
+        job.error = None
+        job.created_at = datetime.utcnow()
+        job.started_at = None
+        job.finished_at = None
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another request queued the same export first
+            db.session.rollback()
+            return ExportJob.query.get(key)
+
+        future = self._executor.submit(self._run, key)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return job
+
+    def touch(self, job):
+        job.last_accessed = datetime.utcnow()
+        db.session.commit()
+
+    def join(self, timeout=None):
+        """Wait for all queued jobs to finish"""
+        with self._lock:
+            pending = list(self._futures)
+        wait(pending, timeout=timeout)
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _reusable(self, job, end_date):
+        # A process that died before or during the render leaves its job
+        # pending or running forever; past the timeout it is queued again
+        cutoff = datetime.utcnow() - timedelta(seconds=self.job_timeout)
+        if job.status == 'pending':
+            return job.created_at > cutoff
+        if job.status == 'running':
+            return job.started_at > cutoff
+        if job.status == 'done' and job.path and os.path.exists(job.path):
+            # Ranges that end before today can no longer change
+            return end_date < datetime.utcnow().date()
+        return False
+
+    def _run(self, key):
+        with self.app.app_context():
+            job = ExportJob.query.get(key)
+            job.status = 'running'
+            job.started_at = datetime.utcnow()
+            db.session.commit()
+
+            params = job.get_params()
+            path = os.path.join(self.directory, f'{key}.{job.kind}')
+            partial = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+            try:
+                render_export(
+                    job.kind,
+                    partial,
+                    datetime.strptime(params['start_date'], '%Y-%m-%d').date(),
+                    datetime.strptime(params['end_date'], '%Y-%m-%d').date(),
+                    params['user_id']
+                )
+                os.replace(partial, path)
+            except Exception as e:
+                db.session.rollback()
+                if os.path.exists(partial):
+                    os.remove(partial)
+                job = ExportJob.query.get(key)
+                job.status = 'failed'
+                job.error = str(e)
+                job.finished_at = datetime.utcnow()
+                db.session.commit()
+                self.app.logger.error(f"Export {key} failed: {e}")
+                return
+
+            job = ExportJob.query.get(key)
+            job.status = 'done'
+            job.path = path
+            job.size = os.path.getsize(path)
+            job.finished_at = job.last_accessed = datetime.utcnow()
+            db.session.commit()
+            get_metrics(self.app).observe_export(
+                job.kind, job.size, (job.finished_at - job.started_at).total_seconds()
+            )
+
+            self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        """Drop least recently used artifacts until the cache fits its budget"""
+        done = ExportJob.query.filter_by(status='done').order_by(
+            ExportJob.last_accessed.desc()
+        ).all()
+
+        total = 0
+        for job in done:
+            total += job.size or 0
+            if total > self.cache_bytes and job.id != keep:
+                if job.path and os.path.exists(job.path):
+                    os.remove(job.path)
+                db.session.delete(job)
+        db.session.commit()
+
+
+_init_lock = threading.Lock()
+
+
+def get_export_queue(app=None):
+    """Return the app's export queue, creating it on first use"""
+    app = app or current_app._get_current_object()
+    queue = app.extensions.get('export_queue')
+    if queue is None:
+        with _init_lock:
+            queue = app.extensions.get('export_queue')
+            if queue is None:
+                queue = ExportQueue(
+                    app,
+                    app.config.get('EXPORT_DIR', os.path.join(app.instance_path, 'exports')),
+                    workers=app.config.get('EXPORT_WORKERS', 2),
+                    cache_bytes=app.config.get('EXPORT_CACHE_BYTES', 500 * 1024 * 1024),
+                    job_timeout=app.config.get('EXPORT_JOB_TIMEOUT', 3600)
+                )
+                app.extensions['export_queue'] = queue
+    return queue
@@ -0,0 +1,91 @@
+import csv
+import io
+import time
+import zlib
+from flask import Response, request, stream_with_context
+from app.utils.metrics import get_metrics
+
+CSV_HEADER = [
+    'ID', 'Username', 'Check-in Time', 'Check-out Time', 'Duration (hours)',
+    'Location (Lat, Long)', 'Address', 'Notes'
+]
+
+
+def csv_row(record):
+    """Format an attendance record (with its user loaded) as a CSV row"""
+    location = record.get_location()
+    location_str = f"{location['latitude']}, {location['longitude']}" if location else "N/A"
+
+    return [
+        record.id,
+        record.user.username,
+        record.check_in_time.strftime('%Y-%m-%d %H:%M:%S'),
+        record.check_out_time.strftime('%Y-%m-%d %H:%M:%S') if record.check_out_time else 'N/A',
+        record.duration() if record.duration() else 'N/A',
+        location_str,
+        record.location_address or 'N/A',
+        record.notes or ''
+    ]
+
+
+def iter_csv(records, rows_per_chunk=500):
+    """Render records as CSV, yielding encoded chunks of `rows_per_chunk` rows"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(CSV_HEADER)
+
+    rows = 0
+    for record in records:
+        writer.writerow(csv_row(record))
+        rows += 1
+        if rows % rows_per_chunk == 0:
+            yield output.getvalue().encode('utf-8')
+            output.seek(0)
+            output.truncate()
+
+    if output.tell():
+        yield output.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of byte chunks into a single gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def observed_chunks(chunks, kind):
+    """Pass chunks through, recording the export's size and duration once all are sent"""
+    started = time.perf_counter()
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    get_metrics().observe_export(kind, size, time.perf_counter() - started)
+
+
+def stream_download(chunks, mimetype, filename, kind):
+    """Stream chunks to the client as a file download.
+
+    The body is gzip-compressed on the fly when the client accepts it.
+    The uncompressed size and the time taken are recorded as an export
+    of `kind` when the last chunk has been sent.
+    """
+    chunks = observed_chunks(chunks, kind)
+    headers = {
+        'Content-Disposition': f'attachment; filename={filename}',
+        'Vary': 'Accept-Encoding',
+    }
+
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers=headers
+    )
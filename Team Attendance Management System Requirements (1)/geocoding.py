@@ -0,0 +1,254 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import current_app
+from app.models.models import Attendance, db
+from app.utils.metrics import get_metrics
+from app.utils.data_versions import bump_data_version
+from app.utils.status_events import status_changed
+
+
+class NominatimGeocoder:
+    """Reverse geocoder backed by OpenStreetMap Nominatim"""
+
+    def __init__(self, user_agent="attendance_system"):
+        # geopy is only needed by workers that actually resolve addresses
+        from geopy.geocoders import Nominatim
+        self.geolocator = Nominatim(user_agent=user_agent)
+
+    def reverse(self, latitude, longitude):
+        location = self.geolocator.reverse(f"{latitude}, {longitude}")
+        if location:
+            return location.address
+        return None
+
+
+class StubGeocoder:
+    """Offline geocoder for tests and local development"""
+
+    def __init__(self, addresses=None, delay=0, failures=0):
+        self.addresses = addresses or {}
+        self.delay = delay
+        # The first `failures` lookups raise, like an unreachable service
+        self.failures = failures
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def reverse(self, latitude, longitude):
+        with self._lock:
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise ConnectionError('Geocoding service unavailable')
+        if self.delay:
+            time.sleep(self.delay)
+        return self.addresses.get(
+            (latitude, longitude),
+            f"Near {latitude:.4f}, {longitude:.4f}"
+        )
+
+
+GEOCODER_BACKENDS = {
+    'nominatim': NominatimGeocoder,
+    'stub': StubGeocoder,
+}
+
+
+class GeocodeCache:
+    """Thread-safe LRU cache of addresses keyed by rounded coordinates"""
+
+    def __init__(self, max_size=10000, ttl=86400, precision=3):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.precision = precision
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bucket(self, latitude, longitude):
+        """Round coordinates to a grid cell (3 decimals is roughly 100m)"""
+        return (
+            round(float(latitude), self.precision),
+            round(float(longitude), self.precision)
+        )
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            address, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return address
+
+    def set(self, key, address):
+        with self._lock:
+            self._entries[key] = (address, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class GeocodingPool:
+    """Resolves check-in addresses off the request thread.
+
+    Lookups for the same grid cell are coalesced: while a cell is being
+    resolved, further attendance ids for it are queued behind the running
+    lookup and updated together once the address is known. A failed
+    lookup is retried up to `retries` times, waiting `retry_delay`
+    seconds and doubling it each time, before its records are given up.
+    """
+
+    def __init__(self, app, backend, cache, workers=2, retries=2, retry_delay=1.0):
+        self.app = app
+        self.backend = backend
+        self.cache = cache
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='geocoder'
+        )
+        self._waiters = {}
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def cached(self, latitude, longitude):
+        """Return the cached address for a location, if there is one"""
+        try:
+            return self.cache.get(self.cache.bucket(latitude, longitude))
+        except (TypeError, ValueError):
+            return None
+
+    def enqueue(self, attendance_id, latitude, longitude):
+        """Schedule filling in location_address for an attendance record"""
+        try:
+            key = self.cache.bucket(latitude, longitude)
+        except (TypeError, ValueError):
+            return
+
+        with self._lock:
+            if key in self._waiters:
+                self._waiters[key].append(attendance_id)
+                return
+            self._waiters[key] = [attendance_id]
+            future = self._executor.submit(self._resolve, key)
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+
+    def join(self, timeout=None):
+        """Wait for all scheduled lookups to finish"""
+        with self._lock:
+            pending = list(self._futures)
+        wait(pending, timeout=timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _lookup(self, key):
+        """Ask the backend for a cell's address, retrying failures.
+
+        Returns the address, which may be None, and whether the lookup
+        succeeded at all.
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # Records queued for the cell meanwhile are resolved with it
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            started = time.perf_counter()
+            try:
+                address = self.backend.reverse(*key)
+            except Exception as e:
+                self.app.logger.warning(f"Error getting address (attempt {attempt + 1}): {e}")
+                get_metrics(self.app).observe_geocoder(
+                    type(self.backend).__name__, time.perf_counter() - started, True
+                )
+                continue
+            get_metrics(self.app).observe_geocoder(
+                type(self.backend).__name__, time.perf_counter() - started, False
+            )
+            return address, True
+        return None, False
+
+    def _resolve(self, key):
+        address = self.cache.get(key)
+        succeeded = True
+        if address is None:
+            address, succeeded = self._lookup(key)
+            if address:
+                self.cache.set(key, address)
+
+        with self._lock:
+            attendance_ids = self._waiters.pop(key, [])
+
+        if not succeeded:
+            # Leave the addresses empty, the check-ins themselves already succeeded
+            self.app.logger.error(
+                f"Giving up on the address of {key} for attendance records {attendance_ids}"
+            )
+        elif address and attendance_ids:
+            self._store(address, attendance_ids)
+
+    def _store(self, address, attendance_ids):
+        with self.app.app_context():
+            # Only records still without an address change
+            rows = db.session.query(Attendance.id, Attendance.user_id).filter(
+                Attendance.id.in_(attendance_ids),
+                Attendance.location_address.is_(None)
+            ).all()
+            if not rows:
+                return
+            updated_ids = [attendance_id for attendance_id, _ in rows]
+            user_ids = {user_id for _, user_id in rows}
+            Attendance.query.filter(
+                Attendance.id.in_(updated_ids),
+                Attendance.location_address.is_(None)
+            ).update({'location_address': address}, synchronize_session=False)
+            bump_data_version(user_ids, updated_ids)
+            db.session.commit()
+            
+            # Cached statuses still carry the empty address
+            for user_id in user_ids:
+                status_changed(user_id, self.app)
+
+
+_init_lock = threading.Lock()
+
+
+def init_geocoder(app):
+    """Create the geocoding pool from the app config"""
+    backend = GEOCODER_BACKENDS[app.config.get('GEOCODER_BACKEND', 'nominatim')]()
+    cache = GeocodeCache(
+        max_size=app.config.get('GEOCODER_CACHE_SIZE', 10000),
+        ttl=app.config.get('GEOCODER_CACHE_TTL', 86400),
+        precision=app.config.get('GEOCODER_PRECISION', 3)
+    )
+    pool = GeocodingPool(
+        app,
+        backend,
+        cache,
+        workers=app.config.get('GEOCODER_WORKERS', 2),
+        retries=app.config.get('GEOCODER_RETRIES', 2),
+        retry_delay=app.config.get('GEOCODER_RETRY_DELAY', 1.0)
+    )
+    app.extensions['geocoder'] = pool
+    return pool
+
+
+def get_geocoder(app=None):
+    """Return the app's geocoding pool, creating it on first use"""
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get('geocoder')
+    if pool is None:
+        with _init_lock:
+            pool = app.extensions.get('geocoder') or init_geocoder(app)
+    return pool
@@ -0,0 +1,231 @@
+import math
+import time
+import threading
+from collections import defaultdict
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app.models.models import Attendance, Site, db, grid_cell, GRID_CELL_DEGREES, GRID_COLUMNS
+from app.utils.data_versions import bump_data_version
+from app.utils.queries import distance_m, EARTH_RADIUS_M
+from app.utils.user_cache import invalidate_user
+
+
+class CircleFence:
+    def __init__(self, site_id, name, latitude, longitude, radius_m):
+        self.site_id = site_id
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius_m = radius_m
+
+        lat_delta = math.degrees(radius_m / EARTH_RADIUS_M)
+        lon_delta = lat_delta / max(math.cos(math.radians(latitude)), 1e-6)
+        self.bounds = (
+            latitude - lat_delta, longitude - lon_delta,
+            latitude + lat_delta, longitude + lon_delta
+        )
+        self.area = math.pi * radius_m ** 2
+
+    def contains(self, latitude, longitude):
+        return distance_m(self.latitude, self.longitude, latitude, longitude) <= self.radius_m
+
+
+class PolygonFence:
+    def __init__(self, site_id, name, vertices):
+        self.site_id = site_id
+        self.name = name
+        self.vertices = [tuple(vertex) for vertex in vertices]
+
+        lats = [lat for lat, _ in self.vertices]
+        lons = [lon for _, lon in self.vertices]
+        self.bounds = (min(lats), min(lons), max(lats), max(lons))
+
+        # Shoelace formula on an equirectangular projection, in m² like
+        # CircleFence.area; only used to prefer the smaller of overlapping sites
+        scale = math.cos(math.radians((min(lats) + max(lats)) / 2))
+        points = [
+            (math.radians(lat) * EARTH_RADIUS_M, math.radians(lon) * EARTH_RADIUS_M * scale)
+            for lat, lon in self.vertices
+        ]
+        self.area = abs(sum(
+            y1 * x2 - y2 * x1
+            for (y1, x1), (y2, x2) in zip(points, points[1:] + points[:1])
+        )) / 2
+
+    def contains(self, latitude, longitude):
+        min_lat, min_lon, max_lat, max_lon = self.bounds
+        if not (min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon):
+            return False
+
+        # Ray casting along the latitude axis
+        inside = False
+        vertices = self.vertices
+        j = len(vertices) - 1
+        for i in range(len(vertices)):
+            lat_i, lon_i = vertices[i]
+            lat_j, lon_j = vertices[j]
+            if (lon_i > longitude) != (lon_j > longitude):
+                crossing = lat_i + (longitude - lon_i) * (lat_j - lat_i) / (lon_j - lon_i)
+                if latitude < crossing:
+                    inside = not inside
+            j = i
+        return inside
+
+
+def fence_for(site):
+    """Build the fence for a site, or None if it has no usable geometry"""
+    vertices = site.get_polygon()
+    if vertices and len(vertices) >= 3:
+        return PolygonFence(site.id, site.name, vertices)
+    if site.latitude is not None and site.longitude is not None and site.radius_m:
+        return CircleFence(site.id, site.name, site.latitude, site.longitude, site.radius_m)
+    return None
+
+
+class GeofenceIndex:
+    """Grid-bucketed index of site fences.
+
+    Every fence is registered in each grid cell its bounding box touches,
+    so a lookup only tests the handful of fences sharing the point's cell.
+    """
+
+    def __init__(self, sites):
+        self.buckets = defaultdict(list)
+        self.size = 0
+
+        for site in sites:
+            fence = fence_for(site)
+            if fence is None:
+                continue
+            self.size += 1
+
+            min_lat, min_lon, max_lat, max_lon = fence.bounds
+            first_row = int((max(min_lat, -90) + 90) / GRID_CELL_DEGREES)
+            last_row = int((min(max_lat, 90) + 90) / GRID_CELL_DEGREES)
+            first_column = int((max(min_lon, -180) + 180) / GRID_CELL_DEGREES)
+            last_column = int((min(max_lon, 180) + 180) / GRID_CELL_DEGREES)
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    self.buckets[row * GRID_COLUMNS + column].append(fence)
+
+        # Prefer the smallest site when fences overlap
+        for fences in self.buckets.values():
+            fences.sort(key=lambda fence: fence.area)
+
+        self.built_at = time.monotonic()
+
+    def locate(self, latitude, longitude):
+        """Return the fence containing a point, or None if it is off-site"""
+        for fence in self.buckets.get(grid_cell(latitude, longitude), ()):
+            if fence.contains(latitude, longitude):
+                return fence
+        return None
+
+
+_index_lock = threading.Lock()
+
+
+def get_geofence_index(app=None):
+    """Return the app's geofence index, rebuilding it once it is stale.
+
+    Other workers pick up site changes after GEOFENCE_REFRESH_SECONDS.
+    """
+    app = app or current_app._get_current_object()
+    refresh = app.config.get('GEOFENCE_REFRESH_SECONDS', 60)
+
+    index = app.extensions.get('geofence')
+    if index is None or time.monotonic() - index.built_at > refresh:
+        with _index_lock:
+            # Another thread may have rebuilt it while we waited
+            index = app.extensions.get('geofence')
+            if index is None or time.monotonic() - index.built_at > refresh:
+                index = GeofenceIndex(Site.query.all())
+                app.extensions['geofence'] = index
+    return index
+
+
+def invalidate_geofence_index(app=None):
+    app = app or current_app._get_current_object()
+    app.extensions.pop('geofence', None)
+
+
+def tag_site(record, index=None):
+    """Set site_id/off_site on a record from its location.
+
+    Records are left unevaluated while no sites are configured.
+    """
+    index = index or get_geofence_index()
+    if not index.size or record.latitude is None:
+        return
+
+    fence = index.locate(record.latitude, record.longitude)
+    record.site_id = fence.site_id if fence else None
+    record.off_site = fence is None
+
+
+def changed_tags(records, index):
+    """Site tags under `index` for the records whose tag changes.
+
+    Returns update mappings for Attendance and the ids of the users
+    whose records changed.
+    """
+    mappings = []
+    user_ids = set()
+    for record in records:
+        fence = index.locate(record.latitude, record.longitude) if index.size else None
+        site_id = fence.site_id if fence else None
+        off_site = (fence is None) if index.size else None
+        if (record.site_id, record.off_site) != (site_id, off_site):
+            mappings.append({'id': record.id, 'site_id': site_id, 'off_site': off_site})
+            user_ids.add(record.user_id)
+    return mappings, user_ids
+
+
+def reevaluate_geofences(start_date=None, end_date=None, batch_size=1000):
+    """Re-tag historical check-ins against the current sites.
+
+    Records are walked in id order and each batch is committed on its
+    own, so the write lock is only held for one batch at a time. Only
+    records whose tag changes are written, and marked as changed for
+    delta sync. Returns the number of records evaluated.
+    """
+    index = GeofenceIndex(Site.query.all())
+    query = Attendance.query.filter(Attendance.latitude.isnot(None))
+
+    if start_date:
+        query = query.filter(Attendance.check_in_time >= datetime.combine(start_date, datetime.min.time()))
+
+    if end_date:
+        query = query.filter(Attendance.check_in_time <= datetime.combine(end_date, datetime.max.time()))
+
+    count = 0
+    last_id = 0
+    while True:
+        records = query.filter(Attendance.id > last_id).order_by(Attendance.id).limit(batch_size).all()
+        if not records:
+            return count
+        last_id = records[-1].id
+        count += len(records)
+
+        batch, user_ids = changed_tags(records, index)
+        if batch:
+            db.session.bulk_update_mappings(Attendance, batch)
+            bump_data_version(user_ids, [mapping['id'] for mapping in batch])
+        db.session.commit()
+        for user_id in user_ids:
+            invalidate_user(user_id)
+
+
+@click.command('evaluate-geofences')
+@click.option('--start-date', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+@click.option('--end-date', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+@with_appcontext
+def evaluate_geofences_command(start_date, end_date):
+    """Re-tag historical check-ins with the site they fall in."""
+    count = reevaluate_geofences(
+        start_date.date() if start_date else None,
+        end_date.date() if end_date else None
+    )
+    click.echo(f'Evaluated {count} check-ins')
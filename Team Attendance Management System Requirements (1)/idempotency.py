@@ -0,0 +1,151 @@
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app, g, jsonify, make_response, request
+from flask_login import current_user
+from sqlalchemy import select
+from app.models.models import IdempotencyKey, db
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = IdempotencyKey.__table__.c.key.type.length
+
+
+class IdempotencyStore:
+    """Responses of keyed requests in the idempotency_keys table.
+
+    Keys expire after `ttl` seconds. Every `prune_seconds` expired keys
+    are deleted and, beyond `max_keys`, the oldest are evicted, so the
+    table stays bounded whatever keys clients send.
+    """
+
+    def __init__(self, ttl, max_keys, prune_seconds):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.prune_seconds = prune_seconds
+        self._next_prune = time.time() + prune_seconds
+
+    def _cutoff(self):
+        return datetime.utcnow() - timedelta(seconds=self.ttl)
+
+    def lookup(self, user_id, key):
+        """The stored response for a key, or None if there is none or it expired"""
+        stored = IdempotencyKey.query.get((user_id, key))
+        if stored is not None and stored.created_at < self._cutoff():
+            # Not pruned yet; delete it with the transaction that reuses the key
+            db.session.delete(stored)
+            db.session.flush()
+            return None
+        return stored
+
+    def save(self, user_id, key, fingerprint, response):
+        """Add a response to the session, to be committed with the change it reports"""
+        db.session.add(IdempotencyKey(
+            user_id=user_id,
+            key=key,
+            fingerprint=fingerprint,
+            status=response.status_code,
+            body=response.get_data(as_text=True)
+        ))
+        now = time.time()
+        if now >= self._next_prune:
+            self._next_prune = now + self.prune_seconds
+            self._prune()
+
+    def _prune(self):
+        # Runs in the request's transaction: a separate connection would
+        # wait on the SQLite write lock this transaction already holds
+        keys = IdempotencyKey.__table__
+        db.session.execute(keys.delete().where(keys.c.created_at < self._cutoff()))
+        oldest_kept = select(keys.c.created_at).order_by(keys.c.created_at.desc()).offset(
+            self.max_keys - 1
+        ).limit(1).scalar_subquery()
+        db.session.execute(keys.delete().where(keys.c.created_at < oldest_kept))
+
+
+_init_lock = threading.Lock()
+
+
+def get_idempotency_store(app=None):
+    """Return the app's store of Idempotency-Key responses"""
+    app = app or current_app._get_current_object()
+    store = app.extensions.get('idempotency_store')
+    if store is None:
+        with _init_lock:
+            store = app.extensions.get('idempotency_store')
+            if store is None:
+                store = IdempotencyStore(
+                    ttl=app.config.get('IDEMPOTENCY_KEY_TTL', 86400),
+                    max_keys=app.config.get('IDEMPOTENCY_MAX_KEYS', 100000),
+                    prune_seconds=app.config.get('IDEMPOTENCY_PRUNE_SECONDS', 60)
+                )
+                app.extensions['idempotency_store'] = store
+    return store
+
+
+def request_fingerprint():
+    digest = hashlib.sha256(f'{request.method} {request.path}\n'.encode('utf-8'))
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _replay(stored, fingerprint):
+    if stored.fingerprint != fingerprint:
+        return jsonify({
+            'success': False,
+            'message': f'{IDEMPOTENCY_HEADER} was already used for a different request'
+        }), 422
+    response = current_app.response_class(stored.body, status=stored.status, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """Answer retries of a request with the same Idempotency-Key from the store.
+
+    The view saves its response with remember_response() in the
+    transaction that makes its change. A retry gets that response back
+    without the view running. Of concurrent duplicates only one can
+    commit the key, so the others roll back their change, fail, and are
+    answered with the winner's response instead.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({
+                'success': False,
+                'message': f'{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters'
+            }), 400
+
+        store = get_idempotency_store()
+        fingerprint = request_fingerprint()
+        stored = store.lookup(current_user.id, key)
+        if stored is not None:
+            return _replay(stored, fingerprint)
+
+        g.idempotency_key = (key, fingerprint)
+        response = make_response(view(*args, **kwargs))
+        if response.status_code >= 400:
+            # The failure may be a duplicate losing to one that committed first
+            stored = store.lookup(current_user.id, key)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+        return response
+    return wrapper
+
+
+def remember_response(response):
+    """Save a response for the request's Idempotency-Key, if it was sent with one.
+
+    Call before committing the change the response reports, so both are
+    committed together or not at all.
+    """
+    pending = g.get('idempotency_key')
+    if pending is None:
+        return
+    key, fingerprint = pending
+    get_idempotency_store().save(current_user.id, key, fingerprint, response)
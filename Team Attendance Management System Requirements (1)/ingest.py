@@ -0,0 +1,176 @@
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from app.models.models import User, Attendance, db
+from app.utils.geocoding import get_geocoder
+from app.utils.geofence import get_geofence_index, tag_site
+from app.utils.data_versions import bump_data_version
+from app.utils.status_events import status_changed
+from app.utils.rollups import record_sessions
+
+EVENT_TYPES = ('check_in', 'check_out')
+
+
+class BatchConflict(Exception):
+    """The batch raced another check-in/out and was rolled back"""
+
+
+def _parse_event(event):
+    """Validate one raw event, returning (user_id, type, timestamp) or raising ValueError"""
+    if not isinstance(event, dict):
+        raise ValueError('Event must be an object')
+
+    event_type = event.get('type')
+    if event_type not in EVENT_TYPES:
+        raise ValueError("type must be 'check_in' or 'check_out'")
+
+    try:
+        user_id = int(event.get('user_id'))
+    except (TypeError, ValueError):
+        raise ValueError('Missing or invalid user_id')
+
+    try:
+        timestamp = datetime.fromisoformat(event.get('timestamp'))
+    except (TypeError, ValueError):
+        raise ValueError('Missing or invalid timestamp')
+    if timestamp.tzinfo is not None:
+        raise ValueError('timestamp must be naive UTC')
+
+    return user_id, event_type, timestamp
+
+
+def ingest_events(events):
+    """Apply a batch of timestamped check-in/out events for many users.
+
+    Events are validated, then replayed per user in timestamp order
+    against the user's open session, so a check-out closes the check-in
+    before it whether that is in the batch or already in the database.
+    New sessions go out in one multi-row insert and closed existing
+    sessions in one executemany UPDATE, all in a single transaction.
+
+    Returns one result dict per event, in input order. Raises
+    BatchConflict if another request changed a user's open session
+    while the batch was being written.
+    """
+    results = [None] * len(events)
+    parsed = []
+    for position, event in enumerate(events):
+        try:
+            parsed.append((position, event) + _parse_event(event))
+        except ValueError as e:
+            results[position] = {'index': position, 'success': False, 'message': str(e)}
+
+    user_ids = {user_id for _, _, user_id, _, _ in parsed}
+    known_users = {
+        user_id for (user_id,) in
+        db.session.query(User.id).filter(User.id.in_(user_ids))
+    } if user_ids else set()
+    open_sessions = {
+        record.user_id: record for record in
+        Attendance.query.filter(
+            Attendance.user_id.in_(known_users),
+            Attendance.check_out_time.is_(None)
+        )
+    } if known_users else {}
+
+    by_user = defaultdict(list)
+    for item in parsed:
+        position, _, user_id, _, _ = item
+        if user_id not in known_users:
+            results[position] = {'index': position, 'success': False, 'message': 'Unknown user'}
+        else:
+            by_user[user_id].append(item)
+
+    geofences = get_geofence_index()
+    new_sessions = []
+    closed_sessions = []
+    closed_existing = []
+    outcome = {}
+
+    for user_id, items in by_user.items():
+        # Stable sort keeps input order for events with equal timestamps
+        items.sort(key=lambda item: item[4])
+        current = open_sessions.get(user_id)
+
+        for position, event, _, event_type, timestamp in items:
+            if event_type == 'check_in':
+                if current is not None:
+                    results[position] = {'index': position, 'success': False, 'message': 'Already checked in'}
+                    continue
+                record = Attendance(user_id=user_id, check_in_time=timestamp, notes=event.get('notes', ''))
+                try:
+                    record.set_location(event.get('latitude'), event.get('longitude'))
+                except (TypeError, ValueError):
+                    results[position] = {'index': position, 'success': False, 'message': 'Invalid location data'}
+                    continue
+                tag_site(record, geofences)
+                new_sessions.append(record)
+                outcome[position] = record
+                current = record
+            else:
+                if current is None:
+                    results[position] = {'index': position, 'success': False, 'message': 'No active check-in found'}
+                    continue
+                if timestamp <= current.check_in_time:
+                    results[position] = {'index': position, 'success': False, 'message': 'Check-out must follow check-in'}
+                    continue
+                if current.id is None:
+                    current.check_out_time = timestamp
+                else:
+                    closed_existing.append((current, timestamp))
+                closed_sessions.append(current)
+                outcome[position] = current
+                current = None
+
+    if closed_existing:
+        # Only close sessions that are still open; anything else is a race
+        statement = Attendance.__table__.update().where(
+            Attendance.id == bindparam('b_id'),
+            Attendance.check_out_time.is_(None)
+        ).values(check_out_time=bindparam('b_check_out_time'))
+        closed = db.session.execute(statement, [
+            {'b_id': record.id, 'b_check_out_time': timestamp}
+            for record, timestamp in closed_existing
+        ])
+        sane_rowcount = db.session.get_bind().dialect.supports_sane_multi_rowcount
+        if sane_rowcount and closed.rowcount != len(closed_existing):
+            db.session.rollback()
+            raise BatchConflict('An open session changed while the batch was applied')
+        for record, timestamp in closed_existing:
+            set_committed_value(record, 'check_out_time', timestamp)
+
+    geocoder = get_geocoder()
+    for record in new_sessions:
+        record.location_address = geocoder.cached(record.latitude, record.longitude)
+
+    db.session.add_all(new_sessions)
+    record_sessions(closed_sessions)
+    try:
+        db.session.flush()
+        # Read what we need now; the commit expires every instance
+        attendance_ids = {position: record.id for position, record in outcome.items()}
+        bump_data_version(by_user, set(attendance_ids.values()))
+        pending_addresses = [
+            (record.id, record.latitude, record.longitude)
+            for record in new_sessions if not record.location_address
+        ]
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise BatchConflict('A user checked in while the batch was applied')
+
+    for attendance_id, latitude, longitude in pending_addresses:
+        geocoder.enqueue(attendance_id, latitude, longitude)
+    for user_id in by_user:
+        status_changed(user_id)
+
+    for position, attendance_id in attendance_ids.items():
+        results[position] = {
+            'index': position,
+            'success': True,
+            'attendance_id': attendance_id,
+            'type': events[position]['type']
+        }
+    return results
@@ -0,0 +1,225 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import case
+from sqlalchemy.exc import IntegrityError
+from app.models.models import LoginBucket, db
+
+
+class MemoryStore:
+    """Token buckets in this worker's memory; each worker throttles on its own"""
+
+    def __init__(self, app, idle_seconds):
+        self.idle_seconds = idle_seconds
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._next_prune = time.time() + idle_seconds
+
+    def take(self, key, capacity, per_second, now):
+        """Take a token from a bucket, returning False when it is empty"""
+        with self._lock:
+            if now >= self._next_prune:
+                self._prune(now)
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * per_second)
+            if tokens < 1:
+                return False
+            self._buckets[key] = (tokens - 1, now)
+            return True
+
+    def give(self, key, capacity):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                self._buckets[key] = (min(capacity, bucket[0] + 1), bucket[1])
+
+    def _prune(self, now):
+        # A bucket idle this long has refilled completely, same as a missing one
+        cutoff = now - self.idle_seconds
+        for key in [key for key, (_, updated_at) in self._buckets.items() if updated_at < cutoff]:
+            del self._buckets[key]
+        self._next_prune = now + self.idle_seconds
+
+
+class DatabaseStore:
+    """Token buckets in the login_buckets table, shared by every worker.
+
+    Buckets are updated with single conditional statements on their own
+    connection, outside the request's transaction, so concurrent
+    attempts from any worker cannot take the same token twice.
+    """
+
+    def __init__(self, app, idle_seconds):
+        self.idle_seconds = idle_seconds
+        self._next_prune = time.time() + idle_seconds
+
+    def take(self, key, capacity, per_second, now):
+        table = LoginBucket.__table__
+        refilled = table.c.tokens + (now - table.c.updated_at) * per_second
+        with db.engine.begin() as connection:
+            if now >= self._next_prune:
+                self._next_prune = now + self.idle_seconds
+                connection.execute(table.delete().where(table.c.updated_at < now - self.idle_seconds))
+            taken = connection.execute(
+                table.update().where(table.c.key == key, refilled >= 1).values(
+                    tokens=case((refilled > capacity, capacity), else_=refilled) - 1,
+                    updated_at=now
+                )
+            ).rowcount
+        if taken:
+            return True
+
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.insert().values(key=key, tokens=capacity - 1, updated_at=now))
+        except IntegrityError:
+            # The bucket exists, so the update found it empty
+            return False
+        return True
+
+    def give(self, key, capacity):
+        table = LoginBucket.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                table.update().where(table.c.key == key, table.c.tokens <= capacity - 1).values(
+                    tokens=table.c.tokens + 1
+                )
+            )
+
+
+LOGIN_THROTTLE_STORES = {
+    'memory': MemoryStore,
+    'database': DatabaseStore,
+}
+
+
+class LoginLimiter:
+    """Token-bucket throttle for login attempts.
+
+    Every attempt takes a token from the client address's bucket and
+    from the username's bucket, before any password is hashed. A
+    successful login gives the username's token back, so only failed
+    attempts count against an account. The address keeps paying for
+    every attempt: one valid account must not buy a sprayer more tries
+    at others.
+    """
+
+    def __init__(self, store, user_burst, user_per_minute, address_burst, address_per_minute):
+        self.store = store
+        self.user_limit = (user_burst, user_per_minute / 60.0)
+        self.address_limit = (address_burst, address_per_minute / 60.0)
+
+    @staticmethod
+    def _user_key(username):
+        return f'user:{(username or "").lower()}'
+
+    def _buckets(self, username, address):
+        return (
+            (f'address:{address}', self.address_limit),
+            (self._user_key(username), self.user_limit),
+        )
+
+    def allow(self, username, address):
+        now = time.time()
+        # The address goes first, so one client spraying usernames cannot drain their buckets
+        for key, (capacity, per_second) in self._buckets(username, address):
+            if not self.store.take(key, capacity, per_second, now):
+                return False
+        return True
+
+    def succeeded(self, username, address):
+        self.store.give(self._user_key(username), self.user_limit[0])
+
+    def retry_after(self):
+        """Seconds until a throttled username gets its next attempt"""
+        return int(1 / self.user_limit[1]) + 1
+
+
+class HashingBusy(Exception):
+    """Every password-hashing slot is taken; the attempt should be retried later"""
+
+
+class HashExecutor:
+    """Runs password checks on a few threads with a bounded wait list.
+
+    pbkdf2 and scrypt release the GIL, so verification runs in parallel
+    with other requests, but never on more than `workers` threads of
+    this process. Attempts beyond the wait list, or that wait longer
+    than `wait` seconds for a slot, raise HashingBusy.
+    """
+
+    def __init__(self, workers, queue_size, wait):
+        self.wait = wait
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def run(self, function, *args):
+        if not self._slots.acquire(timeout=self.wait):
+            raise HashingBusy()
+        try:
+            return self._executor.submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+_init_lock = threading.Lock()
+
+
+def get_login_limiter(app=None):
+    """Return the app's login limiter, or None when LOGIN_THROTTLE_STORE is None"""
+    app = app or current_app._get_current_object()
+    store_name = app.config.get('LOGIN_THROTTLE_STORE', 'memory')
+    if store_name is None:
+        return None
+
+    limiter = app.extensions.get('login_limiter')
+    if limiter is None:
+        with _init_lock:
+            limiter = app.extensions.get('login_limiter')
+            if limiter is None:
+                config = app.config
+                user_burst = config.get('LOGIN_USER_BURST', 5)
+                user_per_minute = config.get('LOGIN_USER_PER_MINUTE', 1)
+                address_burst = config.get('LOGIN_ADDRESS_BURST', 50)
+                address_per_minute = config.get('LOGIN_ADDRESS_PER_MINUTE', 20)
+                # Long enough for either bucket to refill completely
+                idle_seconds = 60 * max(user_burst / user_per_minute, address_burst / address_per_minute)
+                limiter = LoginLimiter(
+                    LOGIN_THROTTLE_STORES[store_name](app, idle_seconds),
+                    user_burst, user_per_minute, address_burst, address_per_minute
+                )
+                app.extensions['login_limiter'] = limiter
+    return limiter
+
+
+def get_hash_executor(app=None):
+    """Return the app's password-checking executor, or None when LOGIN_HASH_WORKERS is 0"""
+    app = app or current_app._get_current_object()
+    workers = app.config.get('LOGIN_HASH_WORKERS', 2)
+    if not workers:
+        return None
+
+    executor = app.extensions.get('hash_executor')
+    if executor is None:
+        with _init_lock:
+            executor = app.extensions.get('hash_executor')
+            if executor is None:
+                executor = HashExecutor(
+                    workers,
+                    app.config.get('LOGIN_HASH_QUEUE', 8),
+                    app.config.get('LOGIN_HASH_WAIT', 1.0)
+                )
+                app.extensions['hash_executor'] = executor
+    return executor
+
+
+def verify_password(check, *args):
+    """Call `check(*args)` on the hashing executor, or inline without one"""
+    executor = get_hash_executor()
+    if executor is None:
+        return check(*args)
+    return executor.run(check, *args)
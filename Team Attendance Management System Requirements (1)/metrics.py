@@ -0,0 +1,233 @@
+import ipaddress
+import threading
+import time
+from bisect import bisect_left
+from flask import Blueprint, Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2)
+EXPORT_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+
+    def inc(self, labels=(), amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, labels=()):
+        series = self._series.get(labels)
+        if series is None:
+            # Per-bucket counts plus +Inf, then the sum
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, labels=()):
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = labels + (('le', bound),)
+                lines.append(f'{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+class Metrics:
+    """Per-process metrics, rendered in the Prometheus text format.
+
+    Each worker process keeps its own numbers; scrape every worker (or
+    sum per instance) when running more than one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter(
+            'http_requests_total', 'Requests by endpoint and status code')
+        self.request_seconds = Histogram(
+            'http_request_duration_seconds', 'Request latency by endpoint', LATENCY_BUCKETS)
+        self.sql_statements = Histogram(
+            'http_request_sql_statements', 'SQL statements executed per request', STATEMENT_BUCKETS)
+        self.sql_seconds = Histogram(
+            'http_request_sql_seconds', 'Time spent in SQL per request', LATENCY_BUCKETS)
+        self.geocoder_seconds = Histogram(
+            'geocoder_lookup_seconds', 'Reverse geocoding latency by backend', LATENCY_BUCKETS)
+        self.geocoder_errors = Counter(
+            'geocoder_errors_total', 'Failed reverse geocoding lookups by backend')
+        self.export_bytes = Histogram(
+            'export_size_bytes', 'Size of rendered exports by kind', SIZE_BUCKETS)
+        self.export_seconds = Histogram(
+            'export_duration_seconds', 'Time to render exports by kind', EXPORT_BUCKETS)
+
+    def observe_request(self, blueprint, endpoint, method, status, seconds, statements, sql_seconds):
+        labels = (('blueprint', blueprint), ('endpoint', endpoint), ('method', method))
+        with self._lock:
+            self.requests.inc(labels + (('status', status),))
+            self.request_seconds.observe(seconds, labels)
+            self.sql_statements.observe(statements, labels)
+            self.sql_seconds.observe(sql_seconds, labels)
+
+    def observe_geocoder(self, backend, seconds, failed=False):
+        labels = (('backend', backend),)
+        with self._lock:
+            self.geocoder_seconds.observe(seconds, labels)
+            if failed:
+                self.geocoder_errors.inc(labels)
+
+    def observe_export(self, kind, size, seconds):
+        labels = (('kind', kind),)
+        with self._lock:
+            self.export_bytes.observe(size, labels)
+            self.export_seconds.observe(seconds, labels)
+
+    def render(self, user_cache=None):
+        with self._lock:
+            lines = []
+            for metric in (self.requests, self.request_seconds, self.sql_statements,
+                           self.sql_seconds, self.geocoder_seconds, self.geocoder_errors,
+                           self.export_bytes, self.export_seconds):
+                lines.extend(metric.render())
+        if user_cache is not None:
+            # The cache keeps its own counts; render them as a counter
+            lookups = Counter('user_cache_lookups_total', 'Cached user loads by result')
+            lookups.inc((('result', 'hit'),), user_cache.hits)
+            lookups.inc((('result', 'miss'),), user_cache.misses)
+            lines.extend(lookups.render())
+        return '\n'.join(lines) + '\n'
+
+
+_init_lock = threading.Lock()
+
+
+def get_metrics(app=None):
+    app = app or current_app._get_current_object()
+    metrics = app.extensions.get('metrics')
+    if metrics is None:
+        with _init_lock:
+            metrics = app.extensions.get('metrics')
+            if metrics is None:
+                metrics = Metrics()
+                app.extensions['metrics'] = metrics
+    return metrics
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_statements' in g:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started or not has_request_context() or 'sql_statements' not in g:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    g.sql_statements += 1
+    g.sql_seconds += elapsed
+    if g.slow_queries is not None:
+        g.slow_queries.append((elapsed, statement))
+
+
+metrics = Blueprint('metrics', __name__)
+
+
+def _is_local_request():
+    """Whether the request comes straight from this host, not through a proxy"""
+    if 'X-Forwarded-For' in request.headers:
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr or '').is_loopback
+    except ValueError:
+        return False
+
+
+@metrics.route('/metrics')
+def metrics_endpoint():
+    # Without a token only scrapers on the same host get the numbers
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    elif not _is_local_request():
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    user_cache = current_app.extensions.get('user_cache')
+    return Response(get_metrics().render(user_cache), mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    """Record latency and SQL use for every request, and serve /metrics.
+
+    With SLOW_REQUEST_SECONDS set, requests slower than that are logged
+    together with the statements they ran.
+    """
+    app.register_blueprint(metrics)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+        g.slow_queries = [] if app.config.get('SLOW_REQUEST_SECONDS') is not None else None
+
+    @app.after_request
+    def record_request(response):
+        if 'request_started' not in g or request.endpoint == 'metrics.metrics_endpoint':
+            return response
+
+        elapsed = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or 'unmatched'
+        get_metrics(app).observe_request(
+            request.blueprint or '', endpoint, request.method,
+            response.status_code, elapsed, g.sql_statements, g.sql_seconds
+        )
+
+        # Streamed responses are timed up to their first byte only
+        threshold = app.config.get('SLOW_REQUEST_SECONDS')
+        if threshold is not None and elapsed >= threshold:
+            queries = '\n'.join(
+                f'  {seconds * 1000:.1f} ms  {statement}' for seconds, statement in g.slow_queries
+            )
+            app.logger.warning(
+                f"Slow request {request.method} {request.path} ({endpoint}): "
+                f"{elapsed * 1000:.0f} ms, {g.sql_statements} statements, "
+                f"{g.sql_seconds * 1000:.0f} ms in SQL\n{queries}"
+            )
+        return response
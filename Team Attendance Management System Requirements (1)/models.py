@@ -1,5 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import text
+from sqlalchemy.orm import deferred
 from datetime import datetime
 import json
 
@@ -14,6 +16,9 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(120), unique=True, nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped whenever the user's attendance data changes; drives ETags
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    data_modified_at = db.Column(db.DateTime, nullable=True)
     
     # Relationship with attendance records
     attendance_records = db.relationship('Attendance', backref='user', lazy=True)
@@ -22,26 +27,76 @@ class User(db.Model, UserMixin):
         return f'<User {self.username}>'
 
 
+# Check-ins are bucketed into a grid of 0.01 degree cells (about 1km of
+# latitude) so location searches can use an index instead of a full scan
+GRID_CELL_DEGREES = 0.01
+GRID_COLUMNS = 36000
+
+def grid_cell(latitude, longitude):
+    """Index of the grid cell containing a point"""
+    row = int((latitude + 90) / GRID_CELL_DEGREES)
+    column = int((longitude + 180) / GRID_CELL_DEGREES)
+    return row * GRID_COLUMNS + column
+
+
 class Attendance(db.Model):
     __tablename__ = 'attendance'
+    __table_args__ = (
+        # Partial index: finds a user's open session without scanning their
+        # history, and guarantees there is never more than one
+        db.Index(
+            'uq_attendance_open_session',
+            'user_id',
+            unique=True,
+            sqlite_where=text('check_out_time IS NULL'),
+            postgresql_where=text('check_out_time IS NULL')
+        ),
+        # Index names match the SQL migrations
+        db.Index('idx_attendance_user_check_in', 'user_id', 'check_in_time'),
+        db.Index('idx_attendance_check_in_time', 'check_in_time'),
+        db.Index('idx_attendance_grid_cell', 'grid_cell'),
+        db.Index('idx_attendance_user_change', 'user_id', 'change_seq'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     check_in_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     check_out_time = db.Column(db.DateTime, nullable=True)
-    location_data = db.Column(db.Text, nullable=False)  # JSON string with lat/long
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    grid_cell = db.Column(db.Integer, nullable=True)
+    # Site the check-in fell in; off_site is None until geofences are evaluated
+    site_id = db.Column(db.Integer, db.ForeignKey('sites.id'), nullable=True)
+    off_site = db.Column(db.Boolean, nullable=True)
+    # Legacy JSON copy of the location, still written for the D1 frontend but
+    # never loaded on listing paths
+    location_data = deferred(db.Column(db.Text, nullable=False))
     location_address = db.Column(db.String(255), nullable=True)
     notes = db.Column(db.Text, nullable=True)
+    # The user's data_version when the row was last inserted or updated;
+    # delta sync returns the rows changed since a client's last version
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     def set_location(self, latitude, longitude):
-        """Store location data as JSON string"""
+        """Store the location, raising ValueError for non-numeric coordinates"""
+        latitude = float(latitude)
+        longitude = float(longitude)
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            raise ValueError('Coordinates out of range')
+        
+        self.latitude = latitude
+        self.longitude = longitude
+        self.grid_cell = grid_cell(latitude, longitude)
         self.location_data = json.dumps({
             'latitude': latitude,
             'longitude': longitude
         })
     
     def get_location(self):
-        """Retrieve location data from JSON string"""
+        """Return the location as a latitude/longitude dict"""
+        if self.latitude is not None:
+            return {'latitude': self.latitude, 'longitude': self.longitude}
+        # Rows written before the location columns existed
         if self.location_data:
             return json.loads(self.location_data)
         return None
@@ -55,3 +110,107 @@ class Attendance(db.Model):
     
     def __repr__(self):
         return f'<Attendance {self.id} for User {self.user_id}>'
+
+
+class Site(db.Model):
+    """Work site a check-in can be matched to, either a circle or a polygon"""
+    __tablename__ = 'sites'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), unique=True, nullable=False)
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    radius_m = db.Column(db.Float, nullable=True)
+    polygon = db.Column(db.Text, nullable=True)  # JSON list of [lat, long] vertices
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def set_polygon(self, vertices):
+        """Store polygon vertices as JSON string"""
+        self.polygon = json.dumps([[float(lat), float(lon)] for lat, lon in vertices])
+    
+    def get_polygon(self):
+        """Retrieve polygon vertices from JSON string"""
+        if self.polygon:
+            return json.loads(self.polygon)
+        return None
+    
+    def __repr__(self):
+        return f'<Site {self.name}>'
+
+
+class DailyAttendance(db.Model):
+    """Per-user, per-day rollup of completed attendance sessions"""
+    __tablename__ = 'daily_attendance'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'day', name='uq_daily_attendance_user_day'),
+        db.Index('idx_daily_attendance_day', 'day'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    sessions = db.Column(db.Integer, nullable=False, default=0)
+    total_hours = db.Column(db.Float, nullable=False, default=0)
+    first_check_in = db.Column(db.DateTime, nullable=True)
+    last_check_out = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<DailyAttendance {self.day} for User {self.user_id}>'
+
+
+class ExportJob(db.Model):
+    """Background CSV/PDF export; the id is a hash of its parameters"""
+    __tablename__ = 'export_jobs'
+    __table_args__ = (
+        db.Index('idx_export_jobs_status_accessed', 'status', 'last_accessed'),
+    )
+    
+    id = db.Column(db.String(64), primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)
+    params = db.Column(db.Text, nullable=False)  # JSON string with the report parameters
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    path = db.Column(db.String(255), nullable=True)
+    size = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    last_accessed = db.Column(db.DateTime, nullable=True)
+    
+    def get_params(self):
+        """Retrieve report parameters from JSON string"""
+        return json.loads(self.params)
+    
+    def __repr__(self):
+        return f'<ExportJob {self.id} {self.status}>'
+
+
+class LoginBucket(db.Model):
+    """Login attempt token bucket, shared by every worker with LOGIN_THROTTLE_STORE = 'database'"""
+    __tablename__ = 'login_buckets'
+    
+    key = db.Column(db.String(255), primary_key=True)  # 'user:<name>' or 'address:<ip>'
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)  # Unix time of the last refill
+    
+    def __repr__(self):
+        return f'<LoginBucket {self.key} {self.tokens:.1f}>'
+
+
+class IdempotencyKey(db.Model):
+    """Stored response of a request sent with an Idempotency-Key header"""
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        db.Index('idx_idempotency_keys_created_at', 'created_at'),
+    )
+    
+    # The primary key is what stops two concurrent duplicates from both applying
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)  # sha256 of method, path and body
+    status = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<IdempotencyKey {self.user_id} {self.key}>'
@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import defaultdict
+from flask import current_app
+from app.models.models import Attendance
+
+
+class OpenSessionCache:
+    """Per-worker cache of each user's attendance status.
+
+    Every invalidation bumps the user's version, and a status computed
+    from the database is only stored if the version has not moved since
+    the read started, so a check-in racing a status poll can never leave
+    the old status cached. Entries expire after `ttl` seconds, which
+    bounds how long another worker's check-in can go unnoticed.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def version(self, user_id):
+        with self._lock:
+            return self._versions[user_id]
+
+    def set(self, user_id, status, version):
+        with self._lock:
+            if self._versions[user_id] == version:
+                self._entries[user_id] = (status, time.monotonic() + self.ttl)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._versions[user_id] += 1
+            self._entries.pop(user_id, None)
+
+
+_init_lock = threading.Lock()
+
+
+def get_open_session_cache(app=None):
+    app = app or current_app._get_current_object()
+    cache = app.extensions.get('open_sessions')
+    if cache is None:
+        with _init_lock:
+            cache = app.extensions.get('open_sessions')
+            if cache is None:
+                cache = OpenSessionCache(ttl=app.config.get('OPEN_SESSION_CACHE_TTL', 30))
+                app.extensions['open_sessions'] = cache
+    return cache
+
+
+def open_session_status(user_id):
+    """Return the status payload for a user, from the cache when possible"""
+    cache = get_open_session_cache()
+    status = cache.get(user_id)
+    if status is not None:
+        return status
+
+    version = cache.version(user_id)
+    open_attendance = Attendance.query.filter_by(
+        user_id=user_id,
+        check_out_time=None
+    ).first()
+
+    if open_attendance:
+        status = {
+            'status': 'checked_in',
+            'check_in_time': open_attendance.check_in_time.isoformat(),
+            'location': open_attendance.get_location(),
+            'location_address': open_attendance.location_address
+        }
+    else:
+        status = {'status': 'checked_out'}
+
+    cache.set(user_id, status, version)
+    return status
+
+
+def invalidate_open_session(user_id, app=None):
+    """Drop a user's cached status; call after committing a check-in/out"""
+    get_open_session_cache(app).invalidate(user_id)
@@ -0,0 +1,238 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib import colors
+from app.models.models import User, Attendance, db
+from app.utils.queries import attendance_with_users
+from app.utils.archive import with_archived
+from app.utils.rollups import summarize
+
+try:
+    from pypdf import PdfWriter
+except ImportError:  # pragma: no cover - sections are then rendered in-process
+    PdfWriter = None
+
+SECTION_FETCH_SIZE = 1000
+
+# Every web worker process gets its own pool, so keep the default small
+DEFAULT_PDF_WORKERS = 2
+
+TABLE_HEADER = ['ID', 'Username', 'Check-in Time', 'Check-out Time', 'Duration (hours)', 'Location', 'Notes']
+
+TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 12),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 1), (-1, -1), 10),
+    ('TOPPADDING', (0, 1), (-1, -1), 8),
+    ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
+])
+
+
+def table_row(record):
+    """Format an attendance record (with its user loaded) as a table row"""
+    location = record.get_location()
+    location_str = f"{location['latitude']}, {location['longitude']}" if location else "N/A"
+    if record.location_address:
+        location_str = record.location_address
+
+    return [
+        str(record.id),
+        record.user.username,
+        record.check_in_time.strftime('%Y-%m-%d %H:%M:%S'),
+        record.check_out_time.strftime('%Y-%m-%d %H:%M:%S') if record.check_out_time else 'N/A',
+        str(record.duration()) if record.duration() else 'N/A',
+        location_str,
+        record.notes or ''
+    ]
+
+
+def section_flowables(title, rows):
+    """Heading plus a table whose header repeats on every page"""
+    styles = getSampleStyleSheet()
+    table = Table([TABLE_HEADER] + rows, repeatRows=1)
+    table.setStyle(TABLE_STYLE)
+    return [Paragraph(title, styles['Heading2']), Spacer(1, 6), table]
+
+
+def render_section(title, rows, path):
+    """Render one section to its own PDF file; runs in a worker process"""
+    doc = SimpleDocTemplate(path, pagesize=letter)
+    doc.build(section_flowables(title, rows))
+    return path
+
+
+def iter_sections(start_date, end_date, user_id=None, section='week'):
+    """Yield (title, rows) sections of a report from one streamed query.
+
+    Sections are per week (Monday to Sunday, clipped to the range),
+    newest first, or per user by username. Only the current section's
+    rows are held in memory.
+    """
+    start_datetime = datetime.combine(start_date, datetime.min.time())
+    end_datetime = datetime.combine(end_date, datetime.max.time())
+    query = attendance_with_users(start_datetime, end_datetime, user_id)
+    if section == 'user':
+        query = query.order_by(None).order_by(User.username, Attendance.check_in_time.desc())
+
+    title = None
+    rows = []
+    records = with_archived(
+        query.yield_per(SECTION_FETCH_SIZE), start_datetime, end_datetime, user_id, by_user=section == 'user'
+    )
+    for record in records:
+        if section == 'user':
+            record_title = record.user.username
+        else:
+            day = record.check_in_time.date()
+            week_start = max(day - timedelta(days=day.weekday()), start_date)
+            record_title = f"Week of {week_start.strftime('%Y-%m-%d')}"
+
+        if record_title != title and rows:
+            yield title, rows
+            rows = []
+        title = record_title
+        rows.append(table_row(record))
+
+    if rows:
+        yield title, rows
+
+
+def summary_flowables(report_title, start_date, end_date, total_records, total_hours, section_counts):
+    styles = getSampleStyleSheet()
+    elements = [
+        Paragraph(report_title, styles['Title']),
+        Paragraph(f"Period: {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}", styles['Normal']),
+        Spacer(1, 12),
+        Paragraph(f"Total Records: {total_records}", styles['Normal']),
+        Paragraph(f"Total Hours: {total_hours:.2f}", styles['Normal']),
+        Spacer(1, 12),
+    ]
+    if section_counts:
+        table = Table([['Section', 'Records']] + [[title, str(count)] for title, count in section_counts], repeatRows=1)
+        table.setStyle(TABLE_STYLE)
+        elements.append(table)
+    return elements
+
+
+_pool_lock = threading.Lock()
+
+
+def pdf_workers(app=None):
+    """Configured number of section rendering processes"""
+    app = app or current_app
+    return app.config.get('PDF_WORKERS', DEFAULT_PDF_WORKERS)
+
+
+def get_pdf_pool(app=None):
+    """Process pool for section rendering, or None when it is disabled"""
+    app = app or current_app._get_current_object()
+    workers = pdf_workers(app)
+    if PdfWriter is None or workers < 2:
+        return None
+
+    pool = app.extensions.get('pdf_pool')
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get('pdf_pool')
+            if pool is None:
+                # spawn: forking a process with live DB connections and threads is unsafe
+                pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                app.extensions['pdf_pool'] = pool
+    return pool
+
+
+def write_pdf(output, start_date, end_date, user_id=None, section=None):
+    """Render the attendance report for a date range into `output`.
+
+    `output` is a file name or a writable binary file object; an
+    unknown `user_id` raises LookupError. The report
+    is split into per-user sections ('user', the default for all users)
+    or per-week sections ('week', the default for one user). With a process pool
+    (PDF_WORKERS > 1 and pypdf installed) sections are laid out in
+    parallel, at most two per worker in flight, and merged behind a
+    summary page; otherwise they are laid out in-process as separate
+    tables, which still avoids laying out one enormous table.
+    """
+    if user_id and user_id != 'all':
+        user = db.session.get(User, int(user_id)) if str(user_id).isdigit() else None
+        if user is None:
+            raise LookupError(f'No user with id {user_id}')
+        report_title = f"Attendance Report for {user.username}"
+    else:
+        report_title = "Attendance Report for All Users"
+
+    if section is None:
+        section = 'week' if user_id and user_id != 'all' else 'user'
+
+    # Total hours come from the daily rollups
+    total_hours = summarize(start_date, end_date, user_id)['total_hours']
+    sections = iter_sections(start_date, end_date, user_id, section)
+    pool = get_pdf_pool()
+
+    if pool is None:
+        section_counts = []
+        elements = []
+        for title, rows in sections:
+            section_counts.append((title, len(rows)))
+            elements.append(PageBreak())
+            elements.extend(section_flowables(title, rows))
+
+        total_records = sum(count for _, count in section_counts)
+        doc = SimpleDocTemplate(output, pagesize=letter)
+        doc.build(summary_flowables(report_title, start_date, end_date, total_records, total_hours, section_counts) + elements)
+        return
+
+    directory = tempfile.mkdtemp(prefix='report-')
+    try:
+        section_counts = []
+        section_paths = []
+        in_flight = deque()
+        max_in_flight = pdf_workers() * 2
+
+        for title, rows in sections:
+            section_counts.append((title, len(rows)))
+
+            path = os.path.join(directory, f'section-{len(section_paths):05d}.pdf')
+            section_paths.append(path)
+            in_flight.append(pool.submit(render_section, title, rows, path))
+
+            # Bound memory by not queueing more sections than the pool can take
+            while len(in_flight) >= max_in_flight:
+                in_flight.popleft().result()
+
+        while in_flight:
+            in_flight.popleft().result()
+
+        summary_path = os.path.join(directory, 'summary.pdf')
+        total_records = sum(count for _, count in section_counts)
+        SimpleDocTemplate(summary_path, pagesize=letter).build(
+            summary_flowables(report_title, start_date, end_date, total_records, total_hours, section_counts)
+        )
+
+        writer = PdfWriter()
+        for path in [summary_path] + section_paths:
+            writer.append(path)
+        writer.write(output)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
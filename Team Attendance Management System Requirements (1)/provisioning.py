@@ -0,0 +1,193 @@
+import csv
+import io
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+from app.models.models import User, db
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
+FALSE_VALUES = ('', '0', 'false', 'no', 'n')
+
+
+class ImportConflict(Exception):
+    """A username or email was taken while the import ran; nothing was created"""
+
+
+def read_users_csv(text):
+    """Rows of a CSV with username, email, password and optional is_admin columns"""
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def _column_field(row, name):
+    value = row.get(name)
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('Missing required fields')
+    value = value.strip()
+    limit = User.__table__.c[name].type.length
+    if len(value) > limit:
+        raise ValueError(f'{name} must be at most {limit} characters')
+    return value
+
+
+def _parse_user(row):
+    """Validate one row, returning (username, email, password, is_admin) or raising ValueError"""
+    if not isinstance(row, dict):
+        raise ValueError('User must be an object')
+
+    username = _column_field(row, 'username')
+    email = _column_field(row, 'email')
+    password = row.get('password')
+    if not isinstance(password, str) or not password:
+        raise ValueError('Missing required fields')
+
+    is_admin = row.get('is_admin')
+    if isinstance(is_admin, str) and is_admin.strip().lower() in TRUE_VALUES + FALSE_VALUES:
+        is_admin = is_admin.strip().lower() in TRUE_VALUES
+    elif is_admin is None:
+        is_admin = False
+    elif not isinstance(is_admin, bool):
+        raise ValueError('is_admin must be true or false')
+
+    return username, email, password, is_admin
+
+
+def hash_password(password, method):
+    return generate_password_hash(password, method=method)
+
+
+_pool_lock = threading.Lock()
+
+
+def hash_workers(app):
+    return app.config.get('HASH_WORKERS', os.cpu_count() or 1)
+
+
+def get_hash_pool(app=None):
+    """Process pool for password hashing, or None when it is disabled"""
+    app = app or current_app._get_current_object()
+    workers = hash_workers(app)
+    if workers < 2:
+        return None
+
+    pool = app.extensions.get('hash_pool')
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get('hash_pool')
+            if pool is None:
+                # spawn: forking a process with live DB connections and threads is unsafe
+                pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                app.extensions['hash_pool'] = pool
+    return pool
+
+
+def hash_passwords(passwords, app=None):
+    """Hash passwords with PASSWORD_HASH_METHOD, across the hash pool when there is one"""
+    app = app or current_app._get_current_object()
+    method = app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+    pool = get_hash_pool(app)
+    if pool is None or len(passwords) < 2:
+        return [hash_password(password, method) for password in passwords]
+
+    # pbkdf2 is pure CPU; chunks keep per-task pickling overhead negligible
+    chunksize = max(1, len(passwords) // (hash_workers(app) * 4))
+    return list(pool.map(hash_password, passwords, repeat(method), chunksize=chunksize))
+
+
+def import_users(rows):
+    """Create many users in one transaction.
+
+    Rows are validated, then checked against each other and, in a
+    single query, against existing usernames and emails. Passwords of
+    the accepted rows are hashed in parallel and the users inserted
+    together.
+
+    Returns one result dict per row, in input order. Raises
+    ImportConflict if a username or email was taken concurrently, in
+    which case no user is created.
+    """
+    results = [None] * len(rows)
+    parsed = []
+    for position, row in enumerate(rows):
+        try:
+            parsed.append((position,) + _parse_user(row))
+        except ValueError as e:
+            results[position] = {'index': position, 'success': False, 'message': str(e)}
+
+    usernames = {username for _, username, _, _, _ in parsed}
+    emails = {email for _, _, email, _, _ in parsed}
+    taken = db.session.query(User.username, User.email).filter(
+        or_(User.username.in_(usernames), User.email.in_(emails))
+    ).all() if parsed else []
+    taken_usernames = {username for username, _ in taken}
+    taken_emails = {email for _, email in taken}
+
+    accepted = []
+    for position, username, email, password, is_admin in parsed:
+        if username in taken_usernames:
+            message = 'Username already exists'
+        elif email in taken_emails:
+            message = 'Email already exists'
+        else:
+            # Later rows with the same username or email lose to the first
+            taken_usernames.add(username)
+            taken_emails.add(email)
+            accepted.append((position, username, email, password, is_admin))
+            continue
+        results[position] = {'index': position, 'success': False, 'message': message}
+
+    hashes = hash_passwords([password for _, _, _, password, _ in accepted])
+    users = [
+        User(username=username, email=email, password=password_hash, is_admin=is_admin)
+        for (_, username, email, _, is_admin), password_hash in zip(accepted, hashes)
+    ]
+
+    db.session.add_all(users)
+    try:
+        db.session.flush()
+        # Read what we need now; the commit expires every instance
+        created = [(position, user.id, user.username) for (position, *_), user in zip(accepted, users)]
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise ImportConflict('A username or email was taken while the import ran')
+
+    for position, user_id, username in created:
+        results[position] = {'index': position, 'success': True, 'user_id': user_id, 'username': username}
+    return results
+
+
+@click.command('import-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def import_users_command(path):
+    """Create users from a CSV file or a JSON list of user objects."""
+    with open(path, encoding='utf-8') as f:
+        if path.lower().endswith('.json'):
+            rows = json.load(f)
+            if not isinstance(rows, list):
+                raise click.ClickException('Expected a JSON list of users')
+        else:
+            rows = read_users_csv(f.read())
+
+    try:
+        results = import_users(rows)
+    except ImportConflict as e:
+        raise click.ClickException(str(e))
+
+    for result in results:
+        if not result['success']:
+            click.echo(f"Row {result['index'] + 1}: {result['message']}", err=True)
+    created = sum(1 for result in results if result['success'])
+    click.echo(f'Created {created} users, rejected {len(results) - created}')
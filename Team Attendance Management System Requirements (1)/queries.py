@@ -0,0 +1,247 @@
+import base64
+import binascii
+import json
+import math
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import contains_eager
+from app.models.models import Attendance, GRID_CELL_DEGREES, GRID_COLUMNS
+
+EARTH_RADIUS_M = 6371000
+
+# Beyond this many grid cells the cell list stops being selective
+MAX_SEARCH_CELLS = 1000
+
+
+def report_date_range(args, default_days):
+    """Parse start_date/end_date query parameters into dates.
+
+    Missing values default to the last `default_days` days.
+    """
+    start_date_str = args.get('start_date')
+    end_date_str = args.get('end_date')
+
+    today = datetime.utcnow().date()
+    if not start_date_str:
+        start_date = today - timedelta(days=default_days)
+    else:
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+
+    if not end_date_str:
+        end_date = today
+    else:
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+
+    return start_date, end_date
+
+
+def attendance_with_users(start_datetime=None, end_datetime=None, user_id=None):
+    """Attendance records joined to their users, newest first.
+
+    The user is loaded in the same statement, so `record.user.username`
+    does not issue a query per row.
+    """
+    query = Attendance.query.join(Attendance.user).options(
+        contains_eager(Attendance.user)
+    )
+
+    if start_datetime:
+        query = query.filter(Attendance.check_in_time >= start_datetime)
+
+    if end_datetime:
+        query = query.filter(Attendance.check_in_time <= end_datetime)
+
+    if user_id and user_id != 'all':
+        query = query.filter(Attendance.user_id == int(user_id))
+
+    return query.order_by(Attendance.check_in_time.desc())
+
+
+def encode_cursor(record):
+    """Opaque cursor pointing just past `record` in newest-first order"""
+    payload = json.dumps([record.check_in_time.isoformat(), record.id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into (check_in_time, id), raising ValueError if invalid"""
+    try:
+        check_in_time, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(check_in_time), int(record_id)
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+
+def _newest_first(query):
+    return query.order_by(None).order_by(
+        Attendance.check_in_time.desc(),
+        Attendance.id.desc()
+    )
+
+
+def _older_than(check_in_time, record_id):
+    return or_(
+        Attendance.check_in_time < check_in_time,
+        and_(
+            Attendance.check_in_time == check_in_time,
+            Attendance.id < record_id
+        )
+    )
+
+
+def keyset_page(query, cursor=None, limit=100):
+    """Fetch one page of an attendance query, newest first.
+
+    Returns the records and the cursor for the next page, which is None
+    on the last page.
+    """
+    query = _newest_first(query)
+    if cursor:
+        query = query.filter(_older_than(*decode_cursor(cursor)))
+
+    # Fetch one extra row to know whether another page follows
+    records = query.limit(limit + 1).all()
+    if len(records) > limit:
+        records = records[:limit]
+        return records, encode_cursor(records[-1])
+    return records, None
+
+
+def iter_keyset(query, page_size=1000):
+    """Iterate an attendance query newest first, one page at a time.
+
+    Each page is fetched with a keyset condition on (check_in_time, id)
+    rather than OFFSET, so only `page_size` rows are held at once and
+    every page costs the same no matter how deep into the range it is.
+    """
+    query = _newest_first(query)
+
+    last = None
+    while True:
+        page_query = query
+        if last is not None:
+            page_query = page_query.filter(_older_than(last.check_in_time, last.id))
+
+        records = page_query.limit(page_size).all()
+        yield from records
+
+        if len(records) < page_size:
+            return
+        last = records[-1]
+
+
+def encode_change_cursor(record):
+    """Opaque cursor pointing just past `record` in change order"""
+    payload = json.dumps([record.change_seq, record.id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_change_cursor(cursor):
+    """Decode a change cursor into (change_seq, id), raising ValueError if invalid"""
+    try:
+        change_seq, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return int(change_seq), int(record_id)
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+
+def changes_since(query, since=None, cursor=None, limit=100):
+    """Fetch one page of an attendance query's records changed after `since`.
+
+    Records come in change order, (change_seq, id), which the
+    (user_id, change_seq) index serves for one user's records; without
+    `since` all of them are fetched. Returns the records, the cursor
+    for the next page (None on the last page) and the watermark to send
+    as `since` next time. One change can span pages, so the watermark
+    only moves past `since` on the last page.
+    """
+    query = query.order_by(None).order_by(Attendance.change_seq, Attendance.id)
+    watermark = 0
+    if since is not None:
+        query = query.filter(Attendance.change_seq > since)
+        watermark = since
+    if cursor:
+        change_seq, record_id = decode_change_cursor(cursor)
+        query = query.filter(or_(
+            Attendance.change_seq > change_seq,
+            and_(Attendance.change_seq == change_seq, Attendance.id > record_id)
+        ))
+        watermark = max(watermark, change_seq)
+
+    records = query.limit(limit + 1).all()
+    if len(records) > limit:
+        records = records[:limit]
+        return records, encode_change_cursor(records[-1]), since or 0
+    if records:
+        watermark = max(watermark, records[-1].change_seq)
+    return records, None, watermark
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in metres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def _longitude_ranges(longitude, lon_delta):
+    """The search box's longitude span as one or two ranges within ±180°"""
+    if lon_delta >= 180:
+        return [(-180, 180)]
+    low, high = longitude - lon_delta, longitude + lon_delta
+    # A box crossing the antimeridian continues on the other side
+    if low < -180:
+        return [(low + 360, 180), (-180, high)]
+    if high > 180:
+        return [(low, 180), (-180, high - 360)]
+    return [(low, high)]
+
+
+def attendance_near(query, latitude, longitude, radius_m, cursor=None, limit=100):
+    """One page of records from `query` checked in within `radius_m` metres of a point.
+
+    The grid cells covering the search circle's bounding box are matched
+    in SQL, then the candidates are filtered by exact distance. Returns
+    (record, distance) pairs, newest first, and the cursor for the next
+    page, which is None on the last page.
+    """
+    lat_delta = math.degrees(radius_m / EARTH_RADIUS_M)
+    min_lat, max_lat = max(latitude - lat_delta, -90), min(latitude + lat_delta, 90)
+    if min_lat == -90 or max_lat == 90:
+        # The circle covers a pole and so every longitude
+        lon_ranges = [(-180, 180)]
+    else:
+        lon_delta = lat_delta / math.cos(math.radians(latitude))
+        lon_ranges = _longitude_ranges(longitude, lon_delta)
+
+    query = query.filter(
+        Attendance.latitude.between(min_lat, max_lat),
+        or_(*[Attendance.longitude.between(low, high) for low, high in lon_ranges])
+    )
+
+    # One extra cell on each side absorbs rounding at cell edges
+    rows = range(int((min_lat + 90) / GRID_CELL_DEGREES) - 1, int((max_lat + 90) / GRID_CELL_DEGREES) + 2)
+    columns = set()
+    for low, high in lon_ranges:
+        first_column = max(int((low + 180) / GRID_CELL_DEGREES) - 1, 0)
+        last_column = min(int((high + 180) / GRID_CELL_DEGREES) + 1, GRID_COLUMNS - 1)
+        columns.update(range(first_column, last_column + 1))
+    if len(rows) * len(columns) <= MAX_SEARCH_CELLS:
+        cells = [row * GRID_COLUMNS + column for row in rows for column in sorted(columns)]
+        query = query.filter(Attendance.grid_cell.in_(cells))
+
+    if cursor:
+        query = query.filter(_older_than(*decode_cursor(cursor)))
+
+    # Collect one extra match to know whether another page follows
+    matches = []
+    for record in iter_keyset(query, page_size=limit + 1):
+        distance = distance_m(latitude, longitude, record.latitude, record.longitude)
+        if distance <= radius_m:
+            matches.append((record, distance))
+            if len(matches) > limit:
+                matches = matches[:limit]
+                return matches, encode_cursor(matches[-1][0])
+    return matches, None
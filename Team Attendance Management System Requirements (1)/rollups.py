@@ -0,0 +1,134 @@
+from collections import defaultdict
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func
+from app.models.models import Attendance, DailyAttendance, db
+from app.utils.queries import iter_keyset
+from app.utils.archive import with_archived
+
+
+def _add_session(rollup, record):
+    rollup.sessions += 1
+    rollup.total_hours += record.duration() or 0
+    if rollup.first_check_in is None or record.check_in_time < rollup.first_check_in:
+        rollup.first_check_in = record.check_in_time
+    if rollup.last_check_out is None or record.check_out_time > rollup.last_check_out:
+        rollup.last_check_out = record.check_out_time
+
+
+def record_session(record):
+    """Add a completed attendance session to its day's rollup.
+
+    Called when a session is checked out; the caller commits. Sessions
+    are attributed to the day they were checked in on, like the reports.
+    """
+    day = record.check_in_time.date()
+    rollup = DailyAttendance.query.filter_by(user_id=record.user_id, day=day).first()
+    if rollup is None:
+        rollup = DailyAttendance(user_id=record.user_id, day=day, sessions=0, total_hours=0)
+        db.session.add(rollup)
+
+    _add_session(rollup, record)
+
+
+def record_sessions(records):
+    """Add many completed sessions to their rollups with a single lookup"""
+    by_key = defaultdict(list)
+    for record in records:
+        by_key[(record.user_id, record.check_in_time.date())].append(record)
+    if not by_key:
+        return
+
+    existing = {
+        (rollup.user_id, rollup.day): rollup
+        for rollup in DailyAttendance.query.filter(
+            DailyAttendance.user_id.in_({user_id for user_id, _ in by_key}),
+            DailyAttendance.day.in_({day for _, day in by_key})
+        )
+    }
+
+    for (user_id, day), sessions in by_key.items():
+        rollup = existing.get((user_id, day))
+        if rollup is None:
+            rollup = DailyAttendance(user_id=user_id, day=day, sessions=0, total_hours=0)
+            db.session.add(rollup)
+        for record in sessions:
+            _add_session(rollup, record)
+
+
+def summarize(start_date, end_date, user_id=None):
+    """Total sessions and hours between two dates, read from the rollups"""
+    query = db.session.query(
+        func.coalesce(func.sum(DailyAttendance.sessions), 0),
+        func.coalesce(func.sum(DailyAttendance.total_hours), 0)
+    ).filter(
+        DailyAttendance.day >= start_date,
+        DailyAttendance.day <= end_date
+    )
+
+    if user_id and user_id != 'all':
+        query = query.filter(DailyAttendance.user_id == int(user_id))
+
+    sessions, total_hours = query.one()
+    return {'sessions': sessions, 'total_hours': round(total_hours, 2)}
+
+
+def rebuild_rollups(start_date=None, end_date=None):
+    """Recompute the rollups from raw attendance records.
+
+    Only days between `start_date` and `end_date` (inclusive, either may
+    be open) are replaced. Returns the number of rollup rows written.
+    """
+    query = Attendance.query.filter(Attendance.check_out_time.isnot(None))
+    stale = DailyAttendance.query
+    start_datetime = end_datetime = None
+
+    if start_date:
+        start_datetime = datetime.combine(start_date, datetime.min.time())
+        query = query.filter(Attendance.check_in_time >= start_datetime)
+        stale = stale.filter(DailyAttendance.day >= start_date)
+
+    if end_date:
+        end_datetime = datetime.combine(end_date, datetime.max.time())
+        query = query.filter(Attendance.check_in_time <= end_datetime)
+        stale = stale.filter(DailyAttendance.day <= end_date)
+
+    rollups = {}
+    # Archived sessions count too, or a rebuild would wipe their days
+    for record in with_archived(iter_keyset(query), start_datetime, end_datetime):
+        key = (record.user_id, record.check_in_time.date())
+        rollup = rollups.get(key)
+        if rollup is None:
+            rollup = rollups[key] = {
+                'user_id': record.user_id,
+                'day': key[1],
+                'sessions': 0,
+                'total_hours': 0,
+                'first_check_in': record.check_in_time,
+                'last_check_out': record.check_out_time
+            }
+        rollup['sessions'] += 1
+        rollup['total_hours'] += record.duration() or 0
+        rollup['first_check_in'] = min(rollup['first_check_in'], record.check_in_time)
+        rollup['last_check_out'] = max(rollup['last_check_out'], record.check_out_time)
+
+    stale.delete(synchronize_session=False)
+    if rollups:
+        db.session.execute(DailyAttendance.__table__.insert(), list(rollups.values()))
+    db.session.commit()
+
+    return len(rollups)
+
+
+@click.command('rebuild-rollups')
+@click.option('--start-date', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+@click.option('--end-date', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+@with_appcontext
+def rebuild_rollups_command(start_date, end_date):
+    """Backfill the daily attendance rollups from raw attendance."""
+    count = rebuild_rollups(
+        start_date.date() if start_date else None,
+        end_date.date() if end_date else None
+    )
+    click.echo(f'Rebuilt {count} daily rollups')
@@ -5,5 +5,8 @@
 # Activate virtual environment
 source venv/bin/activate
 
+# Apply pending migrations; the app does not touch the schema on boot
+flask --app "app:create_app()" migrate
+
 # Run the Flask application
 flask --app "app:create_app()" run --host=0.0.0.0 --port=5000
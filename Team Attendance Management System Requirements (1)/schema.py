@@ -0,0 +1,107 @@
+import os
+import re
+import sqlite3
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app.models.models import db
+
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+# Tables that exist in any database the app has used; 0001 drops them
+APP_TABLES = ('users', 'attendance')
+
+
+class MigrationError(Exception):
+    """A migration could not be applied; the database is left at the last good version"""
+
+
+def migrations_dir(app=None):
+    """The numbered SQL files live in the project root, next to the app package"""
+    app = app or current_app
+    return app.config.get('MIGRATIONS_DIR', os.path.dirname(app.root_path))
+
+
+def migration_files(directory):
+    """Return (version, name, path) for each NNNN_name.sql file, in order"""
+    files = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            files.append((int(match.group(1)), filename, os.path.join(directory, filename)))
+    return sorted(files)
+
+
+def migrate(directory=None, baseline=None):
+    """Apply pending migrations in order and return the names applied.
+
+    Each file runs in its own transaction together with its
+    schema_migrations row. `baseline` marks versions up to that number
+    as applied without running them, for databases created before the
+    chain existed. SQLite only, like the migration files themselves.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        raise MigrationError('Migrations are written for SQLite')
+
+    files = migration_files(directory or migrations_dir())
+    raw = db.engine.raw_connection()
+    try:
+        connection = raw.driver_connection
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            'version INTEGER PRIMARY KEY, name TEXT NOT NULL, '
+            'applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)'
+        )
+        connection.commit()
+        applied = {version for (version,) in connection.execute('SELECT version FROM schema_migrations')}
+
+        if not applied and baseline is None:
+            existing = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN (?, ?)", APP_TABLES
+            ).fetchall()
+            if existing:
+                raise MigrationError(
+                    'Database has tables but no migration history; '
+                    'apply any missing migrations by hand, then run with --baseline'
+                )
+
+        done = []
+        for version, name, path in files:
+            if version in applied:
+                continue
+            if baseline is not None and version <= baseline:
+                connection.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (version, name))
+                connection.commit()
+                continue
+
+            with open(path, encoding='utf-8') as f:
+                script = f.read()
+            try:
+                # executescript commits first, so the explicit BEGIN makes the file atomic
+                connection.executescript(
+                    f"BEGIN;\n{script}\n;"
+                    f"INSERT INTO schema_migrations (version, name) VALUES ({version}, '{name}');\n"
+                    "COMMIT;"
+                )
+            except sqlite3.Error as e:
+                if connection.in_transaction:
+                    connection.rollback()
+                raise MigrationError(f'{name}: {e}')
+            done.append(name)
+        return done
+    finally:
+        raw.close()
+
+
+@click.command('migrate')
+@click.option('--baseline', type=int, help='Mark migrations up to this number as already applied.')
+@with_appcontext
+def migrate_command(baseline):
+    """Bring the database schema up to date. The app no longer does this on boot."""
+    try:
+        applied = migrate(baseline=baseline)
+    except MigrationError as e:
+        raise click.ClickException(str(e))
+    for name in applied:
+        click.echo(f'Applied {name}')
+    click.echo('Database is up to date')
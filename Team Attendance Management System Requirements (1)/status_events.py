@@ -0,0 +1,279 @@
+import json
+import queue
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app.models.models import db
+from app.utils.open_sessions import invalidate_open_session, open_session_status
+from app.utils.user_cache import invalidate_user
+
+
+class Subscription:
+    """Change notifications for one user's status.
+
+    Notifications carry no payload, so pending ones coalesce into a
+    single flag and a slow reader can never make the queue grow.
+    """
+
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self._pending = queue.Queue(maxsize=1)
+
+    def notify(self):
+        try:
+            self._pending.put_nowait(True)
+        except queue.Full:
+            pass
+
+    def wait(self, timeout):
+        """Return True if the status changed within `timeout` seconds"""
+        try:
+            return self._pending.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """In-process pub/sub; only reaches streams served by this worker"""
+
+    def __init__(self, app):
+        self.app = app
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def publish(self, user_id):
+        self._deliver(user_id)
+
+    def _deliver(self, user_id):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.notify()
+
+
+class RelayBroker(LocalBroker):
+    """Pub/sub across worker processes through `flask event-relay`.
+
+    A local stand-in for a Redis-style broker: every worker keeps one
+    connection to the relay, which forwards each published user id to
+    the other workers. Those also drop their cached status for the user,
+    so the open-session cache stays coherent across workers. If the
+    relay is down, publishing still reaches local streams.
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.address = (app.config.get('EVENT_RELAY_HOST', '127.0.0.1'), app.config.get('EVENT_RELAY_PORT', 6050))
+        self.authkey = relay_authkey(app)
+        self._connection = None
+        self._send_lock = threading.Lock()
+        self._connected = threading.Event()
+        self._reader = threading.Thread(target=self._read_forever, name='event-relay', daemon=True)
+        self._reader.start()
+
+    def publish(self, user_id):
+        self._deliver(user_id)
+        with self._send_lock:
+            if self._connection is None:
+                return
+            try:
+                self._connection.send_bytes(encode_user_id(user_id))
+            except OSError as e:
+                self.app.logger.warning(f"Event relay unavailable: {e}")
+
+    def _read_forever(self):
+        delay = 0.5
+        while True:
+            try:
+                connection = Client(self.address, authkey=self.authkey)
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = 0.5
+            with self._send_lock:
+                self._connection = connection
+            self._connected.set()
+            try:
+                while True:
+                    user_id = decode_user_id(connection.recv_bytes(MAX_MESSAGE_BYTES))
+                    if user_id is None:
+                        continue
+                    with self.app.app_context():
+                        invalidate_open_session(user_id)
+                        invalidate_user(user_id)
+                    self._deliver(user_id)
+            except (OSError, EOFError):
+                self._connected.clear()
+                with self._send_lock:
+                    self._connection = None
+                connection.close()
+
+
+EVENT_BROKERS = {
+    'local': LocalBroker,
+    'relay': RelayBroker,
+}
+
+
+def relay_authkey(app):
+    """The relay's shared secret, which must be configured explicitly"""
+    authkey = app.config.get('EVENT_RELAY_AUTHKEY')
+    if not authkey:
+        raise RuntimeError('EVENT_RELAY_AUTHKEY must be set to use the event relay')
+    return authkey.encode('utf-8')
+
+
+# Messages are user ids as ASCII digits; raw bytes, never pickles, so a
+# peer that gets past the authkey still cannot run code in a worker
+MAX_MESSAGE_BYTES = 32
+
+
+def encode_user_id(user_id):
+    return str(int(user_id)).encode('ascii')
+
+
+def decode_user_id(message):
+    """The user id in a relay message, or None if it is malformed"""
+    try:
+        return int(message.decode('ascii'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+_init_lock = threading.Lock()
+
+
+def get_broker(app=None):
+    app = app or current_app._get_current_object()
+    broker = app.extensions.get('status_broker')
+    if broker is None:
+        with _init_lock:
+            broker = app.extensions.get('status_broker')
+            if broker is None:
+                broker = EVENT_BROKERS[app.config.get('EVENT_BROKER', 'local')](app)
+                app.extensions['status_broker'] = broker
+    return broker
+
+
+def status_changed(user_id, app=None):
+    """Drop the cached status and user, and notify open streams; call after committing"""
+    invalidate_open_session(user_id, app)
+    # The cached user carries the data version used for ETags
+    invalidate_user(user_id, app)
+    get_broker(app).publish(user_id)
+
+
+def format_event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+def status_stream(user_id):
+    """Server-sent events carrying the user's status as it changes.
+
+    The current status is sent first, then again after each change.
+    Idle streams get a comment every SSE_KEEPALIVE seconds, and end
+    after SSE_MAX_SECONDS so a worker is not held forever; EventSource
+    reconnects on its own.
+    """
+    config = current_app.config
+    keepalive = config.get('SSE_KEEPALIVE', 15)
+    deadline = time.monotonic() + config.get('SSE_MAX_SECONDS', 300)
+
+    # Subscribe before reading the status so no change can slip in between
+    subscription = get_broker().subscribe(user_id)
+    try:
+        yield f"retry: {config.get('SSE_RETRY_MS', 3000)}\n\n"
+        while True:
+            yield format_event('status', open_session_status(user_id))
+            # Do not hold a connection (or an SQLite read snapshot) while idle
+            db.session.remove()
+
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                if subscription.wait(min(keepalive, remaining)):
+                    break
+                yield ': keepalive\n\n'
+    finally:
+        subscription.close()
+
+
+def run_relay(listener):
+    """Forward every message from one connection to all the others"""
+    connections = set()
+    lock = threading.Lock()
+
+    def serve(connection):
+        try:
+            while True:
+                message = connection.recv_bytes(MAX_MESSAGE_BYTES)
+                if decode_user_id(message) is None:
+                    continue
+                with lock:
+                    others = [other for other in connections if other is not connection]
+                for other in others:
+                    try:
+                        other.send_bytes(message)
+                    except OSError:
+                        pass
+        except (OSError, EOFError):
+            pass
+        finally:
+            with lock:
+                connections.discard(connection)
+            connection.close()
+
+    while True:
+        try:
+            connection = listener.accept()
+        except AuthenticationError:
+            continue
+        except OSError:
+            # The listener was closed
+            return
+        with lock:
+            connections.add(connection)
+        threading.Thread(target=serve, args=(connection,), daemon=True).start()
+
+
+@click.command('event-relay')
+@with_appcontext
+def event_relay_command():
+    """Relay status events between workers (EVENT_BROKER = 'relay')."""
+    app = current_app._get_current_object()
+    try:
+        authkey = relay_authkey(app)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    address = (app.config.get('EVENT_RELAY_HOST', '127.0.0.1'), app.config.get('EVENT_RELAY_PORT', 6050))
+    listener = Listener(address, authkey=authkey)
+    click.echo(f'Relaying status events on {address[0]}:{address[1]}')
+    run_relay(listener)
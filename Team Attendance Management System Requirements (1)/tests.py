@@ -1,16 +1,100 @@
 import unittest
 from app import create_app
-from app.models.models import db, User, Attendance
+from app.models.models import db, User, Attendance, DailyAttendance, ExportJob, Site, IdempotencyKey
 from werkzeug.security import generate_password_hash
+from app.utils.geocoding import get_geocoder, GeocodeCache, StubGeocoder
+from app.utils.rollups import rebuild_rollups, summarize
+from app.utils.geofence import GeofenceIndex, reevaluate_geofences
+from app.utils.open_sessions import get_open_session_cache
+from app.utils.user_cache import get_user_cache
+from app.utils.export_jobs import get_export_queue
+from app.utils.pdf_reports import write_pdf, PdfWriter
+from app.utils.schema import migrate, MigrationError
+from app.utils.database import engine_options
+from app.utils.status_events import RelayBroker, get_broker, run_relay
+from app.utils.login_protection import DatabaseStore, HashExecutor, HashingBusy
+from app.utils.archive import archive_sessions, partitions
+from app.utils.idempotency import get_idempotency_store, request_fingerprint
+from app.utils.data_versions import bump_data_version
+from multiprocessing.connection import Client, Listener
+import threading
+import tempfile
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+from sqlalchemy import event, inspect, text
+import csv
+import gzip
+import io
 import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+
+@contextmanager
+def count_queries(app):
+    """Collect the SQL statements executed inside the block"""
+    statements = []
+    
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@contextmanager
+def record_statements(app):
+    """Collect (statement, parameters) for single executions inside the block"""
+    statements = []
+    
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+    
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def migrated_app(directory):
+    """App on a scratch SQLite file whose schema comes from the SQL migrations"""
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'migrated.db'),
+        'GEOCODER_BACKEND': 'stub',
+        'MIGRATIONS_DIR': os.path.dirname(os.path.abspath(__file__)),
+        'PDF_WORKERS': 0,
+    })
+    with app.app_context():
+        migrate()
+    return app
+
 
 class AttendanceSystemTestCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app()
-        self.app.config['TESTING'] = True
-        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-        self.app.config['WTF_CSRF_ENABLED'] = False
+        # The engine is created in create_app, so the database must be configured there.
+        # A scratch file rather than :memory:, whose single connection would be
+        # shared by the request and the background geocoding and export threads
+        self.database_dir = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.database_dir.name, 'test.db'),
+            'WTF_CSRF_ENABLED': False,
+            'GEOCODER_BACKEND': 'stub'
+        })
         self.client = self.app.test_client()
         
         with self.app.app_context():
@@ -57,9 +141,15 @@ class AttendanceSystemTestCase(unittest.TestCase):
             db.session.commit()
     
     def tearDown(self):
+        # Let background work finish before its database goes away
+        for name in ('geocoder', 'export_queue'):
+            if name in self.app.extensions:
+                self.app.extensions[name].join(timeout=30)
         with self.app.app_context():
             db.session.remove()
             db.drop_all()
+            db.engine.dispose()
+        self.database_dir.cleanup()
     
     def test_login(self):
         # Test login with valid credentials
@@ -177,5 +267,1398 @@ class AttendanceSystemTestCase(unittest.TestCase):
         # Should be redirected to index page
         self.assertNotIn(b'Admin Dashboard', response.data)
 
+    def test_check_in_resolves_address_in_background(self):
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        
+        response = self.client.post('/check-in', data={
+            'latitude': '37.7749',
+            'longitude': '-122.4194'
+        })
+        self.assertEqual(response.status_code, 302)
+        
+        geocoder = get_geocoder(self.app)
+        geocoder.join(timeout=5)
+        
+        with self.app.app_context():
+            record = Attendance.query.filter_by(user_id=2, check_out_time=None).first()
+            self.assertEqual(record.location_address, 'Near 37.7750, -122.4190')
+        self.assertEqual(geocoder.backend.calls, 1)
+        
+        # A second check-in in the same grid cell is served from the cache
+        self.client.post('/check-out')
+        self.client.post('/api/attendance/check-in', json={
+            'latitude': 37.77491,
+            'longitude': -122.41942
+        })
+        geocoder.join(timeout=5)
+        
+        response = self.client.get('/api/attendance/status')
+        data = json.loads(response.data)
+        self.assertEqual(data['location_address'], 'Near 37.7750, -122.4190')
+        self.assertEqual(geocoder.backend.calls, 1)
+    
+    def test_geocoder_coalesces_duplicate_lookups(self):
+        geocoder = get_geocoder(self.app)
+        geocoder.backend = StubGeocoder(delay=0.2)
+        
+        with self.app.app_context():
+            records = []
+            for _ in range(5):
+                record = Attendance(user_id=1, check_in_time=datetime.utcnow(), check_out_time=datetime.utcnow())
+                record.set_location(51.5007, -0.1246)
+                db.session.add(record)
+                records.append(record)
+            db.session.commit()
+            record_ids = [record.id for record in records]
+        
+        for record_id in record_ids:
+            geocoder.enqueue(record_id, 51.5007, -0.1246)
+        geocoder.join(timeout=5)
+        
+        self.assertEqual(geocoder.backend.calls, 1)
+        with self.app.app_context():
+            addresses = {
+                Attendance.query.get(record_id).location_address
+                for record_id in record_ids
+            }
+        self.assertEqual(addresses, {'Near 51.5010, -0.1250'})
+    
+    def test_geocoder_retries_and_skips_filled_records(self):
+        geocoder = get_geocoder(self.app)
+        geocoder.retry_delay = 0
+        
+        with self.app.app_context():
+            records = []
+            for address in (None, 'Typed in by hand'):
+                record = Attendance(
+                    user_id=1,
+                    check_in_time=datetime.utcnow(),
+                    check_out_time=datetime.utcnow(),
+                    location_address=address
+                )
+                record.set_location(48.8584, 2.2945)
+                db.session.add(record)
+                records.append(record)
+            db.session.commit()
+            empty_id, filled_id = (record.id for record in records)
+            version = User.query.get(1).data_version
+        
+        # Records that already have an address are not marked as changed
+        geocoder.backend = StubGeocoder()
+        geocoder.enqueue(filled_id, 48.8584, 2.2945)
+        geocoder.join(timeout=5)
+        with self.app.app_context():
+            self.assertEqual(User.query.get(1).data_version, version)
+            self.assertEqual(Attendance.query.get(filled_id).location_address, 'Typed in by hand')
+        
+        # Lookups that keep failing leave the address empty after the retries
+        geocoder.cache = GeocodeCache()
+        geocoder.backend = StubGeocoder(failures=3)
+        with self.assertLogs(self.app.logger, level='ERROR') as logs:
+            geocoder.enqueue(empty_id, 48.8584, 2.2945)
+            geocoder.join(timeout=5)
+        self.assertEqual(geocoder.backend.calls, 3)
+        self.assertIn(str(empty_id), logs.output[0])
+        
+        # A transient failure is retried
+        geocoder.backend = StubGeocoder(failures=1)
+        geocoder.enqueue(empty_id, 48.8584, 2.2945)
+        geocoder.join(timeout=5)
+        self.assertEqual(geocoder.backend.calls, 2)
+        with self.app.app_context():
+            self.assertEqual(Attendance.query.get(empty_id).location_address, 'Near 48.8580, 2.2950')
+            self.assertEqual(User.query.get(1).data_version, version + 1)
+    
+    def test_geocode_cache_eviction(self):
+        cache = GeocodeCache(max_size=2, ttl=60, precision=2)
+        self.assertEqual(cache.bucket('10.004', 20.006), (10.0, 20.01))
+        
+        cache.set((1, 1), 'one')
+        cache.set((2, 2), 'two')
+        cache.get((1, 1))
+        cache.set((3, 3), 'three')
+        
+        # The least recently used entry is dropped
+        self.assertEqual(cache.get((1, 1)), 'one')
+        self.assertIsNone(cache.get((2, 2)))
+        
+        cache.ttl = -1
+        cache.set((4, 4), 'four')
+        self.assertIsNone(cache.get((4, 4)))
+
+    def _add_staff_attendance(self, count):
+        # Spread records over several users so per-row user lookups would show up
+        with self.app.app_context():
+            for i in range(count):
+                user = User(
+                    username=f'staff{i}',
+                    email=f'staff{i}@example.com',
+                    password='x'
+                )
+                db.session.add(user)
+                db.session.flush()
+                record = Attendance(
+                    user_id=user.id,
+                    check_in_time=datetime.utcnow() - timedelta(hours=3),
+                    check_out_time=datetime.utcnow() - timedelta(hours=1)
+                )
+                record.set_location(37.7749, -122.4194)
+                db.session.add(record)
+            db.session.commit()
+    
+    def test_admin_listing_and_exports_query_count(self):
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        
+        paths = [
+            '/api/admin/attendance',
+            '/admin/export-csv',
+            '/admin/export-pdf',
+        ]
+        
+        # Warm the user cache so it does not skew the first count
+        self.client.get('/api/user/status')
+        
+        baseline = {}
+        for path in paths:
+            with count_queries(self.app) as statements:
+                response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            baseline[path] = len(statements)
+        
+        self._add_staff_attendance(20)
+        
+        for path in paths:
+            with count_queries(self.app) as statements:
+                response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(statements), baseline[path], path)
+        
+        response = self.client.get('/api/admin/attendance')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['attendance']), 22)
+        self.assertIn('staff19', {row['username'] for row in data['attendance']})
+
+    def test_export_csv_streams_in_pages(self):
+        self.app.config['EXPORT_PAGE_SIZE'] = 3
+        self._add_staff_attendance(10)
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        
+        response = self.client.get('/admin/export-csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(rows[0][0], 'ID')
+        self.assertEqual(len(rows), 13)
+        
+        # Rows come out newest first without duplicates across page boundaries
+        check_in_times = [row[2] for row in rows[1:]]
+        self.assertEqual(check_in_times, sorted(check_in_times, reverse=True))
+        self.assertEqual(len({row[0] for row in rows[1:]}), 12)
+        
+        compressed = self.client.get('/admin/export-csv', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.data), response.data)
+
+    def test_history_api_keyset_pagination(self):
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        
+        response = self.client.get('/api/attendance/history?limit=1&fields=id,check_in_time')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['history']), 1)
+        self.assertEqual(set(data['history'][0]), {'id', 'check_in_time'})
+        self.assertIsNotNone(data['next_cursor'])
+        first_id = data['history'][0]['id']
+        
+        response = self.client.get(f"/api/attendance/history?limit=1&cursor={data['next_cursor']}")
+        data = json.loads(response.data)
+        self.assertEqual(len(data['history']), 1)
+        self.assertNotEqual(data['history'][0]['id'], first_id)
+        self.assertIsNone(data['next_cursor'])
+        
+        response = self.client.get('/api/attendance/history?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/attendance/history?fields=id,password')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_delta_sync_returns_only_changes(self):
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        
+        # The first sync fetches everything, page by page
+        response = self.client.get('/api/attendance/sync?limit=1')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['changes']), 1)
+        self.assertIsNotNone(data['next_cursor'])
+        response = self.client.get(f"/api/attendance/sync?limit=1&cursor={data['next_cursor']}")
+        data = json.loads(response.data)
+        self.assertEqual(len(data['changes']), 1)
+        self.assertIsNone(data['next_cursor'])
+        watermark = data['watermark']
+        
+        response = self.client.get(f'/api/attendance/sync?since={watermark}')
+        data = json.loads(response.data)
+        self.assertEqual(data['changes'], [])
+        self.assertEqual(data['watermark'], watermark)
+        
+        response = self.client.post('/api/attendance/check-in', json={'latitude': 37.7749, 'longitude': -122.4194})
+        attendance_id = json.loads(response.data)['attendance_id']
+        get_geocoder(self.app).join(timeout=5)
+        self.client.post('/api/attendance/check-out')
+        
+        with count_queries(self.app) as statements:
+            response = self.client.get(f'/api/attendance/sync?since={watermark}')
+        data = json.loads(response.data)
+        self.assertEqual([change['id'] for change in data['changes']], [attendance_id])
+        self.assertIsNotNone(data['changes'][0]['check_out_time'])
+        self.assertGreater(data['watermark'], watermark)
+        self.assertEqual(len([s for s in statements if 'FROM attendance' in s]), 1)
+        watermark = data['watermark']
+        
+        # Changes made outside the user's requests are picked up too
+        with self.app.app_context():
+            db.session.add(Site(name='HQ', latitude=37.7749, longitude=-122.4194, radius_m=200))
+            db.session.commit()
+            self.assertEqual(reevaluate_geofences(), 3)
+            self.assertEqual(reevaluate_geofences(), 3)
+        response = self.client.get(f'/api/attendance/sync?since={watermark}')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['changes']), 3)
+        self.assertTrue(all(change['site_id'] for change in data['changes']))
+        
+        response = self.client.get(f"/api/attendance/sync?since={data['watermark']}")
+        self.assertEqual(json.loads(response.data)['changes'], [])
+        response = self.client.get('/api/attendance/sync?since=soon')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_idempotent_check_in_and_out(self):
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        location = {'latitude': 37.7749, 'longitude': -122.4194}
+        
+        first = self.client.post('/api/attendance/check-in', json=location, headers={'Idempotency-Key': 'in-1'})
+        self.assertEqual(first.status_code, 200)
+        get_geocoder(self.app).join(timeout=5)
+        
+        # A retry gets the original response without touching attendance
+        with count_queries(self.app) as statements:
+            retry = self.client.post('/api/attendance/check-in', json=location, headers={'Idempotency-Key': 'in-1'})
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(json.loads(retry.data), json.loads(first.data))
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertFalse([s for s in statements if 'attendance' in s])
+        
+        response = self.client.post('/api/attendance/check-in', json={'latitude': 1, 'longitude': 1},
+                                    headers={'Idempotency-Key': 'in-1'})
+        self.assertEqual(response.status_code, 422)
+        
+        for _ in range(2):
+            response = self.client.post('/api/attendance/check-out', headers={'Idempotency-Key': 'out-1'})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['attendance_id'], json.loads(first.data)['attendance_id'])
+        
+        # A duplicate that misses the stored key still cannot apply twice:
+        # its key insert fails, its check-in rolls back, and it is answered
+        # with the response committed first
+        with self.app.test_request_context('/api/attendance/check-in', method='POST', json=location):
+            fingerprint = request_fingerprint()
+        with self.app.app_context():
+            db.session.add(IdempotencyKey(
+                user_id=2, key='in-2', fingerprint=fingerprint, status=200,
+                body=json.dumps({'success': True, 'attendance_id': 99})
+            ))
+            db.session.commit()
+        store = get_idempotency_store(self.app)
+        lookup = store.lookup
+        misses = []
+        
+        def lookup_after_commit(user_id, key):
+            if not misses:
+                misses.append(key)
+                return None
+            return lookup(user_id, key)
+        
+        store.lookup = lookup_after_commit
+        response = self.client.post('/api/attendance/check-in', json=location, headers={'Idempotency-Key': 'in-2'})
+        store.lookup = lookup
+        self.assertEqual(json.loads(response.data)['attendance_id'], 99)
+        with self.app.app_context():
+            self.assertEqual(Attendance.query.filter_by(user_id=2).count(), 3)
+            self.assertEqual(Attendance.query.filter_by(check_out_time=None).count(), 0)
+        
+        # Expired keys are reused; the store keeps at most max_keys
+        store.ttl = 0
+        response = self.client.post('/api/attendance/check-out', headers={'Idempotency-Key': 'out-1'})
+        self.assertEqual(response.status_code, 400)
+        store.ttl = 3600
+        store.max_keys = 1
+        store._next_prune = 0
+        self.client.post('/api/attendance/check-in', json=location, headers={'Idempotency-Key': 'in-3'})
+        with self.app.app_context():
+            self.assertEqual([row.key for row in IdempotencyKey.query.all()], ['in-3'])
+        
+        response = self.client.post('/api/attendance/check-out', headers={'Idempotency-Key': 'x' * 256})
+        self.assertEqual(response.status_code, 400)
+    
+    def test_admin_attendance_api_pages_through_all_rows(self):
+        self._add_staff_attendance(7)
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        
+        seen = []
+        cursor = ''
+        while True:
+            response = self.client.get(f'/api/admin/attendance?limit=4&cursor={cursor}')
+            data = json.loads(response.data)
+            self.assertLessEqual(len(data['attendance']), 4)
+            seen.extend(row['id'] for row in data['attendance'])
+            if not data['next_cursor']:
+                break
+            cursor = data['next_cursor']
+        
+        self.assertEqual(len(seen), 9)
+        self.assertEqual(len(set(seen)), 9)
+
+    def test_daily_rollups_follow_check_out(self):
+        with self.app.app_context():
+            self.assertEqual(rebuild_rollups(), 2)
+            expected = sum(record.duration() for record in Attendance.query.all())
+            today = datetime.utcnow().date()
+            summary = summarize(today - timedelta(days=7), today)
+            self.assertEqual(summary['sessions'], 2)
+            self.assertAlmostEqual(summary['total_hours'], expected)
+        
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        self.client.post('/api/attendance/check-in', json={
+            'latitude': 37.7749,
+            'longitude': -122.4194
+        })
+        self.client.post('/api/attendance/check-out')
+        
+        with self.app.app_context():
+            today = datetime.utcnow().date()
+            rollup = DailyAttendance.query.filter_by(user_id=2, day=today).first()
+            self.assertIsNotNone(rollup.last_check_out)
+            incremental = (rollup.sessions, rollup.total_hours, rollup.last_check_out)
+            
+            # A full rebuild agrees with the incrementally maintained rollup
+            rebuild_rollups(today, today)
+            rollup = DailyAttendance.query.filter_by(user_id=2, day=today).first()
+            self.assertEqual((rollup.sessions, rollup.total_hours, rollup.last_check_out), incremental)
+    
+    def test_rebuild_rollups_command(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['rebuild-rollups'])
+        self.assertIn('Rebuilt 2 daily rollups', result.output)
+
+    def test_location_columns_and_nearby_search(self):
+        with self.app.app_context():
+            record = Attendance.query.first()
+            self.assertEqual(record.get_location(), {'latitude': 37.7749, 'longitude': -122.4194})
+            self.assertIsNotNone(record.grid_cell)
+            
+            # About 300m and 5km away from the seeded records
+            for latitude, longitude in [(37.7776, -122.4194), (37.8199, -122.4194)]:
+                nearby = Attendance(user_id=1, check_in_time=datetime.utcnow(), check_out_time=datetime.utcnow())
+                nearby.set_location(latitude, longitude)
+                db.session.add(nearby)
+            db.session.commit()
+            
+            with self.assertRaises(ValueError):
+                Attendance().set_location('north', -122.4194)
+        
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        response = self.client.get('/api/admin/attendance/nearby?latitude=37.7749&longitude=-122.4194&radius=500')
+        data = json.loads(response.data)
+        self.assertEqual(len(data['attendance']), 3)
+        self.assertTrue(all(row['distance_m'] <= 500 for row in data['attendance']))
+        
+        response = self.client.get('/api/admin/attendance/nearby?latitude=37.7749&longitude=-122.4194&radius=10000')
+        self.assertEqual(len(json.loads(response.data)['attendance']), 4)
+        
+        # Results are paged newest first
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            data = json.loads(self.client.get(
+                f'/api/admin/attendance/nearby?latitude=37.7749&longitude=-122.4194&radius=10000&limit=3&cursor={cursor}'
+            ).data)
+            self.assertLessEqual(len(data['attendance']), 3)
+            seen.extend(row['id'] for row in data['attendance'])
+            cursor = data['next_cursor']
+        self.assertEqual(len(seen), 4)
+        self.assertEqual(len(set(seen)), 4)
+        
+        response = self.client.get('/api/admin/attendance/nearby?latitude=37.7749&longitude=-122.4194&start_date=2023-13-01')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/admin/attendance?end_date=yesterday')
+        self.assertEqual(response.status_code, 400)
+        
+        # A search circle crossing the antimeridian finds check-ins on both sides
+        with self.app.app_context():
+            for longitude in (179.9995, -179.9995):
+                record = Attendance(user_id=1, check_in_time=datetime.utcnow(), check_out_time=datetime.utcnow())
+                record.set_location(10.0, longitude)
+                db.session.add(record)
+            db.session.commit()
+        for longitude in (179.999, -179.999):
+            response = self.client.get(f'/api/admin/attendance/nearby?latitude=10&longitude={longitude}&radius=1000')
+            self.assertEqual(len(json.loads(response.data)['attendance']), 2, longitude)
+        
+        response = self.client.post('/api/attendance/check-in', json={'latitude': 'x', 'longitude': 1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_geofence_tags_check_ins(self):
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        
+        response = self.client.post('/api/admin/sites/create', json={
+            'name': 'HQ',
+            'latitude': 37.7749,
+            'longitude': -122.4194,
+            'radius_m': 200
+        })
+        self.assertEqual(response.status_code, 200)
+        hq_id = json.loads(response.data)['site']['id']
+        
+        response = self.client.post('/api/admin/sites/create', json={
+            'name': 'Warehouse',
+            'polygon': [[37.80, -122.30], [37.81, -122.30], [37.81, -122.29], [37.80, -122.29]]
+        })
+        warehouse_id = json.loads(response.data)['site']['id']
+        
+        response = self.client.post('/api/admin/sites/create', json={'name': 'Broken', 'radius_m': 10})
+        self.assertEqual(response.status_code, 400)
+        
+        response = self.client.post('/api/attendance/check-in', json={
+            'latitude': 37.805,
+            'longitude': -122.295
+        })
+        data = json.loads(response.data)
+        self.assertEqual(data['site_id'], warehouse_id)
+        self.assertFalse(data['off_site'])
+        
+        self.client.post('/api/attendance/check-out')
+        response = self.client.post('/api/attendance/check-in', json={
+            'latitude': 38.5,
+            'longitude': -121.0
+        })
+        data = json.loads(response.data)
+        self.assertIsNone(data['site_id'])
+        self.assertTrue(data['off_site'])
+        
+        # Records from before the sites existed are tagged by re-evaluation
+        with self.app.app_context():
+            self.assertEqual(reevaluate_geofences(batch_size=3), 4)
+            seeded = Attendance.query.filter_by(user_id=2).all()
+            self.assertEqual({record.site_id for record in seeded}, {hq_id})
+        
+        # Deleting a site re-tags its check-ins against the sites that remain
+        response = self.client.post('/api/admin/sites/create', json={
+            'name': 'Campus',
+            'latitude': 37.7749,
+            'longitude': -122.4194,
+            'radius_m': 2000
+        })
+        campus_id = json.loads(response.data)['site']['id']
+        with self.app.app_context():
+            version = User.query.get(2).data_version
+        self.client.post(f'/api/admin/sites/{hq_id}/delete')
+        self.client.post(f'/api/admin/sites/{warehouse_id}/delete')
+        with self.app.app_context():
+            seeded = Attendance.query.filter_by(user_id=2).all()
+            self.assertEqual({(record.site_id, record.off_site) for record in seeded}, {(campus_id, False)})
+            self.assertGreater(User.query.get(2).data_version, version)
+            record = Attendance.query.filter_by(user_id=1, latitude=37.805).one()
+            self.assertEqual((record.site_id, record.off_site), (None, True))
+    
+    def test_geofence_prefers_smaller_overlapping_site(self):
+        with self.app.app_context():
+            campus = Site(id=1, name='Campus')
+            campus.set_polygon([[37.75, -122.45], [37.80, -122.45], [37.80, -122.40], [37.75, -122.40]])
+            lobby = Site(id=2, name='Lobby', latitude=37.7749, longitude=-122.4194, radius_m=50)
+            index = GeofenceIndex([campus, lobby])
+            # Both areas are in m²: a 50 m circle is far smaller than a 5 km campus
+            self.assertEqual(index.locate(37.7749, -122.4194).site_id, 2)
+            self.assertEqual(index.locate(37.7760, -122.4194).site_id, 1)
+            
+            huge = Site(id=3, name='Region', latitude=37.7749, longitude=-122.4194, radius_m=50000)
+            yard = Site(id=4, name='Yard')
+            yard.set_polygon([[37.774, -122.420], [37.776, -122.420], [37.776, -122.418], [37.774, -122.418]])
+            self.assertEqual(GeofenceIndex([huge, yard]).locate(37.7749, -122.4194).site_id, 4)
+
+    def test_status_poll_uses_open_session_cache(self):
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        
+        self.client.get('/api/attendance/status')
+        with count_queries(self.app) as statements:
+            response = self.client.get('/api/attendance/status')
+        self.assertEqual(json.loads(response.data)['status'], 'checked_out')
+        self.assertFalse([s for s in statements if 'FROM attendance' in s])
+        
+        # Check-in and check-out invalidate the cached status
+        self.client.post('/api/attendance/check-in', json={'latitude': 37.7749, 'longitude': -122.4194})
+        response = self.client.get('/api/attendance/status')
+        self.assertEqual(json.loads(response.data)['status'], 'checked_in')
+        self.client.post('/api/attendance/check-out')
+        response = self.client.get('/api/attendance/status')
+        self.assertEqual(json.loads(response.data)['status'], 'checked_out')
+        self.assertGreater(get_open_session_cache(self.app).hits, 0)
+    
+    def test_open_session_is_unique_per_user(self):
+        with self.app.app_context():
+            for _ in range(2):
+                record = Attendance(user_id=2, check_in_time=datetime.utcnow())
+                record.set_location(37.7749, -122.4194)
+                db.session.add(record)
+            with self.assertRaises(IntegrityError):
+                db.session.commit()
+            db.session.rollback()
+        
+        # Checking in from a second device is refused
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        response = self.client.post('/api/attendance/check-in', json={'latitude': 37.7749, 'longitude': -122.4194})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/api/attendance/check-in', json={'latitude': 37.7749, 'longitude': -122.4194})
+        self.assertEqual(response.status_code, 400)
+        
+        # A repeated check-out finds nothing left to close
+        self.assertEqual(self.client.post('/api/attendance/check-out').status_code, 200)
+        self.assertEqual(self.client.post('/api/attendance/check-out').status_code, 400)
+
+    def test_batch_ingestion_pairs_events(self):
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        
+        # User 1 already has an open session that the batch closes
+        with self.app.app_context():
+            open_session = Attendance(user_id=1, check_in_time=datetime(2026, 3, 2, 7, 0))
+            open_session.set_location(37.7749, -122.4194)
+            db.session.add(open_session)
+            db.session.commit()
+            open_session_id = open_session.id
+        
+        events = [
+            {'type': 'check_out', 'user_id': 2, 'timestamp': '2026-03-02T17:00:00'},
+            {'type': 'check_in', 'user_id': 2, 'timestamp': '2026-03-02T09:00:00', 'latitude': 37.7749, 'longitude': -122.4194},
+            {'type': 'check_out', 'user_id': 1, 'timestamp': '2026-03-02T15:30:00'},
+            {'type': 'check_in', 'user_id': 2, 'timestamp': '2026-03-02T10:00:00', 'latitude': 37.7749, 'longitude': -122.4194},
+            {'type': 'check_in', 'user_id': 99, 'timestamp': '2026-03-02T09:00:00', 'latitude': 1, 'longitude': 1},
+            {'type': 'lunch', 'user_id': 2, 'timestamp': '2026-03-02T12:00:00'},
+        ]
+        
+        with count_queries(self.app) as statements:
+            response = self.client.post('/api/attendance/batch', json={'events': events})
+        data = json.loads(response.data)
+        
+        self.assertEqual(data['accepted'], 3)
+        self.assertEqual([result['success'] for result in data['results']], [True, True, True, False, False, False])
+        self.assertEqual(data['results'][2]['attendance_id'], open_session_id)
+        self.assertEqual(data['results'][3]['message'], 'Already checked in')
+        self.assertEqual(data['results'][4]['message'], 'Unknown user')
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO attendance')]), 1)
+        
+        with self.app.app_context():
+            session = Attendance.query.get(data['results'][1]['attendance_id'])
+            self.assertEqual(session.check_out_time, datetime(2026, 3, 2, 17, 0))
+            self.assertEqual(Attendance.query.get(open_session_id).check_out_time, datetime(2026, 3, 2, 15, 30))
+            rollups = DailyAttendance.query.filter_by(day=datetime(2026, 3, 2).date()).all()
+            self.assertEqual(sorted(rollup.total_hours for rollup in rollups), [8.0, 8.5])
+        
+        # A check-out must come after its check-in, not at the same moment
+        response = self.client.post('/api/attendance/batch', json={'events': [
+            {'type': 'check_in', 'user_id': 1, 'timestamp': '2026-03-03T09:00:00', 'latitude': 1, 'longitude': 1},
+            {'type': 'check_out', 'user_id': 1, 'timestamp': '2026-03-03T09:00:00'},
+        ]})
+        data = json.loads(response.data)
+        self.assertEqual(data['accepted'], 1)
+        self.assertEqual(data['results'][1]['message'], 'Check-out must follow check-in')
+
+    def test_bulk_user_import(self):
+        self.app.config['HASH_WORKERS'] = 0
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        
+        users = [
+            {'username': 'ana', 'email': 'ana@example.com', 'password': 'secret1'},
+            {'username': 'user', 'email': 'other@example.com', 'password': 'secret2'},
+            {'username': 'ben', 'email': 'ana@example.com', 'password': 'secret3'},
+            {'username': 'cy', 'email': 'cy@example.com'},
+            {'username': 'dee', 'email': 'dee@example.com', 'password': 'secret4', 'is_admin': True},
+        ]
+        with count_queries(self.app) as statements:
+            response = self.client.post('/api/admin/users/import', json={'users': users})
+        data = json.loads(response.data)
+        
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([result['success'] for result in data['results']], [True, False, False, False, True])
+        self.assertEqual(data['results'][1]['message'], 'Username already exists')
+        self.assertEqual(data['results'][2]['message'], 'Email already exists')
+        self.assertEqual(data['results'][3]['message'], 'Missing required fields')
+        self.assertEqual(len([s for s in statements if s.startswith('SELECT users.username')]), 1)
+        
+        response = self.client.post(
+            '/api/admin/users/import',
+            data='username,email,password,is_admin\neve,eve@example.com,secret5,no\nana,x@example.com,secret6,\n',
+            content_type='text/csv'
+        )
+        data = json.loads(response.data)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(data['results'][1]['message'], 'Username already exists')
+        
+        with self.app.app_context():
+            self.assertTrue(User.query.filter_by(username='dee').one().is_admin)
+            self.assertFalse(User.query.filter_by(username='eve').one().is_admin)
+        
+        self.client.get('/logout')
+        response = self.client.post('/login', data={'username': 'eve', 'password': 'secret5'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_login_throttling(self):
+        self.app.config['LOGIN_USER_BURST'] = 3
+        self.app.config['LOGIN_ADDRESS_BURST'] = 12
+        
+        # Successful logins give the username's token back, not the address's
+        for _ in range(5):
+            response = self.client.post('/login', data={'username': 'user', 'password': 'password'})
+            self.assertEqual(response.status_code, 302)
+            self.client.get('/logout')
+        
+        statuses = [
+            self.client.post('/login', data={'username': 'admin', 'password': 'wrong'}).status_code
+            for _ in range(4)
+        ]
+        self.assertEqual(statuses, [302, 302, 302, 429])
+        response = self.client.post('/login', data={'username': 'admin', 'password': 'password'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        
+        # Other accounts are unaffected until the address runs out too
+        self.assertEqual(self.client.post('/login', data={'username': 'user', 'password': 'wrong'}).status_code, 302)
+        self.assertEqual(self.client.post('/login', data={'username': 'nobody', 'password': 'wrong'}).status_code, 302)
+        self.assertEqual(self.client.post('/login', data={'username': 'user', 'password': 'password'}).status_code, 429)
+        response = self.client.post('/login', data={'username': 'user', 'password': 'password'},
+                                    environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_shared_login_buckets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = migrated_app(directory)
+            with app.app_context():
+                store = DatabaseStore(app, 3600)
+                now = time.time()
+                self.assertEqual([store.take('user:ana', 2, 1 / 60, now) for _ in range(3)], [True, True, False])
+                store.give('user:ana', 2)
+                self.assertTrue(store.take('user:ana', 2, 1 / 60, now))
+                # One token per minute refills
+                self.assertTrue(store.take('user:ana', 2, 1 / 60, now + 61))
+                self.assertFalse(store.take('user:ana', 2, 1 / 60, now + 62))
+                db.engine.dispose()
+
+    def test_hash_executor_is_bounded(self):
+        executor = HashExecutor(workers=1, queue_size=0, wait=0.05)
+        release = threading.Event()
+        busy = threading.Thread(target=executor.run, args=(release.wait,))
+        busy.start()
+        time.sleep(0.05)
+        try:
+            with self.assertRaises(HashingBusy):
+                executor.run(lambda: True)
+        finally:
+            release.set()
+            busy.join()
+        self.assertTrue(executor.run(lambda: True))
+        executor.shutdown()
+
+    def test_cached_user_loader(self):
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        self.client.get('/api/attendance/status')
+        
+        # Both the user and the status come from cache: no SQL at all
+        with count_queries(self.app) as statements:
+            response = self.client.get('/api/attendance/status')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(statements, [])
+        self.assertGreater(get_user_cache(self.app).hits, 0)
+        
+        response = self.client.get('/api/user/status')
+        self.assertFalse(json.loads(response.data)['is_admin'])
+        
+        # Promoting the user is visible on their next request
+        admin_client = self.app.test_client()
+        admin_client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        admin_client.post('/admin/users/2/toggle-admin')
+        
+        response = self.client.get('/api/user/status')
+        self.assertTrue(json.loads(response.data)['is_admin'])
+        
+        # So is a change made outside the admin endpoints
+        with self.app.app_context():
+            User.query.get(2).email = 'changed@example.com'
+            db.session.commit()
+        response = self.client.get('/api/user/status')
+        self.assertEqual(json.loads(response.data)['email'], 'changed@example.com')
+
+    def test_export_jobs_render_in_background(self):
+        export_dir = tempfile.mkdtemp()
+        self.app.config['EXPORT_DIR'] = export_dir
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        
+        # A closed date range, so the finished artifact can be reused
+        end_date = (datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d')
+        params = {'kind': 'csv', 'start_date': '2020-01-01', 'end_date': end_date}
+        response = self.client.post('/admin/exports', json=params)
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.data)['job']['job_id']
+        
+        # The same parameters are deduplicated onto the same job
+        response = self.client.post('/admin/exports', json=params)
+        self.assertEqual(json.loads(response.data)['job']['job_id'], job_id)
+        
+        get_export_queue(self.app).join(timeout=10)
+        response = self.client.get(f'/admin/exports/{job_id}')
+        job = json.loads(response.data)['job']
+        self.assertEqual(job['status'], 'done')
+        
+        response = self.client.get(job['download_url'])
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(len(rows), 2)
+        response.close()
+        
+        # Resubmitting a finished closed range reuses the artifact
+        response = self.client.post('/admin/exports', json=params)
+        self.assertEqual(json.loads(response.data)['job']['status'], 'done')
+        
+        response = self.client.post('/admin/exports', json={'kind': 'pdf'})
+        pdf_job = json.loads(response.data)['job']['job_id']
+        get_export_queue(self.app).join(timeout=30)
+        response = self.client.get(f'/admin/exports/{pdf_job}/download')
+        self.assertTrue(response.data.startswith(b'%PDF'))
+        response.close()
+    
+    def test_export_cache_is_size_bounded(self):
+        self.app.config['EXPORT_DIR'] = tempfile.mkdtemp()
+        self.app.config['EXPORT_CACHE_BYTES'] = 1
+        queue = get_export_queue(self.app)
+        
+        with self.app.app_context():
+            first = queue.submit('csv', datetime(2020, 1, 1).date(), datetime(2020, 1, 31).date())
+            first_id = first.id
+            queue.join(timeout=10)
+            second = queue.submit('csv', datetime(2020, 2, 1).date(), datetime(2020, 2, 28).date())
+            second_id = second.id
+            queue.join(timeout=10)
+            
+            # Only the most recent artifact survives a one-byte budget
+            db.session.expire_all()
+            self.assertIsNone(ExportJob.query.get(first_id))
+            self.assertEqual(ExportJob.query.get(second_id).status, 'done')
+            self.assertEqual(os.listdir(self.app.config['EXPORT_DIR']), [f'{second_id}.csv'])
+    
+    def test_orphaned_export_job_is_requeued(self):
+        self.app.config['EXPORT_DIR'] = tempfile.mkdtemp()
+        queue = get_export_queue(self.app)
+        start_date, end_date = datetime(2020, 1, 1).date(), datetime(2020, 1, 31).date()
+        
+        with self.app.app_context():
+            # Queued by a process that exited before any worker picked it up
+            job = queue.submit('csv', start_date, end_date)
+            queue.join(timeout=10)
+            job.status = 'pending'
+            job.created_at = datetime.utcnow() - timedelta(seconds=queue.job_timeout + 1)
+            db.session.commit()
+            
+            job = queue.submit('csv', start_date, end_date)
+            queue.join(timeout=10)
+            db.session.expire_all()
+            self.assertEqual(ExportJob.query.get(job.id).status, 'done')
+    
+    def test_metrics_endpoint(self):
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        self.client.get('/api/attendance/history')
+        
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.get_data(as_text=True)
+        labels = 'blueprint="api",endpoint="api.attendance_history",method="GET"'
+        self.assertIn(f'http_requests_total{{{labels},status="200"}} 1', body)
+        self.assertIn(f'http_request_duration_seconds_count{{{labels}}} 1', body)
+        self.assertIn(f'http_request_sql_statements_bucket{{{labels},le="+Inf"}} 1', body)
+        
+        self.assertIn('user_cache_lookups_total{result="hit"}', body)
+        
+        # Streamed exports are recorded once the last chunk is sent
+        self.client.get('/logout')
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        response = self.client.get('/admin/export-csv?start_date=2023-01-01&end_date=2023-01-31')
+        response.get_data()
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('export_size_bytes_count{kind="csv"} 1', body)
+        self.assertIn('export_duration_seconds_count{kind="csv"} 1', body)
+        
+        # Without a token only local, unproxied scrapes are answered
+        response = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.7'})
+        self.assertEqual(response.status_code, 403)
+        
+        # With one every scrape must present it
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'},
+                                   environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 200)
+    
+    def test_slow_request_log_lists_queries(self):
+        self.app.config['SLOW_REQUEST_SECONDS'] = 0
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        with self.assertLogs(self.app.logger, level='WARNING') as logs:
+            self.client.get('/api/attendance/history')
+        message = next(line for line in logs.output if 'api.attendance_history' in line)
+        self.assertIn('FROM attendance', message)
+    
+    def test_cold_start_skips_heavy_imports(self):
+        # A fresh interpreter, so modules imported by the tests do not count
+        script = (
+            'import json, sys, time\n'
+            'started = time.perf_counter()\n'
+            'from app import create_app\n'
+            'create_app()\n'
+            'print(json.dumps({"seconds": time.perf_counter() - started, '
+            '"modules": [m for m in ("reportlab", "geopy", "pypdf", "numpy") if m in sys.modules]}))\n'
+        )
+        root = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.run(
+            [sys.executable, '-c', script], cwd=root, capture_output=True, text=True, check=True,
+            env=dict(os.environ, PYTHONPATH=root)
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        
+        self.assertEqual(result['modules'], [])
+        budget = float(os.environ.get('STARTUP_BUDGET_SECONDS', 2.0))
+        self.assertLess(result['seconds'], budget)
+    
+    def test_migrations_match_models(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = migrated_app(directory)
+            with app.app_context():
+                self.assert_schema_matches_models()
+                
+                # Applied migrations are recorded and not run again
+                self.assertEqual(migrate(), [])
+                db.session.remove()
+                db.engine.dispose()
+        
+        # A database created outside the chain must be baselined first
+        with self.app.app_context():
+            with self.assertRaises(MigrationError):
+                migrate(os.path.dirname(os.path.abspath(__file__)))
+        
+        # A database from before the chain is upgraded exactly as DEPLOYMENT.md describes
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'legacy.db')
+            project = os.path.dirname(os.path.abspath(__file__))
+            with open(os.path.join(project, '0001_initial.sql')) as f:
+                connection = sqlite3.connect(path)
+                connection.executescript(f.read())
+                connection.close()
+            app = create_app({
+                'TESTING': True,
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+                'MIGRATIONS_DIR': project,
+            })
+            result = app.test_cli_runner().invoke(args=['migrate', '--baseline', '1'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Applied 0002_daily_attendance.sql', result.output)
+            with app.app_context():
+                self.assert_schema_matches_models()
+                db.session.remove()
+                db.engine.dispose()
+    
+    def assert_schema_matches_models(self):
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            self.assertEqual(columns, set(table.columns.keys()), table.name)
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                self.assertIn(index.name, indexes, table.name)
+    
+    def test_first_user_on_migrated_database_is_admin(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = migrated_app(directory)
+            client = app.test_client()
+            # 0001 seeds an admin that only the D1 frontend can log in as
+            response = client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+            self.assertIn('/login', response.headers['Location'])
+            
+            for username in ('founder', 'second'):
+                client.post('/register', data={
+                    'username': username,
+                    'email': f'{username}@example.com',
+                    'password': 'password'
+                })
+            with app.app_context():
+                self.assertTrue(User.query.filter_by(username='founder').one().is_admin)
+                self.assertFalse(User.query.filter_by(username='second').one().is_admin)
+                db.session.remove()
+                db.engine.dispose()
+    
+    def test_endpoint_queries_use_indexes(self):
+        # Full reads of these small tables are intended when unfiltered
+        full_reads = {'users', 'sites'}
+        
+        with tempfile.TemporaryDirectory() as directory:
+            app = migrated_app(directory)
+            client = app.test_client()
+            with app.app_context():
+                for username, is_admin in (('boss', True), ('worker', False)):
+                    db.session.add(User(
+                        username=username,
+                        email=f'{username}@example.com',
+                        password=generate_password_hash('password'),
+                        is_admin=is_admin
+                    ))
+                db.session.commit()
+                worker_id = User.query.filter_by(username='worker').first().id
+                for days in range(1, 4):
+                    record = Attendance(
+                        user_id=worker_id,
+                        check_in_time=datetime.utcnow() - timedelta(days=days, hours=8),
+                        check_out_time=datetime.utcnow() - timedelta(days=days)
+                    )
+                    record.set_location(37.7749, -122.4194)
+                    db.session.add(record)
+                db.session.commit()
+                rebuild_rollups()
+            
+            start_date = (datetime.utcnow() - timedelta(days=30)).strftime('%Y-%m-%d')
+            with record_statements(app) as statements:
+                client.post('/login', data={'username': 'worker', 'password': 'password'})
+                client.post('/api/attendance/check-in', json={'latitude': 37.7749, 'longitude': -122.4194})
+                client.get('/api/attendance/status')
+                page = json.loads(client.get('/api/attendance/history?limit=2').data)
+                client.get(f"/api/attendance/history?limit=2&cursor={page['next_cursor']}")
+                client.post('/api/attendance/check-out')
+                client.get('/logout')
+                
+                client.post('/login', data={'username': 'boss', 'password': 'password'})
+                page = json.loads(client.get('/api/admin/attendance?limit=2').data)
+                client.get(f"/api/admin/attendance?limit=2&cursor={page['next_cursor']}")
+                client.get(f'/api/admin/attendance?user_id={worker_id}')
+                client.get('/api/admin/attendance/nearby?latitude=37.7749&longitude=-122.4194&radius=500')
+                client.get('/api/admin/users')
+                client.get(f'/admin/export-csv?start_date={start_date}').get_data()
+                client.get(f'/admin/export-csv?start_date={start_date}&user_id={worker_id}').get_data()
+                client.get(f'/admin/export-pdf?start_date={start_date}')
+            
+            with app.app_context():
+                connection = db.engine.raw_connection()
+                try:
+                    scans = []
+                    for statement, parameters in dict.fromkeys(
+                        (statement, tuple(parameters)) for statement, parameters in statements
+                    ):
+                        if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                            continue
+                        plan = connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                        for row in plan:
+                            detail = row[-1].split()
+                            if detail[0] != 'SCAN' or 'USING' in detail or detail[1] in ('CONSTANT', 'subquery'):
+                                continue
+                            if detail[1] in full_reads and ' WHERE ' not in statement:
+                                continue
+                            scans.append(f'{row[-1]}: {statement}')
+                finally:
+                    connection.close()
+                db.session.remove()
+                db.engine.dispose()
+        
+        self.assertGreater(len(statements), 20)
+        self.assertEqual(scans, [])
+    
+    def test_sqlite_pragmas_on_connect(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'wal.db'),
+                'SQLITE_BUSY_TIMEOUT_MS': 2500,
+            })
+            with app.app_context():
+                pragma = lambda name: db.session.execute(text(f'PRAGMA {name}')).scalar()
+                self.assertEqual(pragma('journal_mode'), 'wal')
+                self.assertEqual(pragma('busy_timeout'), 2500)
+                self.assertEqual(pragma('synchronous'), 1)  # NORMAL
+                db.session.remove()
+                db.engine.dispose()
+    
+    def test_engine_options_follow_database_type(self):
+        self.assertEqual(engine_options({'SQLALCHEMY_DATABASE_URI': 'sqlite:///attendance.db'}), {})
+        
+        options = engine_options({
+            'SQLALCHEMY_DATABASE_URI': 'postgresql://attendance@db/attendance',
+            'DB_POOL_SIZE': 5,
+            'SQLALCHEMY_ENGINE_OPTIONS': {'pool_recycle': 300},
+        })
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['max_overflow'], 20)
+        self.assertEqual(options['pool_recycle'], 300)
+        self.assertTrue(options['pool_pre_ping'])
+    
+    def test_status_stream_pushes_changes(self):
+        self.app.config['SSE_KEEPALIVE'] = 0.05
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        response = self.client.get('/api/attendance/status/stream', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = response.response
+        
+        self.assertTrue(next(chunks).startswith(b'retry:'))
+        self.assertIn(b'"checked_out"', next(chunks))
+        self.assertEqual(get_broker(self.app).subscriber_count(), 1)
+        
+        # Idle streams get keepalive comments
+        self.assertEqual(next(chunks), b': keepalive\n\n')
+        
+        # A check-in from another device shows up on the open stream
+        other_device = self.app.test_client()
+        other_device.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        other_device.post('/api/attendance/check-in', json={'latitude': 37.7749, 'longitude': -122.4194})
+        event = next(chunks)
+        while event == b': keepalive\n\n':
+            event = next(chunks)
+        self.assertTrue(event.startswith(b'event: status\n'))
+        self.assertIn(b'"checked_in"', event)
+        
+        response.close()
+        self.assertEqual(get_broker(self.app).subscriber_count(), 0)
+    
+    def test_relay_broker_reaches_other_workers(self):
+        listener = Listener(('127.0.0.1', 0), authkey=b'relay-test')
+        threading.Thread(target=run_relay, args=(listener,), daemon=True).start()
+        config = {
+            'EVENT_RELAY_HOST': '127.0.0.1',
+            'EVENT_RELAY_PORT': listener.address[1],
+            'EVENT_RELAY_AUTHKEY': 'relay-test',
+        }
+        self.app.config.update(config)
+        other_worker = create_app(dict(config, EVENT_BROKER='relay'))
+        
+        try:
+            publisher = RelayBroker(self.app)
+            receiver = get_broker(other_worker)
+            self.assertTrue(publisher._connected.wait(5))
+            self.assertTrue(receiver._connected.wait(5))
+            
+            with other_worker.app_context():
+                get_open_session_cache(other_worker).set(2, {'status': 'checked_out'}, 0)
+            subscription = receiver.subscribe(2)
+            # Anything but a user id, such as a pickle, is dropped unread
+            rogue = Client(listener.address, authkey=b'relay-test')
+            rogue.send({'user_id': 2})
+            rogue.close()
+            publisher.publish(2)
+            self.assertTrue(subscription.wait(5))
+            # The other worker's cached status was dropped too
+            self.assertIsNone(get_open_session_cache(other_worker).get(2))
+            subscription.close()
+        finally:
+            listener.close()
+        
+        # The relay refuses to run on a default, guessable key
+        with self.assertRaises(RuntimeError):
+            RelayBroker(create_app({'EVENT_RELAY_AUTHKEY': None}))
+    
+    def test_conditional_get_skips_unchanged_data(self):
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        
+        for path in ('/api/attendance/history', '/api/attendance/status', '/history'):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            
+            # Nothing changed: 304 without a single query
+            with count_queries(self.app) as statements:
+                response = self.client.get(path, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304, path)
+            self.assertEqual(statements, [], path)
+            self.assertEqual(response.data, b'')
+            self.assertNotIn('Last-Modified', response.headers)
+        
+        # Different query strings are different representations
+        response = self.client.get('/api/attendance/history?limit=1')
+        self.assertNotEqual(response.headers['ETag'], etag)
+        
+        response = self.client.get('/api/attendance/history')
+        etag = response.headers['ETag']
+        self.client.post('/api/attendance/check-in', json={'latitude': 37.7749, 'longitude': -122.4194})
+        # Storing the resolved address is a change of its own
+        get_geocoder(self.app).join(timeout=5)
+        
+        response = self.client.get('/api/attendance/history', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(response.data)['history']), 3)
+        
+        # Committing a bump drops the cached user, wherever it is committed
+        etag = response.headers['ETag']
+        with self.app.app_context():
+            user = User.query.filter_by(username='user').first()
+            bump_data_version([user.id])
+            db.session.commit()
+        response = self.client.get('/api/attendance/history', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+    
+    def test_admin_analytics(self):
+        sessions = [
+            ('2025-03-03 09:30', '2025-03-03 18:30'),  # Monday, late and an hour over
+            ('2025-03-04 08:45', '2025-03-04 12:00'),
+            ('2025-03-04 13:00', '2025-03-04 17:00'),
+            ('2025-03-05 09:10', '2025-03-05 17:10'),
+        ]
+        with self.app.app_context():
+            for check_in, check_out in sessions:
+                record = Attendance(
+                    user_id=2,
+                    check_in_time=datetime.strptime(check_in, '%Y-%m-%d %H:%M'),
+                    check_out_time=datetime.strptime(check_out, '%Y-%m-%d %H:%M')
+                )
+                record.set_location(37.7749, -122.4194)
+                db.session.add(record)
+            db.session.commit()
+        
+        self.client.post('/login', data={
+            'username': 'user',
+            'password': 'password'
+        })
+        self.assertEqual(self.client.get('/api/admin/analytics/summary').status_code, 403)
+        self.client.get('/logout')
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        
+        params = '?start_date=2025-03-03&end_date=2025-03-05'
+        data = json.loads(self.client.get('/api/admin/analytics/summary' + params).data)
+        self.assertEqual(data['users'], [{
+            'user_id': 2,
+            'username': 'user',
+            'sessions': 4,
+            'days_worked': 3,
+            'total_hours': 24.25,
+            'avg_session_hours': 6.06,
+            'late_days': 2,
+            'avg_late_minutes': 20.0,
+            'overtime_hours': 1.0,
+            'trend_hours_per_week': -3.5,
+        }])
+        
+        # A zero-length session on an hour boundary, earliest of all, adds nothing
+        with self.app.app_context():
+            record = Attendance(
+                user_id=2,
+                check_in_time=datetime(2025, 3, 3, 8, 0),
+                check_out_time=datetime(2025, 3, 3, 8, 0)
+            )
+            record.set_location(37.7749, -122.4194)
+            db.session.add(record)
+            db.session.commit()
+        
+        response = self.client.get('/api/admin/analytics/occupancy' + params)
+        self.assertEqual(response.status_code, 200)
+        occupancy = json.loads(response.data)['occupancy']
+        self.assertEqual(occupancy[0][7], 0.0)
+        self.assertEqual(occupancy[0][8], 0.0)
+        self.assertEqual(occupancy[0][9], 0.5)
+        self.assertEqual(occupancy[0][10], 1.0)
+        self.assertEqual(occupancy[1][8], 0.25)
+        self.assertEqual(occupancy[1][12], 0.0)
+        self.assertEqual(occupancy[2][16], 1.0)
+        self.assertEqual(occupancy[3][10], 0.0)
+    
+    def _render_report(self, section):
+        start_date = (datetime.utcnow() - timedelta(days=14)).date()
+        end_date = datetime.utcnow().date()
+        output = io.BytesIO()
+        with self.app.app_context():
+            write_pdf(output, start_date, end_date, section=section)
+        return output.getvalue()
+    
+    def test_archived_sessions_stay_reportable(self):
+        sessions = [
+            (2, '2023-01-10 09:00', '2023-01-10 17:00'),
+            (2, '2023-01-20 09:00', '2023-01-20 17:00'),
+            (2, '2023-02-05 09:00', '2023-02-05 17:00'),
+            (1, '2023-01-15 09:00', None),  # never checked out, so it stays live
+        ]
+        with self.app.app_context():
+            for user_id, check_in, check_out in sessions:
+                record = Attendance(
+                    user_id=user_id,
+                    check_in_time=datetime.strptime(check_in, '%Y-%m-%d %H:%M'),
+                    check_out_time=datetime.strptime(check_out, '%Y-%m-%d %H:%M') if check_out else None,
+                    notes=f'archived {check_in}'
+                )
+                record.set_location(37.7749, -122.4194)
+                db.session.add(record)
+            db.session.commit()
+        
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config['ARCHIVE_DIR'] = directory
+            with self.app.app_context():
+                self.assertEqual(archive_sessions(datetime(2024, 1, 1)), 3)
+                self.assertEqual(archive_sessions(datetime(2024, 1, 1)), 0)
+                self.assertEqual(sorted(os.listdir(directory)), ['attendance-2023-01.npz', 'attendance-2023-02.npz'])
+                self.assertEqual(Attendance.query.count(), 3)
+                
+                # Text is one UTF-8 buffer per column, not padded to the longest value
+                import numpy as np
+                with np.load(os.path.join(directory, 'attendance-2023-01.npz')) as data:
+                    self.assertEqual(data['notes_bytes'].dtype, np.uint8)
+                    self.assertEqual(len(data['notes_bytes']), 2 * len('archived 2023-01-10 09:00'))
+                    self.assertFalse([name for name in data.files if data[name].dtype.kind in 'UO'])
+                
+                # Ranges outside the archive open no partitions
+                self.assertEqual(partitions(datetime(2023, 3, 1), datetime(2024, 1, 1)), [])
+                self.assertEqual(len(partitions(datetime(2023, 1, 31), datetime(2023, 2, 1))), 2)
+                
+                # Rollups rebuilt after archiving still count archived days
+                rebuild_rollups()
+                self.assertEqual(summarize(datetime(2023, 1, 1).date(), datetime(2023, 12, 31).date(), 2),
+                                 {'sessions': 3, 'total_hours': 24.0})
+            
+            self.client.post('/login', data={
+                'username': 'admin',
+                'password': 'password'
+            })
+            response = self.client.get('/admin/export-csv?start_date=2023-01-01')
+            rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))[1:]
+            self.assertEqual(len(rows), 6)
+            self.assertEqual([row[2][:10] for row in rows[2:]], ['2023-02-05', '2023-01-20', '2023-01-15', '2023-01-10'])
+            self.assertEqual(rows[2][1], 'user')
+            self.assertEqual(rows[2][4], '8.0')
+            self.assertEqual(rows[2][5], '37.7749, -122.4194')
+            self.assertEqual(rows[2][7], 'archived 2023-02-05 09:00')
+            
+            response = self.client.get('/admin/export-csv?start_date=2023-01-01&end_date=2023-01-31&user_id=2')
+            self.assertEqual(len(response.get_data(as_text=True).splitlines()), 3)
+            
+            data = json.loads(self.client.get(
+                '/api/admin/analytics/summary?start_date=2023-01-01&end_date=2023-03-01'
+            ).data)
+            self.assertEqual([(user['user_id'], user['sessions']) for user in data['users']], [(2, 3)])
+            
+            # The paged and search APIs only cover live rows
+            data = json.loads(self.client.get('/api/admin/attendance?start_date=2023-01-01').data)
+            self.assertEqual(len(data['attendance']), 3)
+            data = json.loads(self.client.get(
+                '/api/admin/attendance/nearby?latitude=37.7749&longitude=-122.4194&start_date=2023-01-01'
+            ).data)
+            self.assertEqual(len(data['attendance']), 3)
+            
+            self.client.get('/logout')
+            self.client.post('/login', data={
+                'username': 'user',
+                'password': 'password'
+            })
+            self.assertEqual(len(json.loads(self.client.get('/api/attendance/history').data)['history']), 2)
+            self.assertEqual(len(json.loads(self.client.get('/api/attendance/sync').data)['changes']), 2)
+            # The history page shows every session, archived months included
+            response = self.client.get('/history')
+            self.assertEqual(response.get_data(as_text=True).count('<td>2023-'), 3)
+    
+    def test_sectioned_pdf_in_process(self):
+        self.app.config['PDF_WORKERS'] = 0
+        data = self._render_report('week')
+        self.assertTrue(data.startswith(b'%PDF'))
+        
+        # A report for an unknown user is a 404, not a crash
+        self.client.post('/login', data={
+            'username': 'admin',
+            'password': 'password'
+        })
+        self.assertEqual(self.client.get('/admin/export-pdf?user_id=999').status_code, 404)
+        self.assertEqual(self.client.get('/admin/export-pdf?user_id=2').status_code, 200)
+    
+    @unittest.skipUnless(PdfWriter, 'pypdf is not installed')
+    def test_sectioned_pdf_in_process_pool(self):
+        from pypdf import PdfReader
+        self.app.config['PDF_WORKERS'] = 2
+        try:
+            for section in ('user', 'week'):
+                data = self._render_report(section)
+                pages = PdfReader(io.BytesIO(data)).pages
+                
+                # A summary page, then at least one page per non-empty section
+                self.assertGreaterEqual(len(pages), 2)
+                self.assertIn('Total Records: 2', pages[0].extract_text())
+                self.assertIn('Check-in Time', pages[-1].extract_text())
+        finally:
+            self.app.extensions.pop('pdf_pool').shutdown()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import defaultdict
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from app.models.models import User, db
+
+
+class UserCache:
+    """Per-worker cache of users for the Flask-Login user loader.
+
+    Entries are detached copies that are merged into the request's
+    session without a query. Like the open-session cache, a versioned
+    set() keeps a load that raced an invalidation from being stored.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def version(self, user_id):
+        with self._lock:
+            return self._versions[user_id]
+
+    def set(self, user_id, user, version):
+        with self._lock:
+            if self._versions[user_id] == version:
+                self._entries[user_id] = (user, time.monotonic() + self.ttl)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._versions[user_id] += 1
+            self._entries.pop(user_id, None)
+
+
+_init_lock = threading.Lock()
+
+
+def get_user_cache(app=None):
+    app = app or current_app._get_current_object()
+    cache = app.extensions.get('user_cache')
+    if cache is None:
+        with _init_lock:
+            cache = app.extensions.get('user_cache')
+            if cache is None:
+                cache = UserCache(ttl=app.config.get('USER_CACHE_TTL', 60))
+                app.extensions['user_cache'] = cache
+    return cache
+
+
+def _detached_copy(user):
+    columns = {column.key: getattr(user, column.key) for column in inspect(User).column_attrs}
+    copy = User(**columns)
+    make_transient_to_detached(copy)
+    return copy
+
+
+def load_cached_user(user_id):
+    """Return the user for an id, querying only on a cache miss"""
+    cache = get_user_cache()
+    cached = cache.get(user_id)
+    if cached is not None:
+        return db.session.merge(cached, load=False)
+
+    version = cache.version(user_id)
+    user = User.query.get(user_id)
+    if user is not None:
+        cache.set(user_id, _detached_copy(user), version)
+    return user
+
+
+def invalidate_user(user_id, app=None):
+    """Drop a cached user; call after committing a change to it"""
+    get_user_cache(app).invalidate(user_id)
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    # Catches changes made outside the endpoints that invalidate explicitly,
+    # e.g. password resets from a shell
+    if has_app_context():
+        invalidate_user(target.id)